@@ -1,7 +1,9 @@
+import argparse
 import os
 import re
+import tempfile
 import time
-import aiohttp, asyncio
+import asyncio
 import datetime
 from asyncpg import Connection
 import asyncpg
@@ -10,52 +12,74 @@ import numpy as np
 from typing import Dict, List
 from bs4 import BeautifulSoup
 from pandas import DataFrame
-import requests
 import concurrent.futures
+import functools
+import multiprocessing
+import utils.alias as alias
 import utils.db_connect as db
+import utils.http as http
+import utils.pgcopy as pgcopy
+import utils.smogon as smogon
+import utils.source as source
+from utils.lookup import Lookup
+from utils.pipeline import batches, feed, stage
+from utils.table import from_columns
 
 NUM_CORES = os.cpu_count()
 TASK_COUNT = 5
 FILTER = r"^(gen[5-9])?(doubles)?(ou|ubers|anythinggoes|vgc\d{4}(series\d)?)-\d+\.json$"
+MONTH_FOLDER = r"^\d{4}-\d{2}.*/$"
+
+
+async def fetch_file(spool_dir: str, url: str):
+    # the fetch stage; streams the file into `spool_dir` (or just finds it, in a
+    # mirror directory), so only its path goes on to the process pool.
+    try:
+        path = source.local_path(url)
+        spooled = path is None
+        if spooled:
+            path = await source.spool(url, spool_dir)
+        return url, path, spooled
+    except Exception as e:
+        print(f"failed to download {url}: {e!r}")
+        http.dead_letter(url, e)
+        return url, None, False
+
+
+async def parse_file(pool: concurrent.futures.Executor, item):
+    # the parse stage; the workers read the file off disk a chunk at a time and hand
+    # back packed (pokemon, ability, usage) columns.
+    url, path, spooled = item
+    if path is None:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, smogon.ability_usage, path)
+    except Exception as e:
+        print(f"failed to parse {url}: {e!r}")
+        return None
+    finally:
+        if spooled:
+            os.remove(path)
+
+
+async def collect_usage(inbox: asyncio.Queue, total: int) -> DataFrame:
+    # the single loader; every worker's rows end up summed into one frame.
+    usage = DataFrame({"pokemon": [], "ability": [], "usage": []})
+    seen = 0
+    async for batch in batches(inbox, TASK_COUNT):
+        frames = [usage] + [from_columns(c) for c in batch if c is not None]
+        usage = (
+            pd.concat(frames, ignore_index=True)
+            .groupby(["pokemon", "ability"], as_index=False)["usage"]
+            .sum()
+        )
+        seen += len(batch)
+        print(f"Processed {seen}/{total} files.")
+    return usage
 
 
-async def import_file(url: str):
-    # one session per file.
-    async with aiohttp.ClientSession() as session:
-        response = await session.get(url)
-        json = await response.json()
-    info = json["info"]
-    df = DataFrame.from_dict(json["data"], orient="index")
-    abilities = df["Abilities"].copy()
-    # Preserving memory.
-    del df, json
-
-
-async def chunk_worker(chunk: List[str]):
-    for file in chunk:
-        await import_file(file)
-
-
-async def file_worker(files: List[str]):
-    chunk_size = round(len(files) / TASK_COUNT)
-    async with asyncio.TaskGroup() as tg:
-        for i in range(TASK_COUNT):
-            begin = i * chunk_size
-            end = (i + 1) * chunk_size if i < TASK_COUNT - 1 else len(files)
-            tg.create_task(chunk_worker(files[begin:end]))
-
-
-def process_files(files: List[str], id: int):
-    start = time.perf_counter()
-    print(f"Process #{id + 1} started.")
-    asyncio.run(file_worker(files))
-    stop = time.perf_counter()
-    print(
-        f"Process #{id + 1} ended in {stop - start:0.3f}s. ({len(files)} files processed)"
-    )
-
-
-def get_links(url: str, reg: str = None) -> List[str]:
+async def get_links(url: str, reg: str = None) -> List[str]:
     """Helper function that parses the html of the stats page
     and returns the list of url links that can be seen on it.
 
@@ -68,8 +92,8 @@ def get_links(url: str, reg: str = None) -> List[str]:
         List[str]: The list of urls that we see on the webpage
         (excluding any backwards links/regex filtered links).
     """
-    res = requests.get(url)
-    soup = BeautifulSoup(res.text, "html.parser")
+    text = await source.get_listing(url)
+    soup = BeautifulSoup(text, "html.parser")
     urls = []
     if reg == None:
         links = soup.find_all("a")
@@ -82,151 +106,142 @@ def get_links(url: str, reg: str = None) -> List[str]:
     return urls
 
 
-def query_helper(pokemon: str, iter):
-    if iter == 1:
-        return f"""SELECT pokemon_info_id FROM pokemon_info WHERE name LIKE'%{pokemon}%';"""
-    elif iter > 2:
-        # finding gendered pokemon.
-        if re.match(r".*-(male|female|m|f)$", pokemon):
-            gender = pokemon.split("-")[-1]
-            # nidoran is special :3
-            if "nidoran" in pokemon:
-                if gender == "male":
-                    pokemon = "nidoranm"
-                else:
-                    pokemon = "nidoranf"
-            else:
-                split = pokemon.split("-")
-                pokemon = split[0]
-                for i in range(len(split) - 2):
-                    pokemon += f"-{split[i + 1]}"
-                if gender == "female":
-                    pokemon += "-f"
-        else:
-            # for all EXCEPT these, we just remove everything after the final -
-            if "raticate" in pokemon or "marowak" in pokemon:
-                split = pokemon.split("-")
-                pokemon = split[0] + "-alola-totem"
-            elif "zygarde" in pokemon:
-                pokemon += "%"
-            elif "basculin" in pokemon or "morpeko" in pokemon:
-                split = pokemon.split("-")
-                pokemon = split[0]
-            else:
-                split = pokemon.split("-")
-                pokemon = split[0]
-                for i in range(len(split) - 2):
-                    pokemon += f"-{split[i + 1]}"
-    return f"""SELECT pokemon_info_id FROM pokemon_info WHERE name = '{pokemon}';"""
-
-
-async def add_ability_chunk(abilities):
-    chunk = {}
-    async with aiohttp.ClientSession() as session:
-        for ability in abilities:
-            response = await session.get(ability["url"])
-            json = await response.json()
-            pokemon = json["pokemon"]
-            p_dict = {}
-            for p in pokemon:
-                p_dict[p["pokemon"]["name"]] = p["slot"]
-            chunk[ability["name"]] = p_dict
-    with db.tunnel() as server:
-        conn = await db.connect(server)
-        ability_1 = []
-        ability_2 = []
-        hidden_ability = []
-        for ability in chunk.keys():
-            ability_record = await conn.fetch(
-                f"""SELECT ability_info_id FROM ability_info WHERE name = '{ability}';"""
-            )
-            ability_id = ability_record[0]["ability_info_id"]
-            for pokemon in chunk[ability]:
-                if "walking-wake" not in pokemon or "iron-leaves" not in pokemon:
-                    records, iter = "", 0
-                    while len(records) != 1 and iter < 4:
-                        query = query_helper(pokemon, iter)
-                        records = await conn.fetch(query)
-                        iter += 1
-                    if len(records) != 1:
-                        print(pokemon)
-                    else:
-                        id = records[0]["pokemon_info_id"]
-                        match chunk[ability][pokemon]:
-                            case 1:
-                                ability_1.append((ability_id, id))
-                            case 2:
-                                ability_2.append((ability_id, id))
-                            case 3:
-                                hidden_ability.append((ability_id, id))
-
-        stmt_1 = (
-            """UPDATE pokemon_info SET ability_1 = $1 WHERE pokemon_info_id = $2;"""
-        )
-        stmt_2 = (
-            """UPDATE pokemon_info SET ability_2 = $1 WHERE pokemon_info_id = $2;"""
-        )
-        stmt_h = """UPDATE pokemon_info SET hidden_ability = $1 WHERE pokemon_info_id = $2;"""
-        await conn.executemany(stmt_1, ability_1)
-        await conn.executemany(stmt_2, ability_2)
-        await conn.executemany(stmt_h, hidden_ability)
-        await conn.close()
+async def get_ability_chunk(abilities) -> List:
+    # the (pokemon name, slot, ability) of every pokemon that has these abilities.
+    rows = []
+    for ability in abilities:
+        json = await source.get_json(ability["url"])
+        for p in json["pokemon"]:
+            rows.append((p["pokemon"]["name"], p["slot"], ability["name"]))
+    return rows
 
 
 async def add_abilities():
-    async with aiohttp.ClientSession() as session:
-        response = await session.get("https://pokeapi.co/api/v2/ability?limit=500")
-        json = await response.json()
-    results = json["results"]
-    with db.tunnel() as server:
-        conn = await db.connect(server)
-        stmt = """INSERT INTO ability_info(name) VALUES ($1);"""
-        vals = list(map(lambda x: (x["name"],), results))
-        await conn.executemany(stmt, vals)
-        await conn.close()
-    chunk_size = round(len(results) / TASK_COUNT)
     start = time.perf_counter()
-    async with asyncio.TaskGroup() as tg:
-        for i in range(TASK_COUNT):
-            begin = i * chunk_size
-            end = (i + 1) * chunk_size if i < TASK_COUNT - 1 else len(results)
-            tg.create_task(add_ability_chunk(results[begin:end]))
+    # every fetch shares one cached, keep-alive session.
+    async with http.session():
+        json = await source.get_json("https://pokeapi.co/api/v2/ability?limit=500")
+        results = json["results"]
+        chunk_size = round(len(results) / TASK_COUNT)
+        async with asyncio.TaskGroup() as tg:
+            chunks = []
+            for i in range(TASK_COUNT):
+                begin = i * chunk_size
+                end = (i + 1) * chunk_size if i < TASK_COUNT - 1 else len(results)
+                chunks.append(tg.create_task(get_ability_chunk(results[begin:end])))
+    rows = [row for chunk in chunks for row in chunk.result()]
+    async with db.pool():
+        async with db.acquire() as conn:
+            # running it again only adds the abilities that aren't there yet.
+            await conn.execute(
+                """CREATE UNIQUE INDEX IF NOT EXISTS ability_info_name
+                   ON ability_info (name);"""
+            )
+            stmt = """INSERT INTO ability_info(name) VALUES ($1)
+                      ON CONFLICT (name) DO NOTHING;"""
+            vals = list(map(lambda x: (x["name"],), results))
+            await conn.executemany(stmt, vals)
+            ability_ids = Lookup.from_records(
+                await conn.fetch("""SELECT name, ability_info_id FROM ability_info;""")
+            )
+            pokemon_ids = await alias.pokemon_lookup(conn)
+        # every name is resolved here (through the alias table), then they all go
+        # out in one UPDATE.
+        slots = {1: "ability_1", 2: "ability_2", 3: "hidden_ability"}
+        resolved = []
+        for pokemon, slot, ability in rows:
+            id = pokemon_ids.get(alias.slug(pokemon))
+            if id is None:
+                print(pokemon)
+            elif slot in slots:
+                resolved.append((id, slots[slot], ability_ids[ability]))
+        df = (
+            DataFrame(resolved, columns=["pokemon_info_id", "slot", "ability_id"])
+            .drop_duplicates(["pokemon_info_id", "slot"], keep="last")
+            .pivot(index="pokemon_info_id", columns="slot", values="ability_id")
+            .reindex(columns=list(slots.values()))
+            .astype("Int64")
+            .reset_index()
+        )
+        async with db.acquire() as conn:
+            # a slot the pokemon doesn't have is left as it was.
+            await pgcopy.update_frame(
+                conn, "pokemon_info", df, "pokemon_info_id", keep_existing=True
+            )
     stop = time.perf_counter()
     runtime = time.strftime("%M:%S", time.gmtime(stop - start))
     print(f"Added all abilities in {runtime} minutes.")
 
 
-def main():
+async def get_file_links(smogon_url: str, until: str = None) -> List[str]:
+    async with http.session():
+        folders = await get_links(smogon_url, MONTH_FOLDER)
+        # folders are named `YYYY-MM...`, so they compare as strings; `until` is inclusive.
+        if until is not None:
+            folders = [
+                f for f in folders if f.rstrip("/").rsplit("/", 1)[1][:7] <= until
+            ]
+        files = []
+        for folder in folders:
+            chaos = f"{folder}chaos/"
+            files.extend(await get_links(chaos, FILTER))
+    return files
+
+
+async def process_files(files: List[str]) -> DataFrame:
+    # downloads, parsing and collecting all run at once, with bounded queues in
+    # between; the parsing is spread over every core.
+    urls, paths, parsed = (
+        asyncio.Queue(),
+        asyncio.Queue(2 * NUM_CORES),
+        asyncio.Queue(),
+    )
+    with concurrent.futures.ProcessPoolExecutor(
+        NUM_CORES, mp_context=multiprocessing.get_context("spawn")
+    ) as pool, tempfile.TemporaryDirectory(prefix="abilities-") as spool_dir:
+        async with http.session():
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(feed(files, urls))
+                fetch = functools.partial(fetch_file, spool_dir)
+                tg.create_task(stage(fetch, urls, paths, TASK_COUNT))
+                parse = functools.partial(parse_file, pool)
+                tg.create_task(stage(parse, paths, parsed, NUM_CORES))
+                usage = tg.create_task(collect_usage(parsed, len(files)))
+    return usage.result()
+
+
+def main(smogon_url: str = "https://www.smogon.com/stats/", until: str = None):
     print("Getting smogon links...")
     start = time.perf_counter()
-    smogon_url = "https://www.smogon.com/stats/"
-    # we do have some regex here - this is for excluding data past January 2023.
-    folders = get_links(smogon_url, r"^20(?!2[3-9]-[01][2-9])\d{2}-[01]\d.*/$")
-    files = []
-    for folder in folders:
-        chaos = f"{folder}/chaos/"
-        files.extend(get_links(chaos, FILTER))
+    files = asyncio.run(get_file_links(smogon_url, until))
     stop = time.perf_counter()
     print(f"Got {len(files)} file links in {stop - start:0.3f}s")
-    futures = []
-    chunk_size = round(len(files) / NUM_CORES)
     # there's so much data being processed in abilities; that it's
-    # best to use multiple CPU cores. since each process is working
-    # independently and managing multiple downloads at once; it shouldn't
-    # present any unique issues.
+    # best to use multiple CPU cores. the workers only ever see file paths,
+    # and everything they parse comes back to this one process.
     start = time.perf_counter()
-    with concurrent.futures.ProcessPoolExecutor(NUM_CORES) as executor:
-        for i in range(NUM_CORES):
-            # splitting the folders roughly among our various processes.
-            begin = i * chunk_size
-            end = (i + 1) * chunk_size if i < NUM_CORES - 1 else len(files)
-            new_future = executor.submit(process_files, files=files[begin:end], id=i)
-            futures.append(new_future)
-    concurrent.futures.wait(futures)
+    usage = asyncio.run(process_files(files))
     stop = time.perf_counter()
     runtime = time.strftime("%M:%S", time.gmtime(stop - start))
     print(f"Processed all files in {runtime} minutes.")
+    print(usage.sort_values("usage", ascending=False).head(20))
+    return usage
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root",
+        default="https://www.smogon.com/stats/",
+        help="the stats page to import from, e.g. a local fixture server",
+    )
+    parser.add_argument(
+        "--until", help="the last month (YYYY-MM) to import; defaults to all of them"
+    )
+    source.add_arguments(parser)
+    db.add_arguments(parser)
+    args = parser.parse_args()
+    db.configure_from_args(args)
+    source.configure_from_args(args)
+    root = args.root if args.root.endswith("/") else f"{args.root}/"
+    main(root, args.until)
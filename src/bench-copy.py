@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import time
+import numpy as np
+from pandas import DataFrame
+import utils.db_connect as db
+import utils.pgcopy as pgcopy
+from utils.table import to_columns
+
+"""
+Benchmark for loading a move_stats-sized batch: `copy_records_to_table` fed from
+`df.itertuples` (what the importers used to do) against the binary encoder in
+`utils.pgcopy`. Rows go into a temporary table shaped like move_stats (plus an
+item_stats-like text column), so nothing real is touched. Takes the usual
+`--db-*` options, e.g. `--no-tunnel` for a local database.
+"""
+
+ROWS = 2_000_000
+
+
+def fake_rows(n: int) -> DataFrame:
+    rng = np.random.default_rng(0)
+    items = np.array([f"item-{i}" for i in range(300)], dtype=object)
+    return DataFrame(
+        {
+            "stats_id": np.repeat(np.arange(n // 40 + 1), 40)[:n],
+            "move_id": rng.integers(1, 900, n),
+            "move_usage": rng.random(n),
+            "item_name": items[rng.integers(0, len(items), n)],
+        }
+    )
+
+
+async def with_itertuples(conn, df: DataFrame) -> float:
+    await conn.execute("TRUNCATE bench_copy;")
+    start = time.perf_counter()
+    await conn.copy_records_to_table(
+        "bench_copy", records=df.itertuples(index=False, name=None), columns=list(df)
+    )
+    return time.perf_counter() - start
+
+
+async def with_pgcopy(conn, df: DataFrame) -> float:
+    await conn.execute("TRUNCATE bench_copy;")
+    start = time.perf_counter()
+    await pgcopy.copy_frame(conn, "bench_copy", df)
+    return time.perf_counter() - start
+
+
+def encode_only(df: DataFrame, types) -> float:
+    start = time.perf_counter()
+    cols = to_columns(df, downcast=False)
+    fields = [pgcopy._field(types[name], cols[name]) for name in cols]
+    for begin in range(0, len(df.index), pgcopy.CHUNK_ROWS):
+        end = min(begin + pgcopy.CHUNK_ROWS, len(df.index))
+        pgcopy.encode(fields, begin, end, begin == 0, end == len(df.index))
+    return time.perf_counter() - start
+
+
+async def main(rows: int):
+    df = fake_rows(rows)
+    conn = await db.connect()
+    try:
+        await conn.execute(
+            """CREATE TEMP TABLE bench_copy (
+                   stats_id int8, move_id int4, move_usage float8, item_name text
+               );"""
+        )
+        types = await pgcopy.column_types(conn, "bench_copy")
+        old = await with_itertuples(conn, df)
+        new = await with_pgcopy(conn, df)
+        encode = encode_only(df, types)
+        assert await conn.fetchval("SELECT count(*) FROM bench_copy;") == rows
+    finally:
+        await conn.close()
+    print(f"itertuples + copy_records_to_table: {rows / old:12.0f} rows/s ({old:.2f}s)")
+    print(f"pgcopy binary COPY:                 {rows / new:12.0f} rows/s ({new:.2f}s)")
+    print(f"  of which encoding:                {rows / encode:12.0f} rows/s ({encode:.2f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=ROWS)
+    db.add_arguments(parser)
+    args = parser.parse_args()
+    db.configure_from_args(args)
+    asyncio.run(main(args.rows))
@@ -0,0 +1,61 @@
+import asyncio
+import time
+import aiohttp
+from aiohttp import web
+import utils.http as http
+
+"""
+Benchmarks a session-per-url crawl (how the importers used to fetch) against the
+shared keep-alive session in `utils.http`, using a local fixture server so the
+numbers don't depend on pokeapi.co.
+"""
+
+N_REQUESTS = 2000
+BATCH = 100
+
+
+async def fixture(request: web.Request):
+    return web.json_response({"name": request.match_info["name"], "id": 1})
+
+
+async def start_fixture():
+    app = web.Application()
+    app.router.add_get("/api/v2/pokemon/{name}/", fixture)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/api/v2/pokemon/"
+
+
+async def per_url(url: str):
+    async with aiohttp.ClientSession() as session:
+        res = await session.get(url)
+        await res.json()
+
+
+async def crawl(base: str, fetch_fn):
+    start = time.perf_counter()
+    for offset in range(0, N_REQUESTS, BATCH):
+        async with asyncio.TaskGroup() as tg:
+            for i in range(offset, offset + BATCH):
+                tg.create_task(fetch_fn(f"{base}{i}/"))
+    return time.perf_counter() - start
+
+
+async def main():
+    runner, base = await start_fixture()
+    try:
+        old = await crawl(base, per_url)
+        # no rate limit either, so this measures connection reuse and not the limiter.
+        async with http.session(cache=False, rate_per_host=None):
+            new = await crawl(base, http.get_json)
+    finally:
+        await runner.cleanup()
+    print(f"session per url: {N_REQUESTS / old:8.0f} req/s ({old:0.3f}s)")
+    print(f"shared session:  {N_REQUESTS / new:8.0f} req/s ({new:0.3f}s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
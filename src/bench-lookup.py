@@ -0,0 +1,63 @@
+import time
+import numpy as np
+from utils.lookup import Lookup
+
+"""
+Benchmarks resolving a synthetic move_pool (1,300 pokemon x 900 moves, ~80 moves
+learned each) with the old `np.where` scans against `utils.lookup.Lookup`.
+"""
+
+N_POKEMON = 1300
+N_MOVES = 900
+MOVES_PER_POKEMON = 80
+
+
+def synthetic():
+    rng = np.random.default_rng(420)
+    pokemon = [(f"pokemon-{i}", i + 1) for i in range(N_POKEMON)]
+    moves = [(f"move-{i}", i + 1) for i in range(N_MOVES)]
+    learnsets = [
+        [f"move-{m}" for m in rng.choice(N_MOVES, MOVES_PER_POKEMON, replace=False)]
+        for _ in range(N_POKEMON)
+    ]
+    return pokemon, moves, learnsets
+
+
+def with_np_where(pokemon, moves, learnsets) -> float:
+    start = time.perf_counter()
+    pokemon, moves = np.array(pokemon, dtype=object), np.array(moves, dtype=object)
+    for i, learnset in enumerate(learnsets):
+        pkmn_id = pokemon[np.where(pokemon[:, 0] == f"pokemon-{i}")][0][1]
+        for m in learnset:
+            move_id = moves[np.where(moves[:, 0] == m)][0][1]
+    return time.perf_counter() - start
+
+
+def with_lookup(pokemon, moves, learnsets) -> float:
+    start = time.perf_counter()
+    pokemon, moves = Lookup.from_records(pokemon), Lookup.from_records(moves)
+    for i, learnset in enumerate(learnsets):
+        pkmn_id = pokemon[f"pokemon-{i}"]
+        for m in learnset:
+            move_id = moves[m]
+    return time.perf_counter() - start
+
+
+def with_lookup_map(pokemon, moves, learnsets) -> float:
+    start = time.perf_counter()
+    pokemon, moves = Lookup.from_records(pokemon), Lookup.from_records(moves)
+    pokemon.map([f"pokemon-{i}" for i in range(len(learnsets))])
+    moves.map([m for learnset in learnsets for m in learnset])
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    data = synthetic()
+    n = N_POKEMON * MOVES_PER_POKEMON
+    for name, fn in [
+        ("np.where", with_np_where),
+        ("Lookup[]", with_lookup),
+        ("Lookup.map", with_lookup_map),
+    ]:
+        t = fn(*data)
+        print(f"{name:10}: {t:8.4f}s ({n / t:12.0f} lookups/s)")
@@ -0,0 +1,109 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import time
+from typing import List
+import utils.smogon as smogon
+from utils.lookup import Lookup
+
+"""
+Benchmark for the parse stage of the smogon import: `smogon.transform_file` over a
+batch of synthetic chaos files, with 1, 2, 4... worker processes up to one per core.
+It also compares how many bytes a file's tables take to send back to the loader as
+DataFrames versus packed numpy columns. Point it at a mirror with `--files` (a list
+of chaos json paths) to time real data instead.
+"""
+
+MONTH = datetime.date(2024, 1, 1)
+N_FILES = 32
+N_POKEMON = 400
+
+
+def fake_file(seed: int) -> bytes:
+    rng = random.Random(seed)
+    names = [f"Poke {i}" for i in range(N_POKEMON)]
+    data = {}
+    for name in names:
+        data[name] = {
+            "Raw count": rng.randint(1, 10_000),
+            "Moves": {f"move{j}": rng.random() for j in range(40)},
+            "Abilities": {f"ability{j}": rng.random() for j in range(3)},
+            "Items": {f"item{j}": rng.random() for j in range(30)},
+            "Spreads": {
+                f"Adamant:{j}/0/4/0/252/252": rng.random() for j in range(60)
+            },
+            "Teammates": {rng.choice(names): rng.random() for _ in range(40)},
+            "Checks and Counters": {rng.choice(names): [1, 2, 3] for _ in range(40)},
+        }
+    info = {"metagame": "gen9ou", "cutoff": 1500, "number of battles": 1000}
+    return json.dumps({"info": info, "data": data}).encode()
+
+
+def lookups():
+    # keyed by slugs, like the alias tables.
+    pokemon = Lookup([f"poke{i}" for i in range(N_POKEMON)], range(N_POKEMON))
+    moves = Lookup([f"move{j}" for j in range(40)], range(40))
+    abilities = Lookup([f"ability{j}" for j in range(3)], range(3), smogon.strip_dashes)
+    return pokemon, moves, abilities
+
+
+def with_workers(bodies: List[bytes], workers: int) -> float:
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=smogon.init_worker,
+        initargs=lookups(),
+    ) as pool:
+        # warming every worker up first, so process start-up isn't timed.
+        list(pool.map(abs, range(workers)))
+        start = time.perf_counter()
+        for _ in pool.map(smogon.transform_file, bodies, [MONTH] * len(bodies)):
+            pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", nargs="*", help="chaos json files to parse")
+    args = parser.parse_args()
+    if args.files:
+        bodies = []
+        for path in args.files:
+            with open(path, "rb") as f:
+                bodies.append(f.read())
+    else:
+        bodies = [fake_file(i) for i in range(N_FILES)]
+    size = sum(map(len, bodies)) / 2**20
+    print(f"{len(bodies)} files, {size:.1f} MiB")
+
+    tables, _ = smogon.transform(bodies[0], MONTH, *lookups())
+    smogon.init_worker(*lookups())
+    packed, _ = smogon.transform_file(bodies[0], MONTH)
+    for label, value in [("DataFrames", tables), ("packed columns", packed)]:
+        start = time.perf_counter()
+        for _ in range(20):
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.loads(data)
+        elapsed = (time.perf_counter() - start) / 20
+        print(
+            f"one file's tables as {label:>14}: {len(data) / 1024:6.0f} KiB, "
+            f"{elapsed * 1000:6.2f}ms to pickle and unpickle"
+        )
+
+    workers, base = 1, None
+    while True:
+        elapsed = with_workers(bodies, workers)
+        base = base or elapsed
+        print(
+            f"{workers:3} workers: {len(bodies) / elapsed:7.2f} files/s "
+            f"({base / elapsed:.2f}x)"
+        )
+        if workers >= (os.cpu_count() or 1):
+            break
+        workers = min(workers * 2, os.cpu_count())
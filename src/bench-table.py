@@ -0,0 +1,38 @@
+import time
+from pandas import DataFrame
+from utils.table import TableBuilder
+
+"""
+Microbenchmark for growing a move_pool batch: `df.loc[len(df.index)] = row`
+(what the pokeapi fetchers used to do) against `utils.table.TableBuilder`.
+"""
+
+COLUMNS = ["pokemon_info_id", "move_id"]
+# the loc path is quadratic, so it gets a smaller batch to keep the run short.
+LOC_ROWS = 5_000
+BUILDER_ROWS = 200_000
+
+
+def with_loc(n: int) -> float:
+    start = time.perf_counter()
+    df = DataFrame(columns=COLUMNS)
+    for i in range(n):
+        df.loc[len(df.index)] = [i // 100, i % 900]
+    df.drop_duplicates()
+    return time.perf_counter() - start
+
+
+def with_builder(n: int) -> float:
+    start = time.perf_counter()
+    rows = TableBuilder(COLUMNS)
+    for i in range(n):
+        rows.append([i // 100, i % 900])
+    rows.to_frame().drop_duplicates()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    old = with_loc(LOC_ROWS)
+    new = with_builder(BUILDER_ROWS)
+    print(f"df.loc:       {LOC_ROWS / old:12.0f} rows/s ({LOC_ROWS} rows)")
+    print(f"TableBuilder: {BUILDER_ROWS / new:12.0f} rows/s ({BUILDER_ROWS} rows)")
@@ -1,75 +1,56 @@
 from datetime import date, timedelta
+import argparse
 import asyncio
 import matplotlib
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
+from matplotlib.collections import LineCollection
 from pandas import DataFrame
-from utils.db_connect import connect
+import utils.db_connect as db
+import utils.report as report
+import utils.rollup as rollup
 
 matplotlib.use("Agg")
 
+# How many of the most used pokemon eric_eda highlights, and their colors.
+TOP_N = 5
+TOP_COLORS = ["gold", "silver", "saddlebrown", "darkcyan", "darkolivegreen"]
 
-async def eric_eda():
-    conn = await connect()
-    await conn.execute("""set search_path = "p42002_03";""")
-    query_all = """
-select p.name, m.month, sum(ps.raw_count) / t.count percentage
-from pokemon_info p,
-	 pokemon_stats ps,
-	 metagame_info m
-		 left join (select month, sum(total_battles)::float count
-					from metagame_info m2
-					where m2.cutoff = 0
-					group by month) t on t.month = m.month
-where p.pokemon_info_id = ps.pokemon_info_id
-  and m.metagame_id = ps.metagame_id
-  and m.cutoff = 0
-group by m.month, p.name, t.count;"""
-    query_top_5 = """
-        select p.name
-from pokemon_stats ps,
-	 pokemon_info p,
-	 metagame_info m
-where ps.pokemon_info_id = p.pokemon_info_id
-  and m.metagame_id = ps.metagame_id
-  and m.cutoff = 0
-group by p.name
-order by sum(ps.raw_count) desc
-limit 5;"""
-    all_pokemon = await conn.fetch(query_all)
-    top_5 = await conn.fetch(query_top_5)
-    conn.close()
-    df = DataFrame.from_records(all_pokemon)
-    pokemon = df[0].unique()
-    top_5_pokemon = DataFrame.from_records(top_5)[0].unique()
+
+# reads the `usage_monthly` summary table (see `utils.rollup`).
+USAGE_OVER_TIME_QUERY = """
+select p.name, u.month, u.share percentage, u.raw_count
+from usage_monthly u,
+	 pokemon_info p
+where p.pokemon_info_id = u.pokemon_info_id;"""
+
+
+def eric_eda(df: DataFrame):
+    # one column per pokemon, one row per month (NaN where it wasn't used).
+    usage = df.pivot(index="month", columns="name", values="percentage").sort_index()
+    # the most used pokemon of all time, most used first.
+    top = df.groupby("name")["raw_count"].sum().nlargest(TOP_N).index
     fig, ax = plt.subplots(figsize=(10, 4), dpi=150, layout="compressed")
     ax.spines["top"].set_visible(False)
     ax.spines["right"].set_visible(False)
-    max_y = df[2].max()
-    for p in pokemon:
-        vals = df[df[0] == p]
-        if p not in top_5_pokemon:
-            ax.plot(vals[1], vals[2], c="grey", alpha=0.5, linewidth=0.1)
-    for i in range(len(top_5_pokemon) - 1, -1, -1):
-        p = top_5_pokemon[i]
-        vals = df[df[0] == p]
-        match i:
-            case 0:
-                color = "gold"
-            case 1:
-                color = "silver"
-            case 2:
-                color = "saddlebrown"
-            case 3:
-                color = "darkcyan"
-            case 4:
-                color = "darkolivegreen"
-            case _:
-                color = None
-        ax.plot(vals[1], vals[2], c=color)
-        final = vals[vals[1] == vals[1].max()]
-        final_x, final_y = final[1].values[0], final[2].values[0]
+    max_y = np.nanmax(usage.to_numpy())
+    # every other pokemon's line goes into a single LineCollection. Each line is
+    # its column's (month, usage) points, skipping the months it wasn't used.
+    rest = usage.drop(columns=top).to_numpy().T
+    used = ~np.isnan(rest)
+    x = np.broadcast_to(mdates.date2num(usage.index), rest.shape)
+    points = np.column_stack((x[used], rest[used]))
+    lines = np.split(points, np.cumsum(used.sum(axis=1))[:-1])
+    ax.add_collection(LineCollection(lines, colors="grey", alpha=0.5, linewidths=0.1))
+    ax.xaxis_date()
+    for i in range(len(top) - 1, -1, -1):
+        p = top[i]
+        vals = usage[p].dropna()
+        color = TOP_COLORS[i] if i < len(TOP_COLORS) else None
+        ax.plot(vals.index, vals.to_numpy(), c=color)
+        final_x, final_y = vals.index[-1], vals.iloc[-1]
         x, y = [final_x, final_x + timedelta(weeks=4), final_x + timedelta(weeks=8)], [
             final_y,
             max_y - ((max_y / 5) * i),
@@ -102,57 +83,34 @@ limit 5;"""
     fig.savefig("usageovertime.png", dpi=300)
 
 
-async def drake_eda():
-    conn = await connect
-    moves_vs_usage_query = "SELECT \
-            move_query.pokemon_info_id, move_query.name, move_query.moves_available, usage_query.percent_used \
-            FROM (SELECT ps.pokemon_info_id, p.name, SUM(ps.raw_count::float) / SUM(mg.total_battles) AS percent_used \
-          FROM pokemon_info p, \
-               pokemon_stats ps, \
-               metagame_info mg \
-          WHERE mg.cutoff = 0 \
-            AND ps.metagame_id = mg.metagame_id \
-            AND p.pokemon_info_id = ps.pokemon_info_id \
-          GROUP BY ps.pokemon_info_id, p.name \
-          ORDER BY percent_used DESC) usage_query, \
-         (SELECT m.pokemon_info_id, p.name, COUNT(DISTINCT m.move_id) AS moves_available \
-          FROM pokemon_info p, \
-               move_pool m \
-          WHERE p.pokemon_info_id = m.pokemon_info_id \
-          GROUP BY m.pokemon_info_id, p.name \
-          ORDER BY COUNT(m.move_id) DESC) move_query \
-            WHERE move_query.pokemon_info_id = usage_query.pokemon_info_id \
-            ORDER BY percent_used DESC;"
-    # This query intentionally double counts pokemon with multiple types so they can apply to both types
-    type_vs_usage_query = "(SELECT ps.pokemon_info_id, p.name, p.primary_type AS type,  \
-                              SUM(ps.raw_count::float) / SUM(mg.total_battles) AS percent_used \
-      FROM pokemon_info p, \
-           pokemon_stats ps, \
-           metagame_info mg \
-      WHERE mg.cutoff = 0 \
-        AND ps.metagame_id = mg.metagame_id \
-        AND p.pokemon_info_id = ps.pokemon_info_id \
-      GROUP BY ps.pokemon_info_id, p.name, p.primary_type, p.secondary_type \
-      ORDER BY percent_used DESC) \
-    UNION ALL \
-    SELECT ps.pokemon_info_id, p.name, p.secondary_type AS type, SUM(ps.raw_count::float)  \
-                              / SUM(mg.total_battles) AS percent_used \
-      FROM pokemon_info p, \
-           pokemon_stats ps, \
-           metagame_info mg \
-      WHERE mg.cutoff = 0 \
-        AND ps.metagame_id = mg.metagame_id \
-        AND p.pokemon_info_id = ps.pokemon_info_id \
-        AND p.secondary_type IS NOT NULL \
-      GROUP BY ps.pokemon_info_id, p.name, p.primary_type, p.secondary_type ORDER BY percent_used DESC;"
+# both read the summary tables (see `utils.rollup`); usage across every month
+# is the sum of each month's raw counts over the sum of its battles.
+MOVES_VS_USAGE_QUERY = """
+select u.pokemon_info_id, p.name, mp.moves_available,
+       sum(u.raw_count)::float / sum(u.battles) as percent_used
+from usage_monthly u,
+     pokemon_info p,
+     move_pool_size mp
+where p.pokemon_info_id = u.pokemon_info_id
+  and mp.pokemon_info_id = u.pokemon_info_id
+group by u.pokemon_info_id, p.name, mp.moves_available
+order by percent_used desc;"""
+# This query intentionally double counts pokemon with multiple types so they can apply to both types
+TYPE_VS_USAGE_QUERY = """
+select u.pokemon_info_id, p.name, t.type,
+       sum(u.raw_count)::float / sum(u.battles) as percent_used
+from usage_monthly u
+     join pokemon_info p on p.pokemon_info_id = u.pokemon_info_id
+     cross join lateral (values (1, p.primary_type), (2, p.secondary_type)) t(slot, type)
+where t.type is not null
+group by u.pokemon_info_id, p.name, t.slot, t.type
+order by percent_used desc;"""
+
+
+def drake_moves_eda(moves_vs_usage: DataFrame):
     # Column 0 is pokemon id, 1 is pokemon name, 2 is move pool, 3 is usage of pokemon
-    moves_vs_usage_res = await conn.fetch(moves_vs_usage_query)
-    moves_vs_usage = DataFrame(moves_vs_usage_res).drop(columns=[0])
+    moves_vs_usage = moves_vs_usage.drop(columns=moves_vs_usage.columns[0])
     moves_vs_usage.columns = ["name", "available_moves", "usage_percent"]
-    type_vs_usage_res = await conn.fetch(type_vs_usage_query)
-    type_vs_usage = DataFrame(type_vs_usage_res).drop(columns=[0])
-    type_vs_usage.columns = ["name", "type", "usage_percent"]
-    conn.close()
     p1 = sns.scatterplot(
         data=moves_vs_usage[["available_moves", "usage_percent"]],
         x="available_moves",
@@ -174,8 +132,11 @@ async def drake_eda():
             weight="medium",
         )
     plt.savefig("moves_vs_popularity_labeled")
-    # Reset figure to do type
-    plt.figure()
+
+
+def drake_type_eda(type_vs_usage: DataFrame):
+    type_vs_usage = type_vs_usage.drop(columns=type_vs_usage.columns[0])
+    type_vs_usage.columns = ["name", "type", "usage_percent"]
     mean_order = (
         type_vs_usage.groupby(["type"])["usage_percent"]
         .aggregate(np.mean)
@@ -191,7 +152,7 @@ async def drake_eda():
     plt.savefig("popularity_by_type")
 
 
-async def peter_eda():
+def peter_eda():
     # Type hex codes
     BUG = "#9ACD32"
     DARK = "#000000"
@@ -211,7 +172,6 @@ async def peter_eda():
     ROCK = "#A0522D"
     STEEL = "#808080"
     WATER = "#0000FF"
-    conn = await connect()
     # popularity_by_egg_group_query =  """
     # select pk.name, eg.name, pkie.pokemon_info_id, pkie.egg_group_id,
     # SUM(ps.raw_count::float) / SUM(mg.total_battles) as percent_used
@@ -240,7 +200,6 @@ async def peter_eda():
     #                 "#A0522D", "#6B8E23", "#0000CD", "#00008B"]
     # sns.set_palette(sns.color_palette(custom_colors))
     # Order: Fire, Dragon, Steel, Fairy, Electric, Psychic, Ghost, Grass, Fighting, Rock, Flying, Water, Ice, Normal, Ground, Dark, Poison, Bug
-    conn.close()
 
     type_colors = [
         NORMAL,
@@ -329,10 +288,38 @@ async def peter_eda():
     plt.savefig("damage_by_type")
 
 
-async def main():
-    await eric_eda()
-    # await drake_eda()
-    # await peter_eda()
+# every figure in the report, with the queries it's drawn from.
+FIGURES = [
+    report.Figure("usage_over_time", [USAGE_OVER_TIME_QUERY], eric_eda, ["usageovertime.png"]),
+    report.Figure(
+        "moves_vs_popularity",
+        [MOVES_VS_USAGE_QUERY],
+        drake_moves_eda,
+        ["moves_vs_popularity.png", "moves_vs_popularity_labeled.png"],
+    ),
+    report.Figure(
+        "popularity_by_type", [TYPE_VS_USAGE_QUERY], drake_type_eda, ["popularity_by_type.png"]
+    ),
+    report.Figure("damage_by_type", [], peter_eda, ["damage_by_type.png"]),
+]
 
 
-asyncio.run(main())
+async def main(force: bool = False):
+    async with db.pool():
+        # builds the summary tables from what's been imported, if nothing has yet.
+        async with db.acquire() as conn:
+            await rollup.ensure_rollups(conn)
+        drawn = await report.run(FIGURES, force=force)
+    print(f"Drew {len(drawn)}/{len(FIGURES)} figures: {', '.join(drawn) or 'none changed'}")
+
+
+# the guard keeps the render workers (which re-import this file) from running the report.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draws the EDA figures.")
+    parser.add_argument(
+        "--force", action="store_true", help="redraw every figure, even unchanged ones"
+    )
+    db.add_arguments(parser)
+    args = parser.parse_args()
+    db.configure_from_args(args)
+    asyncio.run(main(args.force))
@@ -1,16 +1,21 @@
-import aiohttp, asyncio
+import argparse
+import asyncio
 from pandas import DataFrame
-from asyncpg.connection import Connection
-from utils.db_connect import connect
+import utils.alias as alias
+import utils.db_connect as db
+import utils.http as http
+import utils.pgcopy as pgcopy
+import utils.rollup as rollup
+import utils.source as source
 
 
 async def get_pokemon_info():
-    conn = await connect()
-    records = await conn.fetch(
-        """select pokemon_info_id, name, dex_no, is_primary, is_mythical, is_legendary
-               from pokemon_info
-               order by dex_no;"""
-    )
+    async with db.acquire() as conn:
+        records = await conn.fetch(
+            """select pokemon_info_id, name, dex_no, is_primary, is_mythical, is_legendary
+                   from pokemon_info
+                   order by dex_no;"""
+        )
     df = DataFrame.from_records(
         records,
         columns=[
@@ -22,59 +27,56 @@ async def get_pokemon_info():
             "is_legendary",
         ],
     )
-    conn.close()
     return df
 
 
 async def correct_dex_no(url: str, pkmn_info: DataFrame):
-    async with aiohttp.ClientSession() as session:
-        res = await session.get(url)
-        json = await res.json()
-        order = json["order"]
-        dex_no = json["pokedex_numbers"][0]["entry_number"]
-        is_mythical = json["is_mythical"]
-        is_legendary = json["is_legendary"]
-        our_forms = pkmn_info[pkmn_info["old_dex_no"] == order].index
-        their_forms = json["varieties"]
-        if (
-            order == dex_no
-            and not is_mythical
-            and not is_legendary
-            and len(our_forms) == 1
-        ):
-            pkmn_info.drop(our_forms, inplace=True)
-        else:
-            if json["name"] == "urshifu":
-                pass
-            if len(our_forms) > 1:
-                pkmn_info.loc[
-                    (pkmn_info["old_dex_no"] == order)
-                    & ~(pkmn_info["name"] == json["name"]),
-                    ["is_primary"],
-                ] = False
-                if (
-                    len(
-                        pkmn_info[
+    json = await source.get_json(url)
+    order = json["order"]
+    dex_no = json["pokedex_numbers"][0]["entry_number"]
+    is_mythical = json["is_mythical"]
+    is_legendary = json["is_legendary"]
+    our_forms = pkmn_info[pkmn_info["old_dex_no"] == order].index
+    their_forms = json["varieties"]
+    if (
+        order == dex_no
+        and not is_mythical
+        and not is_legendary
+        and len(our_forms) == 1
+    ):
+        pkmn_info.drop(our_forms, inplace=True)
+    else:
+        if json["name"] == "urshifu":
+            pass
+        if len(our_forms) > 1:
+            pkmn_info.loc[
+                (pkmn_info["old_dex_no"] == order)
+                & ~(pkmn_info["name"] == json["name"]),
+                ["is_primary"],
+            ] = False
+            if (
+                len(
+                    pkmn_info[
+                        (pkmn_info["old_dex_no"] == order)
+                        & (pkmn_info["is_primary"])
+                    ]
+                )
+                != 1
+            ):
+                for v in their_forms:
+                    if v["is_default"]:
+                        name = v["pokemon"]["name"]
+                        pkmn_info.loc[
                             (pkmn_info["old_dex_no"] == order)
-                            & (pkmn_info["is_primary"])
-                        ]
-                    )
-                    != 1
-                ):
-                    for v in their_forms:
-                        if v["is_default"]:
-                            name = v["pokemon"]["name"]
-                            pkmn_info.loc[
-                                (pkmn_info["old_dex_no"] == order)
-                                & ~(pkmn_info["name"] == name),
-                                ["is_primary"],
-                            ] = False
-                            break
-            pkmn_info.loc[our_forms, ["dex_no", "is_mythical", "is_legendary"]] = [
-                dex_no,
-                is_mythical,
-                is_legendary,
-            ]
+                            & ~(pkmn_info["name"] == name),
+                            ["is_primary"],
+                        ] = False
+                        break
+        pkmn_info.loc[our_forms, ["dex_no", "is_mythical", "is_legendary"]] = [
+            dex_no,
+            is_mythical,
+            is_legendary,
+        ]
 
 
 async def main():
@@ -82,33 +84,43 @@ async def main():
     pkmn_info["old_dex_no"] = pkmn_info["dex_no"]
     next = "https://pokeapi.co/api/v2/pokemon-species?offset=0&limit=100"
     # Getting corrected data and storing it into pkmn_info
-    while next != None:
-        async with aiohttp.ClientSession() as session:
-            res = await session.get(next)
-            json = await res.json()
+    async with http.session():
+        while next != None:
+            json = await source.get_json(next)
             async with asyncio.TaskGroup() as tg:
                 for val in json["results"]:
-                    tg.create_task(correct_dex_no(val["url"], pkmn_info))
+                    fix = correct_dex_no(val["url"], pkmn_info)
+                    tg.create_task(http.or_dead_letter(val["url"], fix))
             next = json["next"]
-    start = 0
-    total_pkmn = len(pkmn_info.index)
-    cnt = 0
-    # Storing our updates to the database.
-    conn: Connection = await connect()
-    await conn.execute("""set search_path = "p42002_03";""")
-    stmt = await conn.prepare(
-        """
-            update pokemon_info
-            set dex_no=$2, is_primary=$3, is_mythical=$4, is_legendary=$5
-            where pokemon_info_id=$1;
-            """
-    )
+    for url, error in http.dead_letters():
+        print(f"gave up on {url}: {error}")
+    # Storing our updates to the database; they're COPYed into a staging table
+    # and applied with a single UPDATE, rather than one UPDATE per pokemon.
     pkmn_info.drop(["old_dex_no", "name"], axis=1, inplace=True)
-    records = pkmn_info.itertuples(index=False)
-    await stmt.executemany(records)
-    conn.close()
+    async with db.acquire() as conn:
+        cnt = await pgcopy.update_frame(
+            conn, "pokemon_info", pkmn_info, "pokemon_info_id"
+        )
+        # which form is primary decides some aliases, so they're rebuilt.
+        await alias.ensure_aliases(conn, rebuild=True)
+        # the type summaries are keyed off pokemon_info, so they're redone whole.
+        await rollup.ensure_rollups(conn)
+        await rollup.refresh(conn, None)
     print(pkmn_info)
     print(cnt)
 
 
-asyncio.run(main())
+async def run():
+    async with db.pool():
+        await main()
+
+
+parser = argparse.ArgumentParser(
+    description="Corrects dex numbers and flags from pokeapi's species data."
+)
+source.add_arguments(parser)
+db.add_arguments(parser)
+args = parser.parse_args()
+db.configure_from_args(args)
+source.configure_from_args(args)
+asyncio.run(run())
@@ -1,7 +1,14 @@
-import aiohttp, asyncio
-import numpy as np
+import argparse
+import asyncio
 from pandas import DataFrame
-from utils.db_connect import connect
+import utils.alias as alias
+import utils.db_connect as db
+import utils.pgcopy as pgcopy
+import utils.rollup as rollup
+from utils.lookup import Lookup
+from utils.table import TableBuilder
+import utils.http as http
+import utils.source as source
 
 """
 ORDER OF IMPORTS:
@@ -12,10 +19,10 @@ ORDER OF IMPORTS:
 5.  metagame_info  - smogon  [X]
 6.  pokemon_stats  - smogon  [X]
 7.  move_stats     - smogon  [X]
-8.  nature_stats   - smogon  [ ]
-9.  ability_stats  - smogon  [ ]
-10. teammate_stats - smogon  [ ]
-11. item_stats     - smogon  [ ]
+8.  nature_stats   - smogon  [X]
+9.  ability_stats  - smogon  [X]
+10. teammate_stats - smogon  [X]
+11. item_stats     - smogon  [X]
 *may end up being last form import due to multi-to-multi reasons.
 """
 
@@ -37,146 +44,134 @@ async def append_df(table: str, df: DataFrame, index=False):
 
         index (bool, optional): Whether or not to use the index of the dataframe when appending. Defaults to False.
     """
-    conn = await connect()
-    records = df.itertuples(index=index, name=None)
-    # appending the table.
-    await conn.copy_records_to_table(
-        table,
-        records=records,
-        columns=list(df),
-        timeout=10,
-    )
-    conn.close()
-
-
-async def get_pokemon_info(url: str, df: DataFrame):
-    try:
-        async with aiohttp.ClientSession() as session:
-            res = await session.get(url)
-            json = await res.json()
-            # dex number requires a separate API call
-            species_res = await session.get(json["species"]["url"])
-            species_json = await species_res.json()
-            # getting optional secondary type
-            type_1, type_2 = json["types"][0]["type"]["name"], None
-            if len(json["types"]) > 1:
-                type_2 = json["types"][1]["type"]["name"]
-            stats = json["stats"]
-            # All the information for pokemon_info.
-            row = [
-                species_json["order"],
-                json["name"],
-                type_1,
-                type_2,
-                stats[0]["base_stat"],
-                stats[1]["base_stat"],
-                stats[2]["base_stat"],
-                stats[3]["base_stat"],
-                stats[4]["base_stat"],
-                stats[5]["base_stat"],
-                species_json["generation"]["name"],
-            ]
-            df.loc[len(df.index)] = row
-    except Exception:
-        print(url)
-
-
-async def get_move_info(url: str, df: DataFrame):
-    async with aiohttp.ClientSession() as session:
-        res = await session.get(url)
-        json = await res.json()
-        if json["type"]["name"] == "shadow":
-            return
-        row = [
-            json["name"],
-            json["type"]["name"],
-            json["damage_class"]["name"],
-            json["power"],
-            json["accuracy"],
-            json["pp"],
-            json["priority"],
-        ]
-        df.loc[len(df.index)] = row
+    # appending the table; whole columns are encoded straight into a binary COPY.
+    if index:
+        df = df.reset_index()
+    async with db.acquire() as conn:
+        await pgcopy.copy_frame(conn, table, df, timeout=10)
+
+
+async def get_pokemon_info(url: str, rows: TableBuilder):
+    json = await source.get_json(url)
+    # dex number requires a separate API call
+    species_json = await source.get_json(json["species"]["url"])
+    # getting optional secondary type
+    type_1, type_2 = json["types"][0]["type"]["name"], None
+    if len(json["types"]) > 1:
+        type_2 = json["types"][1]["type"]["name"]
+    stats = json["stats"]
+    # All the information for pokemon_info.
+    row = [
+        species_json["order"],
+        json["name"],
+        type_1,
+        type_2,
+        stats[0]["base_stat"],
+        stats[1]["base_stat"],
+        stats[2]["base_stat"],
+        stats[3]["base_stat"],
+        stats[4]["base_stat"],
+        stats[5]["base_stat"],
+        species_json["generation"]["name"],
+    ]
+    rows.append(row)
+
+
+async def get_move_info(url: str, rows: TableBuilder):
+    json = await source.get_json(url)
+    if json["type"]["name"] == "shadow":
+        return
+    row = [
+        json["name"],
+        json["type"]["name"],
+        json["damage_class"]["name"],
+        json["power"],
+        json["accuracy"],
+        json["pp"],
+        json["priority"],
+    ]
+    rows.append(row)
 
 
 async def preprocess_move_pool():
-    conn = await connect()
-    pkmn_res = await conn.fetch(f"SELECT name, pokemon_info_id FROM pokemon_info")
-    move_res = await conn.fetch(f"SELECT name, move_id FROM move_info")
-    pokemon = np.array(pkmn_res)
-    moves = np.array(move_res)
-
-    async def get_movepool(url: str, df: DataFrame):
-        async with aiohttp.ClientSession() as session:
-            res = await session.get(url)
-            json = await res.json()
-            pkmn_id = pokemon[np.where(pokemon[:, 0] == json["name"])][0][1]
-            for m in json["moves"]:
-                move_id = moves[np.where(moves[:, 0] == m["move"]["name"])][0][1]
-                row = [pkmn_id, move_id]
-                df.loc[len(df.index)] = row
+    async with db.acquire() as conn:
+        pkmn_res = await conn.fetch(f"SELECT name, pokemon_info_id FROM pokemon_info")
+        move_res = await conn.fetch(f"SELECT name, move_id FROM move_info")
+    pokemon = Lookup.from_records(pkmn_res)
+    moves = Lookup.from_records(move_res)
+
+    async def get_movepool(url: str, rows: TableBuilder):
+        json = await source.get_json(url)
+        pkmn_id = pokemon[json["name"]]
+        for m in json["moves"]:
+            move_id = moves[m["move"]["name"]]
+            row = [pkmn_id, move_id]
+            rows.append(row)
 
     return get_movepool
 
 
-async def get_egg_groups(url, df: DataFrame):
-    async with aiohttp.ClientSession() as session:
-        res = await session.get(url)
-        json = await res.json()
-        row = [json["name"], json["id"]]
-        df.loc[len(df.index)] = row
+async def get_egg_groups(url, rows: TableBuilder):
+    json = await source.get_json(url)
+    row = [json["name"], json["id"]]
+    rows.append(row)
 
 
 async def preprocess_egg_groups():
-    conn = await connect()
-    pkmn_res = await conn.fetch(
-        f"SELECT name, pokemon_info_id FROM pokemon_info"
-    )
-    egg_res = await conn.fetch(
-        f"SELECT name, egg_group_id FROM egg_group"
-    )
-    pokemon = np.array(pkmn_res)
-    egg_groups = np.array(egg_res)
-
-    async def get_egg_rel(url, df: DataFrame):
-        async with aiohttp.ClientSession() as session:
-            res = await session.get(url)
-            json = await res.json()
-            species_res = await session.get(json["species"]["url"])
-            species_json = await species_res.json()
-            pkmn_id = pokemon[np.where(pokemon[:, 0] == json["name"])][0][1]
-            for e in species_json["egg_groups"]:
-                egg_id = egg_groups[np.where(egg_groups[:, 0] == e["name"])][0][1]
-                row = [pkmn_id, egg_id]
-                df.loc[len(df.index)] = row
+    async with db.acquire() as conn:
+        pkmn_res = await conn.fetch(f"SELECT name, pokemon_info_id FROM pokemon_info")
+        egg_res = await conn.fetch(f"SELECT name, egg_group_id FROM egg_group")
+    pokemon = Lookup.from_records(pkmn_res)
+    egg_groups = Lookup.from_records(egg_res)
+
+    async def get_egg_rel(url, rows: TableBuilder):
+        json = await source.get_json(url)
+        species_json = await source.get_json(json["species"]["url"])
+        pkmn_id = pokemon[json["name"]]
+        for e in species_json["egg_groups"]:
+            egg_id = egg_groups[e["name"]]
+            row = [pkmn_id, egg_id]
+            rows.append(row)
 
     return get_egg_rel
 
 
 async def import_pokeapi(url, columns, table, get_fn):
-    async with aiohttp.ClientSession() as session:
-        # Getting Pokémon in batches of 20 at a time.
-        next = url
-        offset = 0
-        while next != None:
-            df = DataFrame(columns=columns)
-            res = await session.get(next)
-            json = await res.json()
-            print(f"appending {table}: {offset} - {len(json['results']) + offset - 1}")
-            # doing API calls in batches of 20.
-            async with asyncio.TaskGroup() as tg:
-                for val in json["results"]:
-                    tg.create_task(get_fn(val["url"], df))
-            # dropping identical rows
-            df = df.drop_duplicates()
-            # sending the stuff to the db
-            await append_df(table, df)
-            next = json["next"]
-            offset += 20
+    # Getting Pokémon in batches of 20 at a time.
+    next = url
+    offset = 0
+    rows = TableBuilder(columns)
+    while next != None:
+        rows.clear()
+        json = await source.get_json(next)
+        print(f"appending {table}: {offset} - {len(json['results']) + offset - 1}")
+        # doing API calls in batches of 20.
+        async with asyncio.TaskGroup() as tg:
+            for val in json["results"]:
+                # a url that still fails after its retries is set aside as a
+                # dead letter, instead of taking the whole page down with it.
+                fetch = get_fn(val["url"], rows)
+                tg.create_task(http.or_dead_letter(val["url"], fetch))
+        # dropping identical rows
+        df = rows.to_frame().drop_duplicates()
+        # sending the stuff to the db
+        await append_df(table, df)
+        next = json["next"]
+        offset += 20
 
 
 async def main():
+    # every fetcher below shares this one keep-alive session and connection pool.
+    async with http.session(), db.pool():
+        await run_imports()
+        # the alias tables are built from pokemon_info and move_info.
+        async with db.acquire() as conn:
+            await alias.ensure_aliases(conn, rebuild=True)
+    for url, error in http.dead_letters():
+        print(f"gave up on {url}: {error}")
 
+
+async def run_imports():
     pkmn_inf = (
         "https://pokeapi.co/api/v2/pokemon",
         [
@@ -221,6 +216,18 @@ async def main():
     )
     v1, v2, v3, v4 = egg_g_inf[0], egg_g_inf[1], egg_g_inf[2], egg_g_inf[3]
     # await import_pokeapi(v1, v2, v3, v4)
-
-
+    # move_pool_size is counted off move_pool, so it's redone after every import.
+    async with db.acquire() as conn:
+        await rollup.ensure_rollups(conn)
+        await rollup.refresh_move_pools(conn)
+
+
+parser = argparse.ArgumentParser(
+    description="Imports pokemon, moves, move pools and egg groups from pokeapi."
+)
+source.add_arguments(parser)
+db.add_arguments(parser)
+args = parser.parse_args()
+db.configure_from_args(args)
+source.configure_from_args(args)
 asyncio.run(main())
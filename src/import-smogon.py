@@ -1,37 +1,69 @@
+import argparse
 import re
-from typing import Dict, List
-import aiohttp, asyncio
+from typing import Dict, List, Tuple
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import tempfile
 import time, datetime
-import pandas as pd
 import numpy as np
 from bs4 import BeautifulSoup
-from pandas import DataFrame
-from utils.db_connect import connect
+from asyncpg.connection import Connection
+import utils.alias as alias
+import utils.cursor as cursor
+import utils.db_connect as db
+import utils.migrate as migrate
+import utils.pgcopy as pgcopy
+import utils.rollup as rollup
+import utils.http as http
+import utils.source as source
+import utils.smogon as smogon
+from utils.keys import ensure_sequence, reserve_ids
+from utils.lookup import Lookup
+from utils.manifest import ManifestRow, done_urls, ensure_manifest, record
+from utils.pipeline import batches, feed, stage
+from utils.smogon import TABLE_NAMES
+from utils.table import columns_len, concat_columns, unpack_column
 
 # for debugging.
 pkmn_outliers = set()
 move_outliers = set()
+ability_outliers = set()
+spread_outliers = set()
 
+SMOGON_URL = "https://www.smogon.com/stats/"
+# The month folders on the stats page look like `2023-01/` (some have a suffix after the month).
+MONTH_FOLDER = r"^\d{4}-\d{2}.*/$"
 
-async def append_df(table: str, df: DataFrame):
-    """Function appends the dataframe to the provided table.
+# How many files are downloaded at once.
+FETCHERS = 16
+# How many processes parse files at once.
+PARSERS = os.cpu_count() or 1
+# The most files that are loaded in a single transaction.
+BATCH_SIZE = 100
+# Imports of at least this many files drop the indexes first and build them again
+# at the end, rather than keeping them up to date as every batch goes in.
+BULK_FILES = 50
+
+
+async def append_columns(table: str, cols: Dict[str, Tuple], conn: Connection = None):
+    """Function appends packed columns (see `utils.table.to_columns`) to the provided table.
 
     Args:
         table (str): The table in the database that's being appended to.
-        df (DataFrame): The dataframe that is being appended to the table.
-        The names of the columns in the dataframe must match the names of the columns
-        in the database.
-        index (bool, optional): Whether or not to use the index of the dataframe when appending. Defaults to False.
+        cols (Dict[str, Tuple]): The packed columns that are being appended to the table.
+        Their names must match the names of the columns in the database.
+        conn (Connection, optional): The connection to append on, e.g. one that's in the
+        middle of a transaction. Defaults to borrowing one from the pool.
     """
-    conn = await connect()
-    records = df.itertuples(index=False, name=None)
-    # appending the table.
-    await conn.copy_records_to_table(
-        table,
-        records=records,
-        columns=list(df),
-    )
-    conn.close()
+    if conn is None:
+        async with db.acquire() as conn:
+            return await append_columns(table, cols, conn)
+    # appending the table; the parse workers' columns are encoded straight into a
+    # binary COPY, without going through a DataFrame.
+    await pgcopy.copy_packed(conn, table, cols)
 
 
 async def get_links(url: str, reg: str = None) -> List[str]:
@@ -47,18 +79,16 @@ async def get_links(url: str, reg: str = None) -> List[str]:
         List[str]: The list of urls that we see on the webpage
         (excluding any backwards links/regex filtered links).
     """
-    async with aiohttp.ClientSession() as session:
-        res = await session.get(url)
-        text = await res.text()
-        soup = BeautifulSoup(text, "html.parser")
-        urls = []
-        for l in soup.find_all("a"):
-            href = l.get("href")
-            if href != "../":
-                if reg == None:
-                    urls.append(f"{url}{href}")
-                elif re.match(reg, href):
-                    urls.append(f"{url}{href}")
+    text = await source.get_listing(url)
+    soup = BeautifulSoup(text, "html.parser")
+    urls = []
+    for l in soup.find_all("a"):
+        href = l.get("href")
+        if href != "../":
+            if reg == None:
+                urls.append(f"{url}{href}")
+            elif re.match(reg, href):
+                urls.append(f"{url}{href}")
     return urls
 
 
@@ -80,224 +110,325 @@ async def add_data_files(url: str, month: datetime.date, data_files: List[str]):
         data_files.append([f, month])
 
 
-async def extract_json(df: DataFrame, column: str, c1: str, c2: str, explode_on: str):
-    m = (
-        pd.DataFrame([*df[column]], df.index)
-        .stack()
-        .rename_axis([None, c1])
-        .reset_index(1, name=c2)
-    )
-    return df[[explode_on]].join(m)
+async def fetch_file(spool_dir: str, item: Tuple[str, datetime.date]) -> Tuple:
+    """The fetch stage: streams a data file into `spool_dir` (or just finds it, in a
+    mirror directory), so only its path goes down the pipeline rather than its whole
+    body.
+    """
+    url, month = item
+    try:
+        path = source.local_path(url)
+        spooled = path is None
+        if spooled:
+            path = await source.spool(url, spool_dir)
+        return url, month, path, spooled, None
+    except Exception as e:
+        print(f"failed to download {url}: {e!r}")
+        http.dead_letter(url, e)
+        failed = ManifestRow(url, month, status="failed", error=repr(e))
+        return url, month, None, False, failed
 
 
-async def get_smogon_data(
-    url: str,
-    month: datetime.date,
-    pokemon: DataFrame,
-    moves: DataFrame,
-    shift: Dict[str, int],
-    dataframes: Dict[str, DataFrame],
-):
-    """This is the core function of the program. This takes in a url to a json file,
-    gathers the data from it, transforms it, and calls `append_df` to add all of the
-    info to the database.
+async def parse_file(
+    pool: concurrent.futures.Executor, item: Tuple
+) -> Tuple[Dict[str, Dict[str, Tuple]], ManifestRow, Dict[str, set]]:
+    """The parse stage: runs `smogon.transform` on a downloaded file in the process
+    pool (which reads it off disk a chunk at a time, and hands the tables back as
+    packed numpy columns) and describes how it went for the manifest. A file that
+    fails is recorded as failed (and retried next run) instead of taking the rest of
+    its batch down with it.
 
-    Args:
-        url (str): The link to the json file we're reading.
-        month (datetime.date): The month that this json file is associated with.
-        pokemon (DataFrame): A dataframe that's equal to the `pokemon_info` table
-        in the database.
-        moves (DataFrame): A dataframe that's equal to the `move_info` table
-        in the database.
+    Returns:
+        Tuple[Dict[str, Dict[str, Tuple]], ManifestRow, Dict[str, set]]: The file's
+        packed tables (None if it was empty or failed), its manifest row and its outliers.
     """
-    async with aiohttp.ClientSession() as session:
-        # getting the json data
-        res = await session.get(url)
-        json = await res.json()
-        # skipping empty data
-        if json["data"] == {}:
-            return
-        meta_inf = json["info"]
-        # generating a single dataframe of metagame info. this is basically just a single row of the table.
-        meta_idx = len(dataframes["metagame_info"].index) + shift["metagame_info"]
-        meta_df = DataFrame(
-            columns=["metagame_name", "cutoff", "month", "total_battles"]
-        )
-        meta_df.loc[len(meta_df.index)] = [
-            meta_inf["metagame"],
-            meta_inf["cutoff"],
-            month,
-            meta_inf["number of battles"],
-        ]
-        dataframes["metagame_info"] = pd.concat(
-            [dataframes["metagame_info"], meta_df], ignore_index=True
-        )
-        # this creates a dataframe with indices as pokemon names, and the rest the values that smogon has (which will become tables
-        # of their own)
-        data = DataFrame.from_dict(json["data"], orient="index")
-        data.index = (
-            data.index.str.lower().str.replace(" ", "-").str.replace(r"\.|\'", "")
-        )
-        # This here is how i figure out which pokemon arent in pokeapi, but are in smogon.
-        merged = data.merge(pokemon, how="inner", left_index=True, right_index=True)
-        merged.reset_index(inplace=True)
-        merged = merged.rename(columns={"index": "name", 1: "id"})
-        # This adds to `pokemon_stats`
-        stats_df = DataFrame(
-            columns=["pokemon_info_id", "metagame_id", "raw_count"],
-        )
-        stats_df["pokemon_info_id"] = merged["id"]
-        stats_df["metagame_id"] = meta_idx
-        stats_df["raw_count"] = merged["Raw count"]
-        # getting outliers
-        if len(stats_df.index) != len(data.index):
-            not_in = data.merge(
-                pokemon, how="left", left_index=True, right_index=True, indicator=True
-            )
-            not_in = not_in.loc[not_in["_merge"] == "left_only"]
-            pkmn_outliers.update(not_in.index.to_list())
-        # this shift allows us to figure out the id's of the stats (necessary for everything else)
-        stats_idx_shift = (
-            len(dataframes["pokemon_stats"].index) + shift["pokemon_stats"]
-        )
-        dataframes["pokemon_stats"] = pd.concat(
-            [dataframes["pokemon_stats"], stats_df], ignore_index=True
-        )
-        # adding to `move_stats`
-        moves_data = DataFrame(merged["Moves"])
-        moves_data.index += stats_idx_shift
-        moves_data.reset_index(names="stats_id", inplace=True)
-        # FANCY PIVOTING TO GET JSON
-        moves_data = await extract_json(
-            moves_data,
-            "Moves",
-            "name",
-            "move_usage",
-            "stats_id",
-        )
-        # FANCY PIVOTING TO GET JSON
-        moves_df = moves_data.merge(moves, left_on="name", right_index=True)
-        moves_df.drop(columns=["name"], inplace=True)
-        moves_df.rename(columns={1: "move_id"}, inplace=True)
-        moves_df.reset_index(drop=True, inplace=True)
-        # getting move outliers (there are some).
-        if len(moves_df.index) != len(moves_data.index):
-            not_in = moves_data.merge(
-                moves, how="left", left_on="name", right_index=True, indicator=True
-            )
-            not_in = not_in.loc[not_in["_merge"] == "left_only"]
-            move_outliers.update(not_in["name"].to_list())
-        dataframes["move_stats"] = pd.concat(
-            [dataframes["move_stats"], moves_df], ignore_index=True
+    url, month, path, spooled, failed = item
+    if failed is not None:
+        return None, failed, {}
+    loop = asyncio.get_running_loop()
+    try:
+        tables, outliers = await loop.run_in_executor(
+            pool, smogon.transform_file, path, month
         )
+    except Exception as e:
+        print(f"failed to import {url}: {e!r}")
+        return None, ManifestRow(url, month, status="failed", error=repr(e)), {}
+    finally:
+        if spooled:
+            os.remove(path)
+    etag, size = source.stat(url)
+    counts = {} if tables is None else {t: columns_len(c) for t, c in tables.items()}
+    return tables, ManifestRow(url, month, etag, size, "done", counts), outliers
 
 
-async def main():
+async def assign_ids(
+    conn: Connection, files: List[Dict[str, Dict[str, Tuple]]]
+) -> Dict[str, Dict[str, Tuple]]:
+    """Reserves real ids for the `metagame_info` and `pokemon_stats` rows of a
+    batch of files (see `smogon.transform`) from their sequences, and concatenates
+    each table across the batch with those ids (and the `month` of the tables that
+    have one, see `utils.migrate`) filled in. The tables stay packed (see `utils.table.to_columns`) the
+    whole way. `move_stats.movedata_id` is left for the database to fill in on insert.
     """
-    The main function basically handles the "asynchronous" aspect of the program, as to
-    make it run significantly faster.
-    """
-    smogon_url = "https://www.smogon.com/stats/"
-    # gets all the folders that are within the main `stats` page.
-    folders = await get_links(smogon_url)
-    data_files = []
+    n_stats = sum(columns_len(f["pokemon_stats"]) for f in files)
+    meta_ids = await reserve_ids(conn, "metagame_info", "metagame_id", len(files))
+    stats_ids = await reserve_ids(conn, "pokemon_stats", "stats_id", n_stats)
+    tables: Dict[str, List[Dict[str, Tuple]]] = {t: [] for t in TABLE_NAMES}
+    offset = 0
+    for f, meta_id in zip(files, meta_ids):
+        ids = stats_ids[offset : offset + columns_len(f["pokemon_stats"])]
+        offset += len(ids)
+        month = unpack_column(f["metagame_info"]["month"])[0]
+        for table, cols in f.items():
+            n = columns_len(cols)
+            if n == 0:
+                continue
+            cols = dict(cols)
+            if table in ("metagame_info", "pokemon_stats"):
+                cols["metagame_id"] = ("array", np.full(n, meta_id), np.dtype(np.int64))
+            if table != "metagame_info":
+                # the file-local stats ids are positions into the reserved ones.
+                local = np.asarray(unpack_column(cols["stats_id"]))
+                cols["stats_id"] = ("array", ids[local], ids.dtype)
+            # the partitioned tables (and the ones referencing them) get their
+            # file's month.
+            if table in migrate.PARTITIONED or table in migrate.MONTH_REFERENCES:
+                months = np.array([month], dtype=object)
+                cols["month"] = ("codes", np.zeros(n, np.int32), months)
+            tables[table].append(cols)
+    return {t: concat_columns(parts) for t, parts in tables.items()}
 
-    # everything within the "with" here is just to gather the `move_info` and `pokemon_info`
-    # tables into dataframes that we use later in the program.
-    conn = await connect()
-    pkmn_res = await conn.fetch(
-        f"SELECT name, pokemon_info_id FROM pokemon_info"
-    )
-    move_res = await conn.fetch(f"SELECT name, move_id FROM move_info")
-    # defining the moves and pokemon dataframes correctly; after we get their info from the db.
-    pokemon, moves = DataFrame(pkmn_res), DataFrame(move_res)
-    pokemon.index, moves.index = pokemon[0], moves[0]
-    pokemon, moves = pokemon.drop(columns=[0]), moves.drop(columns=[0])
-    # for move processing we have to remove the `-`.
-    moves.index = moves.index.str.replace("-", "")
-    conn.close()
-
-    # an async taskgroup that gathers all of the json files that we need. `data_files`
-    # is populated after this is run (in the form [[url, month], ...]).
+
+def folder_month(folder: str) -> datetime.date:
+    """Gets the month a stats folder url (`.../2023-01/`) is for."""
+    split_url = folder.split("/")
+    split_val = split_url[len(split_url) - 2].split("-")
+    return datetime.date(int(split_val[0]), int(split_val[1]), 1)
+
+
+async def get_data_files(folders: List[str]) -> List:
+    """Lists the data files in every month folder, in the form [[url, month], ...]."""
+    data_files = []
     async with asyncio.TaskGroup() as tg:
         for folder in folders:
             data_url = f"{folder}chaos/"
-            split_url = folder.split("/")
-            split_val = split_url[len(split_url) - 2].split("-")
-            month = datetime.date(int(split_val[0]), int(split_val[1]), 1)
-            tg.create_task(add_data_files(data_url, month, data_files))
-    # this is for handling async groups (does 100 json files async at once rn)
-    offset, inc = 0, 100
-    # Shift vals is for setting indices - while id names is the name of the indices in
-    # the database.
-    table_names = [
-        "metagame_info",
-        "pokemon_stats",
-        "move_stats",
-        # "nature_stats"
+            tg.create_task(add_data_files(data_url, folder_month(folder), data_files))
+    return data_files
+
+
+async def get_missing_files(root: str) -> List:
+    """Finds just the data files whose (month, metagame, cutoff) isn't in
+    `metagame_info` yet. Months older than the newest one we have are assumed to be
+    complete, so only new months (and the newest one, in case smogon added to it)
+    have their folders listed at all.
+    """
+    async with db.acquire() as conn:
+        records = await conn.fetch(
+            """SELECT DISTINCT month, metagame_name, cutoff FROM metagame_info;"""
+        )
+    have = {(r["month"], r["metagame_name"], int(r["cutoff"])) for r in records}
+    months = {m for m, _, _ in have}
+    latest = max(months) if len(months) != 0 else None
+    folders = [
+        f
+        for f in await get_links(root, MONTH_FOLDER)
+        if latest is None or folder_month(f) >= latest or folder_month(f) not in months
     ]
-    shift_vals = {}
-    for t in table_names:
-        shift_vals[t] = 1
-    id_name = {
-        "metagame_info": "metagame_id",
-        "pokemon_stats": "stats_id",
-        "move_stats": "movedata_id",
-        # "nature_stats": None,
-    }
-    # this is for just printing how long each batch takes and estimating remaining time.
-    times = []
+    data_files = []
+    for url, month in await get_data_files(folders):
+        # data files are named `<metagame>-<cutoff>.json`.
+        metagame, cutoff = url.rsplit("/", 1)[1].removesuffix(".json").rsplit("-", 1)
+        if (month, metagame, int(cutoff)) not in have:
+            data_files.append([url, month])
+    return data_files
+
+
+async def load_files(inbox: asyncio.Queue, total: int):
+    """The load stage: writes parsed files to the database in batches. Every batch
+    and its manifest rows commit together (or not at all), so a crash never leaves
+    a file half imported.
+
+    Args:
+        inbox (asyncio.Queue): The queue of `parse_file` results.
+        total (int): How many files there are in all, for the progress estimate.
+
+    Returns:
+        Set[datetime.date]: The months that had files imported.
+    """
+    start = time.perf_counter()
+    loaded = 0
+    months = set()
     n_pkmn_outliers = 0
     n_move_outliers = 0
-    # THE MAIN LOOP; GOES THROUGH ALL DATA FILES.
-    while offset < len(data_files):
-        end = min(offset + inc, len(data_files))
-        chunk = data_files[offset:end]
-        t = time.perf_counter()
-        # This taskgroup creates tasks for every batch of `inc` (currently 100) json files.
-        # The `async with ...` syntax prevents any further code from computing until all the
-        # files have been processed.
-        data_dict: Dict[str, DataFrame] = {}
-        # Creating empty table dicts of which we compress into defined tables later on.
-        for tb in table_names:
-            data_dict[tb] = DataFrame()
-        async with asyncio.TaskGroup() as tg:
-            for info in chunk:
-                tg.create_task(
-                    get_smogon_data(
-                        info[0], info[1], pokemon, moves, shift_vals, data_dict
-                    )
-                )
-        for k in data_dict.keys():
-            # Shifting indices, changing the index to be the actual amount of processed data.
-            df = data_dict[k]
-            df.index += shift_vals[k]
-            if id_name[k] != None:
-                shift_vals[k] += len(df.index)
-                df.reset_index(names=id_name[k], inplace=True)
-            # We store in batches after EVERYTHING is done for the 100 json files.
-            await append_df(k, df)
+    n_ability_outliers = 0
+    n_spread_outliers = 0
+    async for batch in batches(inbox, BATCH_SIZE):
+        files = [tables for tables, _, _ in batch if tables is not None]
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                if len(files) != 0:
+                    data_dict = await assign_ids(conn, files)
+                    for k in TABLE_NAMES:
+                        if columns_len(data_dict[k]) != 0:
+                            await append_columns(k, data_dict[k], conn)
+                await record(conn, [row for _, row, _ in batch])
+        months.update(row.month for _, row, _ in batch if row.status == "done")
+        for _, _, outliers in batch:
+            pkmn_outliers.update(outliers.get("pokemon", ()))
+            move_outliers.update(outliers.get("moves", ()))
+            ability_outliers.update(outliers.get("abilities", ()))
+            spread_outliers.update(outliers.get("spreads", ()))
         if len(pkmn_outliers) != n_pkmn_outliers:
             print(f"{len(pkmn_outliers)} problem children seen so far.")
             n_pkmn_outliers = len(pkmn_outliers)
         if len(move_outliers) != n_move_outliers:
             print(f"{len(move_outliers)} problem moves seen so far.")
             n_move_outliers = len(move_outliers)
+        if len(ability_outliers) != n_ability_outliers:
+            print(f"{len(ability_outliers)} problem abilities seen so far.")
+            n_ability_outliers = len(ability_outliers)
+        if len(spread_outliers) != n_spread_outliers:
+            print(f"{len(spread_outliers)} problem spreads seen so far.")
+            n_spread_outliers = len(spread_outliers)
         # This just prints out to the console how long things took/look like they'll take to do.
-        times.append(time.perf_counter() - t)
-        est = (np.mean(times) * (len(data_files) / inc)) - sum(times)
+        loaded += len(batch)
+        elapsed = time.perf_counter() - start
+        est = elapsed / loaded * (total - loaded)
         fmt_est = time.strftime("%M:%S", time.gmtime(est))
-        print(
-            f"Managed {end}/{len(data_files)} json files in {times[len(times)-1]:06.3f}s (~{fmt_est}m remaining)"
+        print(f"Managed {loaded}/{total} json files (~{fmt_est}m remaining)")
+    return months
+
+
+async def main(root: str = SMOGON_URL, sync: bool = False):
+    """
+    The main function basically handles the "asynchronous" aspect of the program, as to
+    make it run significantly faster.
+
+    Args:
+        root (str, optional): The stats page to import from; either smogon's or a fixture
+        server's. Defaults to SMOGON_URL.
+        sync (bool, optional): Whether to only import the months and cutoffs that aren't in
+        the database yet. Defaults to False.
+    """
+    # everything here is just to gather the `move_info`, `pokemon_info` and
+    # `ability_info` tables into lookups that we use later in the program.
+    # pokemon and moves are matched through the alias tables (built on first use).
+    async with db.acquire() as conn:
+        pokemon = await alias.pokemon_lookup(conn)
+        moves = await alias.move_lookup(conn)
+        ability_cols = await cursor.fetch_columns(
+            conn, "SELECT name, ability_info_id FROM ability_info"
         )
-        # Setting the offset
-        offset += inc
+    # for ability processing we have to remove the `-`.
+    abilities = Lookup(
+        ability_cols["name"],
+        ability_cols["ability_info_id"],
+        normalize=smogon.strip_dashes,
+    )
+
+    # gathers all of the json files that we need (in the form [[url, month], ...]).
+    if sync:
+        data_files = await get_missing_files(root)
+    else:
+        # gets all the folders that are within the main `stats` page.
+        folders = await get_links(root, MONTH_FOLDER)
+        data_files = await get_data_files(folders)
+    # ids come from sequences in the database, so batches (or whole separate runs)
+    # can never hand out the same one twice.
+    async with db.acquire() as conn:
+        await ensure_sequence(conn, "metagame_info", "metagame_id")
+        await ensure_sequence(conn, "pokemon_stats", "stats_id")
+        await ensure_sequence(conn, "move_stats", "movedata_id")
+        # skipping every file a previous run already imported.
+        await ensure_manifest(conn)
+        # the eda reads from summary tables, which are kept up to date as we go.
+        await rollup.ensure_rollups(conn)
+        done = await done_urls(conn)
+    data_files = [f for f in data_files if f[0] not in done]
+    print(f"{len(done)} files already imported, {len(data_files)} to go.")
+    async with db.acquire() as conn:
+        # `month` is filled in on pokemon_stats and move_stats so they can be
+        # partitioned by it, and on the tables referencing them (see utils/migrate.py).
+        await migrate.ensure_month_columns(conn)
+        await migrate.ensure_partitions(conn, {month for _, month in data_files})
+        bulk = len(data_files) >= BULK_FILES
+        if bulk:
+            await migrate.drop_indexes(conn)
+    # the import is a pipeline: downloads, parses (one process per core) and
+    # database writes all happen at once, with bounded queues in between so no
+    # stage can run too far ahead of the next one.
+    t = time.perf_counter()
+    files, downloads, parsed = (
+        asyncio.Queue(),
+        asyncio.Queue(2 * PARSERS),
+        asyncio.Queue(2 * BATCH_SIZE),
+    )
+    # spawning (rather than forking) the workers, since the ssh tunnel runs in threads.
+    # downloads are spooled to disk until they're parsed; whatever's left of them if
+    # the import fails goes with the directory.
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            PARSERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=smogon.init_worker,
+            initargs=(pokemon, moves, abilities),
+        ) as pool, tempfile.TemporaryDirectory(prefix="smogon-") as spool_dir:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(feed(data_files, files))
+                tg.create_task(
+                    stage(
+                        functools.partial(fetch_file, spool_dir), files, downloads, FETCHERS
+                    )
+                )
+                tg.create_task(
+                    stage(functools.partial(parse_file, pool), downloads, parsed, PARSERS)
+                )
+                loaded = tg.create_task(load_files(parsed, len(data_files)))
+    finally:
+        # the indexes come back even if the load failed part way, since the
+        # batches before that are already in.
+        if bulk:
+            async with db.acquire() as conn:
+                await migrate.create_indexes(conn)
     # Printing how long everything took.
-    total_time = time.strftime("%M:%S", time.gmtime(sum(times)))
+    total_time = time.strftime("%M:%S", time.gmtime(time.perf_counter() - t))
     print(f"Parsed all files in {total_time}m")
+    # only the months we just imported are recomputed.
+    async with db.acquire() as conn:
+        await rollup.refresh(conn, loaded.result())
     print(pkmn_outliers)  # debugging problem children.
     print(move_outliers)
+    print(ability_outliers)
+    print(spread_outliers)
+
 
+async def run(args: argparse.Namespace):
+    # every request in the import shares one cached, keep-alive session,
+    # and every batch borrows its connection from one pool.
+    root = args.root if args.root.endswith("/") else f"{args.root}/"
+    async with http.session(), db.pool():
+        await main(root, sync=args.command == "sync")
 
-# Required for asyncio to work.
-asyncio.run(main())
+
+# the guard keeps the parse workers (which re-import this file) from running the import.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports smogon's usage stats.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["full", "sync"],
+        default="full",
+        help="`full` walks every data file; `sync` only imports months/cutoffs we don't have yet",
+    )
+    parser.add_argument(
+        "--root",
+        default=SMOGON_URL,
+        help="the stats page to import from, e.g. a local fixture server",
+    )
+    source.add_arguments(parser)
+    db.add_arguments(parser)
+    args = parser.parse_args()
+    db.configure_from_args(args)
+    source.configure_from_args(args)
+    # Required for asyncio to work.
+    asyncio.run(run(args))
@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+import sys
+import utils.db_connect as db
+import utils.migrate as migrate
+
+"""
+Brings the database's indexes and partitioning up to date (see `utils/migrate.py`),
+and checks that the planner uses them. Run it once after the first full import;
+`check` can be run any time after that, e.g. after changing a query.
+"""
+
+
+async def main(command: str) -> int:
+    async with db.pool():
+        async with db.acquire() as conn:
+            if command == "apply":
+                await migrate.migrate(conn)
+            failures = await migrate.check_plans(conn)
+    for failure in failures:
+        print(failure)
+    print(f"{len(migrate.CHECKS) - len(failures)}/{len(migrate.CHECKS)} plan checks passed.")
+    return 1 if len(failures) != 0 else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Applies and checks the schema migration.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["apply", "check"],
+        default="apply",
+        help="`apply` migrates and then checks; `check` only checks the query plans",
+    )
+    db.add_arguments(parser)
+    args = parser.parse_args()
+    db.configure_from_args(args)
+    sys.exit(asyncio.run(main(args.command)))
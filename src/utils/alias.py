@@ -0,0 +1,172 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+import pandas as pd
+from asyncpg.connection import Connection
+from pandas import DataFrame
+import utils.cursor as cursor
+import utils.pgcopy as pgcopy
+from utils.lookup import Lookup
+
+"""
+The alias tables: every name a pokemon or move goes by, as a canonical slug, mapped
+to its id. Smogon calls a pokemon "Great Tusk" or "Meowstic-F", pokeapi calls it
+"great-tusk" or "meowstic-female", and both come down to the same slug. The tables
+are built once from `pokemon_info`/`move_info` and stored in the database, so every
+importer matches names with the same rules, through a single hash lookup.
+"""
+
+# Anything that isn't a letter or a digit is dropped from a slug.
+_NOT_SLUG = r"[^a-z0-9]"
+# gendered pokemon (pokeapi's "meowstic-male", "nidoran-f") -> smogon's "-m"/"-f".
+_GENDERS = {"male": "m", "m": "m", "female": "f", "f": "f"}
+# the words a form's name adds onto its pokemon's ("charizard-mega-x", "raticate-alola").
+_REGIONS = {"alola", "galar", "hisui", "paldea"}
+_FORMS = {"mega", "x", "y", "primal", "gmax", "totem", "power", "construct", *_REGIONS}
+
+TABLES = {
+    # table -> (the table it aliases, its id column)
+    "pokemon_alias": ("pokemon_info", "pokemon_info_id"),
+    "move_alias": ("move_info", "move_id"),
+}
+
+
+def slug(name: str) -> str:
+    """"Mr. Mime", "mr-mime" and "Mr Mime" all become "mrmime"."""
+    return re.sub(_NOT_SLUG, "", name.lower())
+
+
+def slugs(names: Iterable) -> pd.Index:
+    """`slug`, for a whole column of names at once."""
+    return pd.Index(names, dtype=object).str.lower().str.replace(
+        _NOT_SLUG, "", regex=True
+    )
+
+
+def _species(rows: List[Tuple[int, str, bool, int]]) -> Set[str]:
+    # the names of the species that have several forms: what every form with the
+    # same dex number starts with ("basculin" for "basculin-red-striped" and
+    # "basculin-blue-striped", but "mr-mime" for "mr-mime" and "mr-mime-galar").
+    forms = defaultdict(list)
+    for _, name, _, dex_no in rows:
+        forms[dex_no].append(name.split("-"))
+    species = set()
+    for names in forms.values():
+        if len(names) < 2:
+            continue
+        common = []
+        for words in zip(*names):
+            if len(set(words)) != 1:
+                break
+            common.append(words[0])
+        if len(common) != 0:
+            species.add("-".join(common))
+    return species
+
+
+def _variants(name: str, species: Set[str]) -> List[str]:
+    # the other names a pokemon might go by besides its own.
+    parts = name.split("-")
+    out = []
+    if len(parts) > 1 and parts[-1] in _GENDERS:
+        gender = _GENDERS[parts[-1]]
+        out.append("-".join(parts[:-1]) + gender)
+        # the male form is the one smogon leaves unmarked.
+        if gender == "m":
+            out.append("-".join(parts[:-1]))
+    if "totem" in parts:
+        # "raticate-totem-alola" is "raticate-alola-totem" elsewhere.
+        out.append("-".join([p for p in parts if p != "totem"] + ["totem"]))
+    # forms by their base name: "basculin-red-striped" is just "basculin", and
+    # "zygarde-10-power-construct" can be "zygarde-10" too. only a species, or what's
+    # left without the form words, counts; "mr-mime" isn't "mr", nor "ho-oh" "ho".
+    for i in range(1, len(parts)):
+        base = "-".join(parts[:i])
+        if base in species or all(p in _FORMS for p in parts[i:]):
+            out.append(base)
+    return out
+
+
+def pokemon_aliases(rows: Iterable[Tuple[int, str, bool, int]]) -> Dict[str, int]:
+    """Works out every alias of every pokemon.
+
+    A pokemon's own name always wins. Otherwise an alias belongs to the only
+    pokemon that goes by it, or if several do, the only one of those that is the
+    primary form (so "urshifu" is the single strike form). Aliases that still
+    can't be told apart are left out. A form goes by its base name only when
+    that's its species' name (the part every form with its dex number shares) or
+    the rest of its name is just form words, like "mega" or "alola".
+
+    Args:
+        rows (Iterable[Tuple[int, str, bool, int]]): The `(pokemon_info_id, name,
+        is_primary, dex_no)` of every pokemon.
+
+    Returns:
+        Dict[str, int]: The slug -> `pokemon_info_id` of every alias.
+    """
+    rows = list(rows)
+    species = _species(rows)
+    aliases, candidates = {}, defaultdict(set)
+    primary = {}
+    for id, name, is_primary, _ in rows:
+        aliases[slug(name)] = id
+        primary[id] = bool(is_primary)
+        for variant in _variants(name, species):
+            candidates[slug(variant)].add(id)
+    for alias, ids in candidates.items():
+        if alias in aliases:
+            continue
+        if len(ids) > 1:
+            ids = {id for id in ids if primary[id]}
+        if len(ids) == 1:
+            aliases[alias] = ids.pop()
+    return aliases
+
+
+async def ensure_aliases(conn: Connection, rebuild: bool = False):
+    """Creates the alias tables if they don't exist yet, and fills them if they're
+    empty (or `rebuild` is set, e.g. after `pokemon_info` has changed).
+    """
+    async with conn.transaction():
+        # only one importer at a time gets to build them.
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('alias'))")
+        for table, (_, id_col) in TABLES.items():
+            await conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {table} (
+                       alias text PRIMARY KEY,
+                       {id_col} integer NOT NULL
+                   );"""
+            )
+        empty = not await conn.fetchval("SELECT EXISTS (SELECT FROM pokemon_alias);")
+        if not (rebuild or empty):
+            return
+        records = await conn.fetch(
+            """SELECT pokemon_info_id, name, is_primary, dex_no FROM pokemon_info;"""
+        )
+        pokemon = pokemon_aliases(tuple(r) for r in records)
+        records = await conn.fetch("""SELECT move_id, name FROM move_info;""")
+        moves = {slug(r["name"]): r["move_id"] for r in records}
+        for table, aliases in [("pokemon_alias", pokemon), ("move_alias", moves)]:
+            id_col = TABLES[table][1]
+            df = DataFrame({"alias": list(aliases), id_col: list(aliases.values())})
+            await conn.execute(f"TRUNCATE {table};")
+            await pgcopy.copy_frame(conn, table, df)
+
+
+async def _lookup(conn: Connection, table: str) -> Lookup:
+    await ensure_aliases(conn)
+    id_col = TABLES[table][1]
+    cols = await cursor.fetch_columns(conn, f"SELECT alias, {id_col} FROM {table};")
+    return Lookup(cols["alias"], cols[id_col])
+
+
+async def pokemon_lookup(conn: Connection) -> Lookup:
+    """The slug -> `pokemon_info_id` lookup. Its keys are slugs already, so names
+    have to go through `slug`/`slugs` before they're looked up.
+    """
+    return await _lookup(conn, "pokemon_alias")
+
+
+async def move_lookup(conn: Connection) -> Lookup:
+    """The slug -> `move_id` lookup (see `pokemon_lookup`)."""
+    return await _lookup(conn, "move_alias")
@@ -0,0 +1,204 @@
+import hashlib
+import os
+import sqlite3
+import time
+from typing import NamedTuple
+
+# Where the cache lives, relative to the directory the scripts are run from.
+CACHE_DIR = "./.http_cache"
+# How long a cached response is used without asking the server about it.
+TTL = 60 * 60 * 24 * 30
+# Once the cached bodies grow past this many bytes, the least recently used go.
+MAX_SIZE = 4 * 1024**3
+
+
+class Entry(NamedTuple):
+    url: str
+    digest: str
+    etag: str
+    last_modified: str
+    fetched_at: float
+    size: int
+
+
+class Cache:
+    """An on-disk http response cache. Bodies are stored content-addressed
+    (sharded by the first two characters of their sha256) so urls that return
+    the same body share a file, and a small sqlite index maps every url to its
+    body along with the validators needed for a conditional GET.
+    """
+
+    def __init__(self, path: str = CACHE_DIR, ttl: float = TTL, max_size: int = MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed_at)"
+        )
+        self.db.commit()
+
+    def _body_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def lookup(self, url: str) -> Entry:
+        """Returns the cache entry for a url, or None if it isn't cached."""
+        row = self.db.execute(
+            """SELECT url, digest, etag, last_modified, fetched_at, size
+               FROM entries WHERE url = ?""",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = Entry(*row)
+        if not os.path.exists(self._body_path(entry.digest)):
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self.db.commit()
+            return None
+        return entry
+
+    def is_fresh(self, entry: Entry) -> bool:
+        """Whether an entry is young enough to be used without revalidating."""
+        return time.time() - entry.fetched_at < self.ttl
+
+    def open(self, entry: Entry):
+        """Opens the body of an entry as a binary file, marking it as recently used."""
+        self.db.execute(
+            "UPDATE entries SET accessed_at = ? WHERE url = ?",
+            (time.time(), entry.url),
+        )
+        self.db.commit()
+        return open(self._body_path(entry.digest), "rb")
+
+    def read(self, entry: Entry) -> bytes:
+        """Reads the body of an entry, marking it as recently used."""
+        with self.open(entry) as f:
+            return f.read()
+
+    def store(self, url: str, body: bytes, etag: str = None, last_modified: str = None):
+        """Stores a body for a url, then evicts old entries if we're over size."""
+        writer = self.writer(url, etag, last_modified)
+        writer.write(body)
+        writer.commit()
+
+    def writer(self, url: str, etag: str = None, last_modified: str = None):
+        """Returns a `BodyWriter` for storing a body a chunk at a time, for
+        responses too big to hold in memory.
+        """
+        return BodyWriter(self, url, etag, last_modified)
+
+    def _commit(
+        self, url: str, tmp: str, digest: str, size: int, etag: str, last_modified: str
+    ):
+        path = self._body_path(digest)
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        old = self.lookup(url)
+        now = time.time()
+        self.db.execute(
+            """INSERT OR REPLACE INTO entries
+               (url, digest, etag, last_modified, fetched_at, accessed_at, size)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (url, digest, etag, last_modified, now, now, size),
+        )
+        self.db.commit()
+        if old is not None and old.digest != digest:
+            self._drop_body(old.digest)
+        self.evict()
+
+    def touch(self, url: str):
+        """Marks an entry as fresh again after the server answered 304."""
+        now = time.time()
+        self.db.execute(
+            "UPDATE entries SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+            (now, now, url),
+        )
+        self.db.commit()
+
+    def _drop_body(self, digest: str):
+        # bodies are shared between urls, so only delete once nothing points at it.
+        (refs,) = self.db.execute(
+            "SELECT count(*) FROM entries WHERE digest = ?", (digest,)
+        ).fetchone()
+        if refs == 0:
+            try:
+                os.remove(self._body_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """Drops the least recently used entries until we're under `max_size`."""
+        (total,) = self.db.execute(
+            "SELECT coalesce(sum(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self.max_size:
+            return
+        rows = self.db.execute(
+            "SELECT url, digest, size FROM entries ORDER BY accessed_at"
+        ).fetchall()
+        for url, digest, size in rows:
+            if total <= self.max_size:
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._drop_body(digest)
+            total -= size
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class BodyWriter:
+    """Streams a body into the cache. Chunks go to a temp file (so a crash never
+    leaves half a body behind) and are hashed as they come in; `commit` moves the
+    file to its content-addressed path and indexes it.
+    """
+
+    def __init__(self, cache: Cache, url: str, etag: str, last_modified: str):
+        self.cache = cache
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.tmp = os.path.join(cache.path, f"{os.getpid()}.{id(self)}.tmp")
+        self.file = open(self.tmp, "wb")
+
+    def write(self, chunk: bytes):
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(
+            self.url,
+            self.tmp,
+            self.hash.hexdigest(),
+            self.size,
+            self.etag,
+            self.last_modified,
+        )
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,160 @@
+import codecs
+import json
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, Union
+import utils.source as source
+
+# The parts of each pokemon's entry that we import. Everything else (checks and
+# counters, happiness, viability ceiling...) is dropped as soon as it's parsed.
+RECORD_KEYS = ("Raw count", "Moves", "Abilities", "Items", "Spreads", "Teammates")
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class ChaosParser:
+    """An incremental parser for Smogon's chaos json files, which look like
+    `{"info": {...}, "data": {"Pokemon": {...}, ...}}`. Feed it the file a chunk
+    at a time and it hands back events as soon as they're complete:
+
+    - `("info", info)` for the `info` object.
+    - `("pokemon", name, record)` for every entry of `data`, with only `RECORD_KEYS` kept.
+
+    Only the entry currently being parsed is ever held in memory, so peak memory
+    depends on the biggest single pokemon, not on the size of the file.
+    """
+
+    def __init__(self, keys: Iterable[str] = RECORD_KEYS):
+        self.keys = tuple(keys)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        # where we are in the file: "start", "key", "value", "data" or "done".
+        self._state = "start"
+        self._key: str = None
+        # after a failed decode we wait for the buffer to grow before trying again,
+        # so a huge entry isn't re-parsed from the start for every chunk.
+        self._retry_at = 0
+
+    def feed(self, chunk: bytes) -> List[Tuple]:
+        """Parses a chunk of the file, returning every event it completed."""
+        self._buf = self._buf[self._pos :] + self._utf8.decode(chunk)
+        self._retry_at -= self._pos
+        self._pos = 0
+        return self._parse(final=False)
+
+    def close(self) -> List[Tuple]:
+        """Finishes parsing, raising if the file ended early."""
+        self._buf = self._buf[self._pos :] + self._utf8.decode(b"", final=True)
+        self._pos, self._retry_at = 0, 0
+        events = self._parse(final=True)
+        if self._state != "done":
+            raise ValueError("chaos json ended unexpectedly")
+        return events
+
+    def _skip(self, chars: str = _WHITESPACE):
+        buf, pos = self._buf, self._pos
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        self._pos = pos
+
+    def _decode(self, final: bool):
+        # decodes the next json value, or returns (None, False) if it isn't all here yet.
+        if not final and len(self._buf) < self._retry_at:
+            return None, False
+        try:
+            val, end = _decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            self._retry_at = len(self._buf) + max(len(self._buf) - self._pos, 1)
+            return None, False
+        # a number (or anything) right at the end of the buffer may continue in
+        # the next chunk, so we only trust it once something follows it.
+        if end == len(self._buf) and not final:
+            return None, False
+        self._pos, self._retry_at = end, 0
+        return val, True
+
+    def _parse(self, final: bool) -> List[Tuple]:
+        events = []
+        while True:
+            self._skip()
+            if self._pos >= len(self._buf):
+                return events
+            char = self._buf[self._pos]
+            if self._state == "start":
+                if char != "{":
+                    raise ValueError(f"expected '{{' at the start of the file, got {char!r}")
+                self._pos += 1
+                self._state = "key"
+            elif self._state in ("key", "data"):
+                if char == ",":
+                    self._pos += 1
+                    continue
+                if char == "}":
+                    self._pos += 1
+                    self._state = "key" if self._state == "data" else "done"
+                    continue
+                start = self._pos
+                key, ok = self._decode(final)
+                if not ok:
+                    return events
+                self._skip()
+                if self._pos >= len(self._buf):
+                    # the colon isn't here yet; back up and wait for it.
+                    self._pos = start
+                    return events
+                if self._buf[self._pos] != ":":
+                    raise ValueError(f"expected ':' after {key!r}")
+                self._pos += 1
+                if self._state == "data":
+                    self._skip()
+                    if self._pos >= len(self._buf):
+                        self._pos = start
+                        return events
+                    record, ok = self._decode(final)
+                    if not ok:
+                        self._pos = start
+                        return events
+                    record = {k: record[k] for k in self.keys if k in record}
+                    events.append(("pokemon", key, record))
+                else:
+                    self._key = key
+                    self._state = "value"
+            elif self._state == "value":
+                if self._key == "data":
+                    if char != "{":
+                        raise ValueError("expected 'data' to be an object")
+                    self._pos += 1
+                    self._state = "data"
+                    continue
+                val, ok = self._decode(final)
+                if not ok:
+                    return events
+                if self._key == "info":
+                    events.append(("info", val))
+                self._state = "key"
+            else:
+                raise ValueError("unexpected data after the end of the chaos json")
+
+
+def parse_chaos(
+    body: Union[bytes, BinaryIO],
+    keys: Iterable[str] = RECORD_KEYS,
+    chunk_size: int = source.CHUNK_SIZE,
+) -> Iterator[Tuple]:
+    """Parses a chaos json file, yielding its events (see `ChaosParser` for what
+    they look like). `body` is either the file in memory or an open binary file;
+    either way it's fed to the parser a chunk at a time, so only one pokemon's
+    entry (not the whole file's worth of dicts) is ever parsed at once, and a file
+    is never read into memory whole.
+    """
+    parser = ChaosParser(keys)
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        view = memoryview(body)
+        chunks = (view[i : i + chunk_size] for i in range(0, len(view), chunk_size))
+    else:
+        chunks = iter(lambda: body.read(chunk_size), b"")
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
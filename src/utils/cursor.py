@@ -0,0 +1,111 @@
+from typing import AsyncIterator, Dict, List, Union
+import numpy as np
+import pandas as pd
+from asyncpg.connection import Connection
+from asyncpg.prepared_stmt import PreparedStatement
+from pandas import DataFrame
+
+"""
+Reading big query results a chunk at a time through a server-side cursor, straight
+into typed numpy columns. `conn.fetch` holds an asyncpg Record (and a python object
+per value) for every row before anything can be done with them; here only one
+chunk of Records is alive at a time, and what's kept is a few numpy arrays.
+"""
+
+# Rows fetched from the cursor at a time.
+CHUNK_ROWS = 50_000
+
+# postgres type -> the numpy type its values are read into.
+_DTYPES = {
+    "int2": np.dtype(np.int64),
+    "int4": np.dtype(np.int64),
+    "int8": np.dtype(np.int64),
+    "float4": np.dtype(np.float64),
+    "float8": np.dtype(np.float64),
+    "bool": np.dtype(bool),
+}
+
+
+def _dtype(attr) -> np.dtype:
+    return _DTYPES.get(attr.type.name, np.dtype(object))
+
+
+def _column(values: np.ndarray, dtype: np.dtype):
+    # `values` is an object array; NULLs stay None until we know what to make of them.
+    if dtype.kind == "f":
+        # None becomes NaN.
+        return values.astype(dtype)
+    if dtype.kind in "ib":
+        nulls = pd.isna(values)
+        if not nulls.any():
+            return values.astype(dtype)
+        return pd.array(values, dtype="Int64" if dtype.kind == "i" else "boolean")
+    return values
+
+
+def _concat(chunks: List):
+    if len(chunks) == 1:
+        return chunks[0]
+    if all(isinstance(c, np.ndarray) for c in chunks):
+        return np.concatenate(chunks)
+    # some chunks had NULLs in them (and came back as nullable pandas arrays).
+    return pd.concat([pd.Series(c) for c in chunks], ignore_index=True).array
+
+
+async def stream_columns(
+    conn: Connection,
+    query: Union[str, PreparedStatement],
+    *args,
+    chunk_rows: int = CHUNK_ROWS,
+) -> AsyncIterator[Dict[str, np.ndarray]]:
+    """Runs a query through a server-side cursor, yielding its rows as columns a
+    chunk at a time. Numbers and booleans come back as typed numpy arrays (or
+    nullable pandas arrays, for a chunk with NULLs in it); everything else as an
+    object array.
+
+    Args:
+        conn (Connection): The connection to run it on.
+        query (Union[str, PreparedStatement]): The query, or the statement already
+        prepared from it on `conn`.
+        *args: The query's arguments.
+        chunk_rows (int, optional): The most rows in a chunk. Defaults to CHUNK_ROWS.
+
+    Yields:
+        Dict[str, np.ndarray]: Each chunk's columns, by name.
+    """
+    stmt = await conn.prepare(query) if isinstance(query, str) else query
+    attrs = stmt.get_attributes()
+    dtypes = [_dtype(a) for a in attrs]
+    # cursors only live as long as the transaction they're in.
+    async with conn.transaction():
+        cursor = await stmt.cursor(*args)
+        while len(rows := await cursor.fetch(chunk_rows)) != 0:
+            chunk = {}
+            for i, (a, dtype) in enumerate(zip(attrs, dtypes)):
+                values = np.fromiter((r[i] for r in rows), dtype=object, count=len(rows))
+                chunk[a.name] = _column(values, dtype)
+            del rows
+            yield chunk
+
+
+async def fetch_columns(
+    conn: Connection, query: str, *args, chunk_rows: int = CHUNK_ROWS
+) -> Dict[str, np.ndarray]:
+    """`stream_columns`, with the chunks joined into whole columns."""
+    chunks: Dict[str, List] = {}
+    # prepared just the once; its attributes still type the columns of an empty result.
+    stmt = await conn.prepare(query)
+    async for chunk in stream_columns(conn, stmt, *args, chunk_rows=chunk_rows):
+        for name, values in chunk.items():
+            chunks.setdefault(name, []).append(values)
+    return {
+        a.name: _concat(chunks[a.name]) if a.name in chunks else np.empty(0, _dtype(a))
+        for a in stmt.get_attributes()
+    }
+
+
+async def fetch_frame(
+    conn: Connection, query: str, *args, chunk_rows: int = CHUNK_ROWS
+) -> DataFrame:
+    """`fetch_columns`, as a DataFrame."""
+    return DataFrame(await fetch_columns(conn, query, *args, chunk_rows=chunk_rows))
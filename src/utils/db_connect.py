@@ -1,33 +1,328 @@
+import argparse
+import atexit
+import os
+from contextlib import asynccontextmanager, contextmanager
+from typing import NamedTuple
 import asyncpg
 from asyncpg.connection import Connection
+from asyncpg.pool import Pool
 from sshtunnel import SSHTunnelForwarder
 
-db_conn_file = open("./db_conn.key")
-db_name = db_conn_file.readline().strip()
-schema = db_conn_file.readline().strip()
-username = db_conn_file.readline().strip()
-password = db_conn_file.readline().strip()
+# Where the database, schema, username and password are read from (one per line).
+KEY_FILE = "./db_conn.key"
 
 
-def tunnel():
-    server = SSHTunnelForwarder(
-        ("starbug.cs.rit.edu", 22),
-        ssh_username=username,
-        ssh_password=password,
-        remote_bind_address=("localhost", 5432),
+class Config(NamedTuple):
+    db_name: str
+    schema: str
+    username: str
+    password: str
+    # where postgres is, as seen from the end of the tunnel (or from here, without one).
+    host: str = "localhost"
+    port: int = 5432
+    # whether we reach the database through an ssh tunnel. Without one we connect
+    # straight to `host:port`, e.g. a local stand-in database for testing.
+    use_tunnel: bool = True
+    ssh_host: str = "starbug.cs.rit.edu"
+    ssh_port: int = 22
+
+
+# Environment variables that override the matching field of the config.
+ENV_VARS = {
+    "DB_NAME": "db_name",
+    "DB_SCHEMA": "schema",
+    "DB_USER": "username",
+    "DB_PASSWORD": "password",
+    "DB_HOST": "host",
+    "DB_PORT": "port",
+    "DB_USE_TUNNEL": "use_tunnel",
+    "DB_SSH_HOST": "ssh_host",
+    "DB_SSH_PORT": "ssh_port",
+}
+
+_config: Config = None
+_overrides: dict = {}
+
+# Defaults for the shared connection pool.
+MIN_SIZE = 2
+MAX_SIZE = 10
+STATEMENT_CACHE_SIZE = 100
+# How long (in seconds) `acquire` waits for a free connection before giving up.
+ACQUIRE_TIMEOUT = 60
+
+_pool: Pool = None
+_pool_server: SSHTunnelForwarder = None
+
+# The tunnel is shared by everything in a process and reference counted, so it's
+# only set up once no matter how many pools/connections/tasks are using it.
+_tunnel: SSHTunnelForwarder = None
+_tunnel_refs = 0
+_tunnel_pid: int = None
+
+
+def _parse(field: str, val: str):
+    if field in ("port", "ssh_port"):
+        return int(val)
+    if field == "use_tunnel":
+        return val.strip().lower() not in ("0", "false", "no", "off", "")
+    return val
+
+
+def configure(**overrides):
+    """Overrides config fields (e.g. from command line arguments). These win over
+    both the key file and the environment. Call before the first connection.
+
+    Example:
+        db.configure(use_tunnel=False, port=5433)
+    """
+    global _config
+    for field in overrides:
+        if field not in Config._fields:
+            raise TypeError(f"unknown config field: {field}")
+    _overrides.update(overrides)
+    _config = None
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Adds `--db-*` options for every config field to a script's argument parser."""
+    group = parser.add_argument_group("database")
+    group.add_argument("--db-name", dest="db_name")
+    group.add_argument("--db-schema", dest="schema")
+    group.add_argument("--db-user", dest="username")
+    group.add_argument("--db-password", dest="password")
+    group.add_argument("--db-host", dest="host")
+    group.add_argument("--db-port", dest="port", type=int)
+    group.add_argument(
+        "--tunnel",
+        dest="use_tunnel",
+        action="store_const",
+        const=True,
+        help="connect through ssh, even if DB_USE_TUNNEL turned it off",
+    )
+    group.add_argument(
+        "--no-tunnel",
+        dest="use_tunnel",
+        action="store_const",
+        const=False,
+        help="connect straight to --db-host/--db-port instead of through ssh",
     )
-    server.start()
-    return server
+    group.add_argument("--db-ssh-host", dest="ssh_host")
+    group.add_argument("--db-ssh-port", dest="ssh_port", type=int)
+
+
+def configure_from_args(args: argparse.Namespace):
+    """Passes any `--db-*` options that were given on the command line to `configure`."""
+    overrides = {}
+    for field in Config._fields:
+        val = getattr(args, field, None)
+        if val is not None:
+            overrides[field] = val
+    configure(**overrides)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses (and applies) just the `--db-*` options, for scripts that don't
+    have arguments of their own.
+    """
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+    return args
+
+
+def get_config() -> Config:
+    """Returns the database config, loading it the first time it's needed. Fields
+    come from the key file (`DB_CONN_KEY` or `KEY_FILE`), then the `DB_*`
+    environment variables, then anything passed to `configure`. The key file is
+    optional if everything it would provide is set some other way.
+    """
+    global _config
+    if _config is None:
+        fields = {}
+        key_file = os.environ.get("DB_CONN_KEY", KEY_FILE)
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                lines = [f.readline().strip() for _ in range(4)]
+            fields.update(zip(["db_name", "schema", "username", "password"], lines))
+        for var, field in ENV_VARS.items():
+            if var in os.environ:
+                fields[field] = _parse(field, os.environ[var])
+        fields.update(_overrides)
+        missing = [f for f in ("db_name", "schema", "username", "password") if f not in fields]
+        if missing:
+            raise RuntimeError(
+                f"no {', '.join(missing)} for the database; add {key_file} or set "
+                "the DB_* environment variables"
+            )
+        _config = Config(**fields)
+    return _config
+
+
+def open_tunnel() -> SSHTunnelForwarder:
+    """Takes a reference to this process's ssh tunnel, starting it if this is the
+    first one. Every call must be matched by a `close_tunnel()`.
+
+    Returns:
+        SSHTunnelForwarder: The shared tunnel, or None if the config has
+        `use_tunnel` off.
+    """
+    global _tunnel, _tunnel_refs, _tunnel_pid
+    config = get_config()
+    if not config.use_tunnel:
+        return None
+    # a forked child can't use its parent's tunnel, so it starts its own.
+    if _tunnel_pid != os.getpid():
+        _tunnel, _tunnel_refs = None, 0
+    if _tunnel is None:
+        _tunnel = SSHTunnelForwarder(
+            (config.ssh_host, config.ssh_port),
+            ssh_username=config.username,
+            ssh_password=config.password,
+            remote_bind_address=(config.host, config.port),
+        )
+        _tunnel.start()
+        _tunnel_pid = os.getpid()
+    _tunnel_refs += 1
+    return _tunnel
 
 
-async def connect(server) -> Connection:
-    params = {
-        "database": db_name,
-        "user": username,
-        "password": password,
-        "host": "localhost",
-        "port": server.local_bind_port,
+def close_tunnel():
+    """Drops a reference to the shared tunnel, stopping it once nothing uses it."""
+    global _tunnel, _tunnel_refs
+    if _tunnel is None or _tunnel_pid != os.getpid():
+        return
+    _tunnel_refs -= 1
+    if _tunnel_refs <= 0:
+        _tunnel.stop()
+        _tunnel, _tunnel_refs = None, 0
+
+
+@contextmanager
+def tunnel():
+    """Context manager for a reference to the shared tunnel.
+
+    Example:
+        with db.tunnel() as server:
+            conn = await db.connect(server)
+    """
+    server = open_tunnel()
+    try:
+        yield server
+    finally:
+        close_tunnel()
+
+
+def _params(server=None) -> dict:
+    config = get_config()
+    # without a tunnel we talk to `host:port` directly.
+    if server is None:
+        host, port = config.host, config.port
+    else:
+        host, port = "localhost", server.local_bind_port
+    return {
+        "database": config.db_name,
+        "user": config.username,
+        "password": config.password,
+        "host": host,
+        "port": port,
+        # set on connect rather than with `SET`, so the pool's `RESET ALL` on
+        # release doesn't put a connection back on the default schema.
+        "server_settings": {"search_path": f'"{config.schema}"'},
     }
-    conn: Connection = await asyncpg.connect(**params)
-    await conn.execute(f"""set search_path = "{schema}";""")
-    return conn
+
+
+def _close_leftover_tunnel():
+    # connections made by `connect()` hold the tunnel for the life of the process.
+    global _tunnel_refs
+    if _tunnel is not None and _tunnel_pid == os.getpid():
+        _tunnel_refs = 1
+        close_tunnel()
+
+
+atexit.register(_close_leftover_tunnel)
+
+
+async def connect(server=None) -> Connection:
+    """Opens a single connection. Prefer `pool()`/`acquire()` for anything
+    that opens more than one.
+
+    Args:
+        server (SSHTunnelForwarder, optional): The tunnel to connect through. If None,
+        uses the shared tunnel (or a direct connection if `use_tunnel` is off).
+        Defaults to None.
+    """
+    if server is None:
+        # we can't know when this connection gets closed, so the reference taken
+        # here keeps the tunnel up until the process exits.
+        server = open_tunnel()
+    return await asyncpg.connect(**_params(server))
+
+
+async def create_pool(
+    server=None,
+    min_size: int = MIN_SIZE,
+    max_size: int = MAX_SIZE,
+    statement_cache_size: int = STATEMENT_CACHE_SIZE,
+) -> Pool:
+    """Creates the shared connection pool (if it doesn't exist yet) and returns it.
+    Every connection in it already has the search path set to our schema.
+
+    Args:
+        server (SSHTunnelForwarder, optional): The tunnel to connect through. If None,
+        the pool takes a reference to the shared tunnel (or connects to postgres
+        directly if `use_tunnel` is off). Defaults to None.
+        min_size (int, optional): Connections opened up front. Defaults to MIN_SIZE.
+        max_size (int, optional): Most connections the pool will hold. Defaults to MAX_SIZE.
+        statement_cache_size (int, optional): Prepared statements cached per
+        connection. Defaults to STATEMENT_CACHE_SIZE.
+
+    Returns:
+        Pool: The shared pool.
+    """
+    global _pool, _pool_server
+    if _pool is None:
+        if server is None:
+            server = _pool_server = open_tunnel()
+        _pool = await asyncpg.create_pool(
+            **_params(server),
+            min_size=min_size,
+            max_size=max_size,
+            statement_cache_size=statement_cache_size,
+        )
+    return _pool
+
+
+async def close_pool():
+    """Closes the shared pool, waiting for every connection to be released."""
+    global _pool, _pool_server
+    if _pool is not None:
+        await _pool.close()
+    if _pool_server is not None:
+        close_tunnel()
+    _pool, _pool_server = None, None
+
+
+@asynccontextmanager
+async def pool(server=None, **kwargs):
+    """Context manager that creates the shared pool and closes it on exit.
+    Takes the same arguments as `create_pool`.
+
+    Example:
+        async with db.pool():
+            async with db.acquire() as conn:
+                records = await conn.fetch("SELECT * FROM table;")
+    """
+    try:
+        yield await create_pool(server, **kwargs)
+    finally:
+        await close_pool()
+
+
+def acquire(timeout: float = ACQUIRE_TIMEOUT):
+    """Borrows a connection from the shared pool. Use as `async with db.acquire() as conn:`,
+    and the connection is handed back to the pool when the block exits.
+    """
+    if _pool is None:
+        raise RuntimeError("no connection pool; call create_pool() or use pool() first")
+    return _pool.acquire(timeout=timeout)
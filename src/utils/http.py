@@ -0,0 +1,339 @@
+import asyncio
+import email.utils
+import json
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Dict, List, NamedTuple
+from urllib.parse import urlsplit
+import aiohttp
+from utils.cache import Cache
+
+# Maximum number of keep-alive connections we hold open to any single host.
+LIMIT_PER_HOST = 20
+# Maximum number of requests that may be in flight at once, across all hosts.
+MAX_CONCURRENCY = 100
+# Size of the chunks `stream` yields.
+CHUNK_SIZE = 64 * 1024
+# Requests per second we send to any single host, and how many can go out in a burst.
+RATE_PER_HOST = 20.0
+BURST_PER_HOST = 20
+# How many times a request is retried after a 429, a 5xx, a timeout or a dropped
+# connection, and the bounds of the (jittered, exponential) wait between tries.
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# A request gives up (and may be retried) if it can't connect, or the body stalls, for this long.
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+_session: aiohttp.ClientSession = None
+_semaphore: asyncio.Semaphore = None
+_cache: Cache = None
+_rate: float = RATE_PER_HOST
+_limiters: Dict[str, "TokenBucket"] = {}
+
+
+class DeadLetter(NamedTuple):
+    """A url we gave up on, and why."""
+
+    url: str
+    error: str
+
+
+_dead_letters: List[DeadLetter] = []
+
+
+class TokenBucket:
+    """A token bucket rate limiter: `acquire` hands out up to `rate` tokens a
+    second, with up to `burst` saved up for a burst. Waiters are served in order.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Waits for a token."""
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """Holds back every request to the host for (at least) `seconds`, e.g.
+        after it answered with a 429 and a Retry-After.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+async def open_session(
+    limit_per_host: int = LIMIT_PER_HOST,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: bool = True,
+    rate_per_host: float = RATE_PER_HOST,
+) -> aiohttp.ClientSession:
+    """Opens the shared session (if it isn't already open) and returns it.
+    Every fetcher in the importers goes through this one session, so TCP/TLS
+    connections are reused instead of being set up for every url.
+
+    Args:
+        limit_per_host (int, optional): Keep-alive connections per host.
+        Defaults to LIMIT_PER_HOST.
+        max_concurrency (int, optional): Requests allowed in flight at once.
+        Defaults to MAX_CONCURRENCY.
+        cache (bool, optional): Whether responses go through the on-disk cache
+        in `utils.cache`. Defaults to True.
+        rate_per_host (float, optional): Requests per second sent to each host,
+        or None for no limit (e.g. against a local fixture). Defaults to RATE_PER_HOST.
+
+    Returns:
+        aiohttp.ClientSession: The shared session.
+    """
+    global _session, _semaphore, _cache, _rate
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=max_concurrency, limit_per_host=limit_per_host
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+        _semaphore = asyncio.Semaphore(max_concurrency)
+        _rate = rate_per_host
+        _limiters.clear()
+        if cache and _cache is None:
+            _cache = Cache()
+    return _session
+
+
+async def close_session():
+    """Closes the shared session, if one is open."""
+    global _session, _semaphore, _cache
+    if _session is not None and not _session.closed:
+        await _session.close()
+    if _cache is not None:
+        _cache.close()
+    _session, _semaphore, _cache = None, None, None
+
+
+@asynccontextmanager
+async def session(
+    limit_per_host: int = LIMIT_PER_HOST,
+    max_concurrency: int = MAX_CONCURRENCY,
+    cache: bool = True,
+    rate_per_host: float = RATE_PER_HOST,
+):
+    """Context manager that opens the shared session and closes it on exit.
+
+    Example:
+        async with http.session():
+            json = await http.get_json(url)
+    """
+    try:
+        yield await open_session(limit_per_host, max_concurrency, cache, rate_per_host)
+    finally:
+        await close_session()
+
+
+def _limiter(url: str) -> TokenBucket:
+    if _rate is None:
+        return None
+    host = urlsplit(url).netloc
+    if host not in _limiters:
+        _limiters[host] = TokenBucket(_rate, BURST_PER_HOST)
+    return _limiters[host]
+
+
+def _backoff(attempt: int) -> float:
+    # "full jitter": a random wait of up to base * 2^attempt, so retries from
+    # many tasks don't all land on the host at the same moment.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def _retry_after(res: aiohttp.ClientResponse) -> float:
+    # Retry-After is either a number of seconds or an http date.
+    value = res.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.isdigit():
+        return min(float(value), BACKOFF_MAX)
+    try:
+        when = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return min(max(when - time.time(), 0), BACKOFF_MAX)
+
+
+@asynccontextmanager
+async def _request(url: str, headers: Dict[str, str]) -> AsyncIterator[aiohttp.ClientResponse]:
+    """Sends a GET through the shared session at the host's rate limit, retrying
+    429s, 5xxs, timeouts and dropped connections with jittered exponential backoff
+    (or as long as a Retry-After asks for). Yields the last response, whatever its
+    status, and releases it on exit.
+
+    Each try holds one of the `max_concurrency` slots (the final response holds it
+    until it's released), but the waits between tries don't, so a throttled url
+    doesn't keep other fetches from going out.
+    """
+    sess = await open_session()
+    limiter = _limiter(url)
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            await limiter.acquire()
+        async with _semaphore:
+            try:
+                res = await sess.get(url, headers=headers)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = _backoff(attempt)
+            else:
+                if res.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    async with res:
+                        yield res
+                    return
+                res.release()
+                delay = _retry_after(res)
+                if delay is not None:
+                    # the host told us how long to back off; everyone waits that long.
+                    if limiter is not None:
+                        limiter.pause(delay)
+                else:
+                    delay = _backoff(attempt)
+        await asyncio.sleep(delay)
+
+
+def dead_letter(url: str, error: BaseException):
+    """Records a url we gave up on."""
+    _dead_letters.append(DeadLetter(url, f"{type(error).__name__}: {error}"))
+
+
+def dead_letters() -> List[DeadLetter]:
+    """Every url that has failed for good so far (after all its retries)."""
+    return list(_dead_letters)
+
+
+async def or_dead_letter(url: str, aw: Awaitable):
+    """Awaits `aw` (a fetcher working on `url`), recording the url as a dead letter
+    instead of raising if it fails. Lets a crawl carry on past the odd bad url
+    rather than taking its whole TaskGroup down.
+
+    Returns:
+        The result of `aw`, or None if it failed.
+    """
+    try:
+        return await aw
+    except Exception as e:
+        dead_letter(url, e)
+        return None
+
+
+def cached(url: str):
+    """Returns the cache entry for a url (with its etag and size), or None."""
+    return _cache.lookup(url) if _cache is not None else None
+
+
+async def get_bytes(url: str, revalidate: bool = False) -> bytes:
+    """Gets the raw body of a url through the shared session. Fresh cached
+    responses are read straight off disk; stale ones are revalidated with a
+    conditional GET, so an unchanged resource costs a 304 instead of a download.
+    Requests go out at the host's rate limit and are retried on 429s, 5xxs and
+    timeouts (see `_request`).
+
+    Args:
+        url (str): The url.
+        revalidate (bool, optional): Whether even a fresh cached response is
+        revalidated, e.g. for a directory listing that new files show up in.
+        Defaults to False.
+    """
+    await open_session()
+    entry = _cache.lookup(url) if _cache is not None else None
+    if entry is not None and not revalidate and _cache.is_fresh(entry):
+        return _cache.read(entry)
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    async with _request(url, headers) as res:
+        if res.status == 304 and entry is not None:
+            _cache.touch(url)
+            return _cache.read(entry)
+        res.raise_for_status()
+        body = await res.read()
+        etag = res.headers.get("ETag")
+        last_modified = res.headers.get("Last-Modified")
+    if _cache is not None:
+        _cache.store(url, body, etag, last_modified)
+    return body
+
+
+async def stream(url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Like `get_bytes`, but yields the body a chunk at a time so it never has to
+    be held in memory whole. Network responses are written into the cache as they
+    stream past.
+    """
+    await open_session()
+    entry = _cache.lookup(url) if _cache is not None else None
+    if entry is not None and _cache.is_fresh(entry):
+        async for chunk in _stream_cached(entry, chunk_size):
+            yield chunk
+        return
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    async with _request(url, headers) as res:
+        if res.status == 304 and entry is not None:
+            _cache.touch(url)
+            revalidated = True
+        else:
+            revalidated = False
+            res.raise_for_status()
+            writer = None
+            if _cache is not None:
+                writer = _cache.writer(
+                    url, res.headers.get("ETag"), res.headers.get("Last-Modified")
+                )
+            try:
+                async for chunk in res.content.iter_chunked(chunk_size):
+                    if writer is not None:
+                        writer.write(chunk)
+                    yield chunk
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+            if writer is not None:
+                writer.commit()
+    if revalidated:
+        async for chunk in _stream_cached(entry, chunk_size):
+            yield chunk
+
+
+async def _stream_cached(entry, chunk_size: int) -> AsyncIterator[bytes]:
+    with _cache.open(entry) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+async def get_json(url: str):
+    """Gets the json body of a url through the shared session."""
+    return json.loads(await get_bytes(url))
+
+
+async def get_text(url: str, revalidate: bool = False) -> str:
+    """Gets the text body of a url through the shared session."""
+    return (await get_bytes(url, revalidate)).decode("utf-8")
@@ -0,0 +1,60 @@
+import numpy as np
+from asyncpg.connection import Connection
+
+
+async def ensure_sequence(conn: Connection, table: str, column: str) -> str:
+    """Makes sure `table.column` is backed by a sequence (as a `serial` column would
+    be), creating one if it isn't, and that it starts after the ids already in the
+    table.
+
+    Returns:
+        str: The name of the sequence.
+    """
+    async with conn.transaction():
+        # only one importer at a time gets to create the sequence.
+        await conn.execute(
+            "SELECT pg_advisory_xact_lock(hashtext($1))", f"{table}.{column}"
+        )
+        seq = await conn.fetchval(
+            "SELECT pg_get_serial_sequence($1, $2)", table, column
+        )
+        if seq is None:
+            seq = f"{table}_{column}_seq"
+            await conn.execute(
+                f"""CREATE SEQUENCE IF NOT EXISTS {seq} OWNED BY {table}.{column};"""
+            )
+            await conn.execute(
+                f"""ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT nextval('{seq}');"""
+            )
+            seq = await conn.fetchval(
+                "SELECT pg_get_serial_sequence($1, $2)", table, column
+            )
+        # ids used to be picked client side, so an existing sequence can be behind
+        # the ids already in the table; it's moved past them (but never back).
+        await conn.execute(
+            f"""SELECT setval('{seq}', greatest(
+                    coalesce((SELECT max({column}) FROM {table}), 0) + 1,
+                    (SELECT last_value + is_called::int FROM {seq})
+                ), false);"""
+        )
+        return seq
+
+
+async def reserve_ids(conn: Connection, table: str, column: str, n: int) -> np.ndarray:
+    """Reserves `n` ids from the sequence behind `table.column`. Sequences never
+    hand the same value out twice, so any number of tasks or processes can reserve
+    ids at once without colliding (the ids just aren't guaranteed to be contiguous).
+
+    Returns:
+        np.ndarray: The reserved ids, in ascending order.
+    """
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    records = await conn.fetch(
+        """SELECT nextval(pg_get_serial_sequence($1, $2)) AS id
+           FROM generate_series(1, $3) ORDER BY id;""",
+        table,
+        column,
+        n,
+    )
+    return np.fromiter((r["id"] for r in records), dtype=np.int64, count=n)
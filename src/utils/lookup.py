@@ -0,0 +1,78 @@
+from typing import Callable, Iterable, Tuple
+import numpy as np
+import pandas as pd
+
+
+class Lookup:
+    """A hash-indexed name -> id table, built once from the rows of a lookup table
+    in the database (`pokemon_info`, `move_info`, `egg_group`, `ability_info`).
+    Single lookups are dict lookups, and `map` resolves a whole column of names
+    at once through a pandas hash index, instead of a linear scan per name.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable,
+        values: Iterable,
+        normalize: Callable[[str], str] = None,
+    ):
+        """
+        Args:
+            keys (Iterable): The names.
+            values (Iterable): The ids, in the same order as the names.
+            normalize (Callable[[str], str], optional): Applied to every name,
+            both when building the table and when looking one up. Defaults to None.
+        """
+        self.normalize = normalize
+        if normalize is not None:
+            keys = map(normalize, keys)
+        self._table = dict(zip(keys, values))
+        self._index = None
+        self._values = None
+
+    @classmethod
+    def from_records(cls, records, normalize: Callable[[str], str] = None):
+        """Builds a lookup from `(name, id)` records, e.g. the result of
+        `conn.fetch("SELECT name, move_id FROM move_info")`.
+        """
+        keys, values = [], []
+        for r in records:
+            keys.append(r[0])
+            values.append(r[1])
+        return cls(keys, values, normalize)
+
+    def _norm(self, key):
+        return key if self.normalize is None else self.normalize(key)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __contains__(self, key) -> bool:
+        return self._norm(key) in self._table
+
+    def __getitem__(self, key):
+        return self._table[self._norm(key)]
+
+    def get(self, key, default=None):
+        return self._table.get(self._norm(key), default)
+
+    def map(self, keys: Iterable) -> Tuple[np.ndarray, np.ndarray]:
+        """Looks up many names at once.
+
+        Args:
+            keys (Iterable): The names to look up.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The ids, and a boolean mask of which
+            names were found. Ids for names that weren't found are undefined.
+        """
+        if self._index is None:
+            self._index = pd.Index(list(self._table.keys()))
+            self._values = np.array(list(self._table.values()))
+        if self.normalize is not None:
+            keys = [self.normalize(k) for k in keys]
+        pos = self._index.get_indexer(keys)
+        found = pos >= 0
+        if len(self._values) == 0:
+            return np.zeros(len(pos), dtype=np.int64), found
+        return self._values[np.where(found, pos, 0)], found
@@ -0,0 +1,64 @@
+import datetime
+import json
+from typing import Dict, List, NamedTuple, Set
+from asyncpg.connection import Connection
+
+
+class ManifestRow(NamedTuple):
+    url: str
+    month: datetime.date
+    etag: str = None
+    size: int = None
+    # "done" or "failed".
+    status: str = "done"
+    row_counts: Dict[str, int] = {}
+    error: str = None
+
+
+async def ensure_manifest(conn: Connection):
+    """Creates the `import_manifest` table if it doesn't exist yet. It has one row
+    per data file we've tried to import, so re-runs can skip the ones that are done.
+    """
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS import_manifest (
+               url text PRIMARY KEY,
+               month date NOT NULL,
+               etag text,
+               size bigint,
+               status text NOT NULL,
+               row_counts jsonb,
+               error text,
+               updated_at timestamptz NOT NULL DEFAULT now()
+           );"""
+    )
+
+
+async def done_urls(conn: Connection) -> Set[str]:
+    """Returns the urls of every file that has already been imported."""
+    records = await conn.fetch(
+        """SELECT url FROM import_manifest WHERE status = 'done';"""
+    )
+    return {r["url"] for r in records}
+
+
+async def record(conn: Connection, rows: List[ManifestRow]):
+    """Upserts manifest rows. Call this inside the same transaction as the data
+    it describes, so a file is only ever marked done if its rows were committed.
+    """
+    await conn.executemany(
+        """INSERT INTO import_manifest
+               (url, month, etag, size, status, row_counts, error, updated_at)
+           VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7, now())
+           ON CONFLICT (url) DO UPDATE SET
+               month = excluded.month,
+               etag = excluded.etag,
+               size = excluded.size,
+               status = excluded.status,
+               row_counts = excluded.row_counts,
+               error = excluded.error,
+               updated_at = excluded.updated_at;""",
+        [
+            (r.url, r.month, r.etag, r.size, r.status, json.dumps(r.row_counts), r.error)
+            for r in rows
+        ],
+    )
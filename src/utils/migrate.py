@@ -0,0 +1,356 @@
+import datetime
+import json
+from typing import Iterable, List, NamedTuple
+from asyncpg.connection import Connection
+
+"""
+The indexes and partitioning the importers and the EDA rely on, and a check that
+the planner actually uses them.
+
+`pokemon_stats` and `move_stats` are range partitioned on a `month` column (one
+partition per month, plus a default one for months that don't have theirs yet), so
+anything that only looks at some months only scans their partitions. The importer
+fills `month` in as it loads; `partition` backfills it for rows from before that.
+The rest of the per-pokemon tables (`MONTH_REFERENCES`) aren't partitioned, but get
+a `month` column too, so their foreign keys into `pokemon_stats` can include it.
+
+The indexes cover how rows are looked up and joined: metagames by cutoff and month,
+pokemon stats by metagame and by pokemon, and move stats by their pokemon stats row.
+A big import drops them first and builds them again once the data is in (see
+`drop_indexes`/`create_indexes`), since one bulk build beats updating them row by
+row the whole way through.
+"""
+
+
+class Index(NamedTuple):
+    name: str
+    table: str
+    columns: str
+
+
+INDEXES = [
+    Index("metagame_info_cutoff_month", "metagame_info", "cutoff, month"),
+    Index("pokemon_stats_metagame_id", "pokemon_stats", "metagame_id"),
+    Index("pokemon_stats_pokemon_info_id", "pokemon_stats", "pokemon_info_id"),
+    Index("move_stats_stats_id", "move_stats", "stats_id"),
+]
+
+# partitioned table -> (its id column, and the table + key its month comes from).
+# they're partitioned in this order, since move_stats gets its months from pokemon_stats.
+PARTITIONED = {
+    "pokemon_stats": ("stats_id", "metagame_info", "metagame_id"),
+    "move_stats": ("movedata_id", "pokemon_stats", "stats_id"),
+}
+
+# tables that reference pokemon_stats by stats_id without being partitioned; a key
+# into a partitioned table has to include its month, so they carry it as well.
+MONTH_REFERENCES = ["nature_stats", "ability_stats", "teammate_stats", "item_stats"]
+
+
+class PlanCheck(NamedTuple):
+    name: str
+    query: str
+    # the table whose scans are checked.
+    table: str
+    # whether every scan of it has to go through an index.
+    indexed: bool = True
+    # the most partitions of it that may be scanned (None for no limit).
+    max_partitions: int = None
+
+
+CHECKS = [
+    PlanCheck(
+        "metagames by cutoff and month",
+        "SELECT * FROM metagame_info WHERE cutoff = 0 AND month = '2020-01-01'",
+        "metagame_info",
+    ),
+    PlanCheck(
+        "pokemon stats by metagame",
+        "SELECT * FROM pokemon_stats WHERE metagame_id = 1",
+        "pokemon_stats",
+    ),
+    PlanCheck(
+        "pokemon stats by pokemon",
+        "SELECT * FROM pokemon_stats WHERE pokemon_info_id = 1",
+        "pokemon_stats",
+    ),
+    PlanCheck(
+        "move stats by stats id",
+        "SELECT * FROM move_stats WHERE stats_id = 1",
+        "move_stats",
+    ),
+    PlanCheck(
+        "one month of pokemon stats",
+        """SELECT pokemon_info_id, sum(raw_count) FROM pokemon_stats
+           WHERE month >= '2020-01-01' AND month < '2020-02-01'
+           GROUP BY pokemon_info_id""",
+        "pokemon_stats",
+        indexed=False,
+        max_partitions=1,
+    ),
+    PlanCheck(
+        "one month of move stats",
+        """SELECT move_id, sum(move_usage) FROM move_stats
+           WHERE month >= '2020-01-01' AND month < '2020-02-01'
+           GROUP BY move_id""",
+        "move_stats",
+        indexed=False,
+        max_partitions=1,
+    ),
+]
+
+
+async def ensure_month_columns(conn: Connection):
+    """Adds the (nullable) `month` column to the tables that get partitioned (and
+    the `MONTH_REFERENCES`), if it isn't there yet. That's only a catalog change, so
+    it's instant.
+    """
+    for table in [*PARTITIONED, *MONTH_REFERENCES]:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS month date;")
+
+
+async def is_partitioned(conn: Connection, table: str) -> bool:
+    return bool(
+        await conn.fetchval(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1);", table
+        )
+    )
+
+
+def _month_partition(table: str, month: datetime.date, of: str = None) -> str:
+    # e.g. pokemon_stats_2023_01, for january 2023 (of `of`, if it isn't `table`
+    # itself, like while it's being partitioned).
+    start = month.replace(day=1)
+    end = (start + datetime.timedelta(days=31)).replace(day=1)
+    return f"""CREATE TABLE IF NOT EXISTS {table}_{start:%Y_%m} PARTITION OF {of or table}
+               FOR VALUES FROM ('{start}') TO ('{end}');"""
+
+
+async def ensure_partitions(conn: Connection, months: Iterable[datetime.date]):
+    """Makes sure every partitioned table has a partition for each month, e.g.
+    before importing the files of those months.
+    """
+    months = sorted({m.replace(day=1) for m in months})
+    for table in PARTITIONED:
+        if not await is_partitioned(conn, table):
+            continue
+        for month in months:
+            await conn.execute(_month_partition(table, month))
+
+
+async def _dependents(conn: Connection, table: str) -> List[str]:
+    # views on the table, and foreign keys into it from tables that have no month
+    # to reference it by once it's partitioned; neither survives the swap.
+    records = await conn.fetch(
+        """SELECT DISTINCT 'view ' || r.ev_class::regclass AS what
+           FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+           WHERE d.refobjid = $1::regclass AND r.ev_class <> $1::regclass
+           UNION ALL
+           SELECT 'foreign key ' || c.conname || ' on ' || c.conrelid::regclass
+           FROM pg_constraint c
+           WHERE c.confrelid = $1::regclass AND c.contype = 'f' AND c.conparentid = 0
+             AND NOT EXISTS (SELECT FROM pg_attribute a
+                             WHERE a.attrelid = c.conrelid AND a.attname = 'month'
+                               AND NOT a.attisdropped);""",
+        table,
+    )
+    return [r["what"] for r in records]
+
+
+async def _constraints(conn: Connection, table: str) -> List[str]:
+    # `ALTER TABLE`s that put the table's primary key and foreign keys (both ways)
+    # back once it's partitioned. A partitioned table's primary key has to include
+    # the month, and so does every foreign key that references it; the referencing
+    # rows that have no month yet get it from the row they reference first.
+    statements = []
+    records = await conn.fetch(
+        """SELECT c.conname, c.contype::text, c.conrelid::regclass::text AS rel,
+                  pg_get_constraintdef(c.oid) AS def,
+                  ARRAY(SELECT attname FROM unnest(c.conkey) WITH ORDINALITY k(n, i)
+                        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.n
+                        ORDER BY k.i) AS cols,
+                  ARRAY(SELECT attname FROM unnest(c.confkey) WITH ORDINALITY k(n, i)
+                        JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = k.n
+                        ORDER BY k.i) AS ref_cols
+           FROM pg_constraint c
+           -- (a foreign key into a partitioned table has one per partition
+           -- under it, which come back with it.)
+           WHERE c.conparentid = 0
+             AND ((c.conrelid = $1::regclass AND c.contype IN ('p', 'f'))
+                  OR (c.confrelid = $1::regclass AND c.contype = 'f'
+                      AND c.conrelid <> $1::regclass));""",
+        table,
+    )
+    for r in records:
+        if r["contype"] == "p":
+            cols = ", ".join([*r["cols"], "month"])
+            statements.append(
+                f"ALTER TABLE {table} ADD CONSTRAINT {r['conname']} PRIMARY KEY ({cols});"
+            )
+        elif r["rel"] == table:
+            # a foreign key out of the table comes back as it was.
+            statements.append(
+                f"ALTER TABLE {table} ADD CONSTRAINT {r['conname']} {r['def']};"
+            )
+        else:
+            on = " AND ".join(f"r.{c} = t.{rc}" for c, rc in zip(r["cols"], r["ref_cols"]))
+            cols = ", ".join([*r["cols"], "month"])
+            ref_cols = ", ".join([*r["ref_cols"], "month"])
+            statements.append(
+                f"""UPDATE {r['rel']} r SET month = t.month FROM {table} t
+                    WHERE {on} AND r.month IS NULL;
+                    ALTER TABLE {r['rel']} ADD CONSTRAINT {r['conname']}
+                    FOREIGN KEY ({cols}) REFERENCES {table} ({ref_cols});"""
+            )
+    # the primary key has to be there before anything can reference it.
+    return sorted(statements, key=lambda st: "PRIMARY KEY" not in st)
+
+
+async def partition(conn: Connection, table: str):
+    """Turns one of the `PARTITIONED` tables into a table range partitioned on
+    `month` (one partition per month), backfilling `month` from the table it comes
+    from for rows that don't have one. Runs in a single transaction, and does
+    nothing if it's already partitioned.
+
+    The table's primary key becomes `(id, month)`, and its foreign keys are made
+    again on the new table; foreign keys into it get the month added, which needs
+    a `month` on the referencing table too (`ensure_month_columns` gives the
+    `MONTH_REFERENCES` one, and the rows without it are backfilled through the
+    key). It refuses (with a RuntimeError) to
+    touch a table with views on it, or with foreign keys into it from a table
+    without a month, rather than have the swap drop them. Its indexes are made
+    again by `create_indexes`.
+    """
+    id_col, parent, key = PARTITIONED[table]
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('migrate'))")
+        if await is_partitioned(conn, table):
+            return
+        dependents = await _dependents(conn, table)
+        if len(dependents) != 0:
+            raise RuntimeError(
+                f"can't partition {table}, it would drop: {', '.join(dependents)}"
+            )
+        constraints = await _constraints(conn, table)
+        columns = [
+            r["attname"]
+            for r in await conn.fetch(
+                """SELECT attname FROM pg_attribute
+                   WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped
+                     AND attname <> 'month'
+                   ORDER BY attnum;""",
+                table,
+            )
+        ]
+        # every row needs a month to be part of the primary key.
+        orphans = await conn.fetchval(
+            f"""SELECT count(*) FROM {table} t LEFT JOIN {parent} p ON p.{key} = t.{key}
+                WHERE t.month IS NULL AND p.month IS NULL;"""
+        )
+        if orphans != 0:
+            raise RuntimeError(
+                f"can't partition {table}, {orphans} of its rows have no {parent} "
+                "row to get their month from"
+            )
+        # the id sequence would be dropped with the old table if it still owned it.
+        seq = await conn.fetchval("SELECT pg_get_serial_sequence($1, $2)", table, id_col)
+        if seq is not None:
+            await conn.execute(f"ALTER SEQUENCE {seq} OWNED BY NONE;")
+        new = f"{table}_partitioned"
+        await conn.execute(
+            f"""CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS)
+                PARTITION BY RANGE (month);
+                ALTER TABLE {new} ALTER COLUMN month SET NOT NULL;
+                CREATE TABLE {table}_default PARTITION OF {new} DEFAULT;"""
+        )
+        records = await conn.fetch(
+            f"""SELECT DISTINCT month FROM {parent} WHERE month IS NOT NULL
+                UNION SELECT DISTINCT month FROM {table} WHERE month IS NOT NULL;"""
+        )
+        for month in sorted({r["month"].replace(day=1) for r in records}):
+            await conn.execute(_month_partition(table, month, of=new))
+        cols = ", ".join(columns)
+        t_cols = ", ".join(f"t.{c}" for c in columns)
+        await conn.execute(
+            f"""INSERT INTO {new} ({cols}, month)
+                SELECT {t_cols}, coalesce(t.month, p.month)
+                FROM {table} t LEFT JOIN {parent} p ON p.{key} = t.{key};"""
+        )
+        # the old table's constraints go with it (CASCADE takes the foreign keys
+        # into it), and come back on the new one.
+        await conn.execute(
+            f"""DROP TABLE {table} CASCADE;
+                ALTER TABLE {new} RENAME TO {table};"""
+        )
+        for statement in constraints:
+            await conn.execute(statement)
+        if seq is not None:
+            await conn.execute(f"ALTER SEQUENCE {seq} OWNED BY {table}.{id_col};")
+    await conn.execute(f"ANALYZE {table};")
+
+
+async def drop_indexes(conn: Connection):
+    """Drops the `INDEXES`, e.g. before a bulk load."""
+    for index in INDEXES:
+        await conn.execute(f"DROP INDEX IF EXISTS {index.name};")
+
+
+async def create_indexes(conn: Connection):
+    """Creates any of the `INDEXES` that are missing (on a partitioned table, on
+    every partition), and updates the planner's statistics for their tables.
+    """
+    for index in INDEXES:
+        await conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {index.name} ON {index.table} ({index.columns});"
+        )
+    for table in dict.fromkeys(index.table for index in INDEXES):
+        await conn.execute(f"ANALYZE {table};")
+
+
+async def migrate(conn: Connection):
+    """Brings the schema up to date: month columns, partitions and indexes."""
+    await ensure_month_columns(conn)
+    for table in PARTITIONED:
+        await partition(conn, table)
+    await create_indexes(conn)
+
+
+def _scans(plan: dict, table: str) -> List[dict]:
+    # every node of a plan that scans `table` (or one of its partitions).
+    found = []
+    relation = plan.get("Relation Name")
+    if relation == table or (relation or "").startswith(f"{table}_"):
+        found.append(plan)
+    for child in plan.get("Plans", []):
+        found.extend(_scans(child, table))
+    return found
+
+
+async def check_plans(conn: Connection, checks: List[PlanCheck] = CHECKS) -> List[str]:
+    """EXPLAINs each check's query and makes sure its plan still scans the way it
+    should: through an index, and/or only a few partitions. Sequential scans are
+    turned off while planning, so a sequential scan means there's no index the
+    query can use at all (rather than the table just being small).
+
+    Returns:
+        List[str]: What's wrong with each check that failed (empty if they all passed).
+    """
+    failures = []
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off;")
+        for check in checks:
+            plan = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) {check.query}"))
+            scans = _scans(plan[0]["Plan"], check.table)
+            if check.indexed:
+                seq = [s["Relation Name"] for s in scans if s["Node Type"] == "Seq Scan"]
+                if len(seq) != 0:
+                    failures.append(f"{check.name}: sequential scan of {', '.join(seq)}")
+            if check.max_partitions is not None:
+                if not await is_partitioned(conn, check.table):
+                    failures.append(f"{check.name}: {check.table} isn't partitioned")
+                scanned = {s["Relation Name"] for s in scans}
+                if len(scanned) > check.max_partitions:
+                    failures.append(
+                        f"{check.name}: scans {len(scanned)} partitions of {check.table}"
+                    )
+    return failures
@@ -0,0 +1,370 @@
+import datetime
+import decimal
+import math
+import struct
+from typing import AsyncIterator, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from asyncpg.connection import Connection
+from pandas import DataFrame
+from utils.table import from_columns, to_columns
+
+"""
+Bulk loading through PostgreSQL's binary COPY format, encoded a whole column at
+a time with numpy instead of a python tuple (and an asyncpg encode) per row.
+
+A binary COPY stream is a header, then one tuple per row: an int16 field count
+and, for every field, an int32 byte length (-1 for NULL) followed by the value
+in the type's binary "send" format, then a -1 trailer. Rows whose fields have
+the same lengths share a layout, so the rows are grouped by their lengths and
+each group is interleaved as a single numpy structured array (see `encode`).
+
+Fixed-width numbers are converted with a single `astype` to the big-endian type.
+Everything else (text, dates, numeric, or numbers stored as python objects) is
+factorized first, so each distinct value is encoded once and then gathered.
+"""
+
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+TRAILER = struct.pack("!h", -1)
+# Rows encoded per chunk of the stream, to keep the index arrays small.
+CHUNK_ROWS = 100_000
+
+# postgres type -> the big-endian numpy type of its binary format.
+_FIXED = {
+    "bool": np.dtype("u1"),
+    "int2": np.dtype(">i2"),
+    "int4": np.dtype(">i4"),
+    "int8": np.dtype(">i8"),
+    "float4": np.dtype(">f4"),
+    "float8": np.dtype(">f8"),
+}
+_TEXT = {"text", "varchar", "bpchar", "name", "citext"}
+_EPOCH = datetime.date(2000, 1, 1)
+
+# (schema, table) -> {column: type name}
+_types: Dict[Tuple[str, str], Dict[str, str]] = {}
+
+
+def _numeric(value) -> bytes:
+    # numeric's send format: ndigits, weight, sign, dscale, then base-10000 digits.
+    if isinstance(value, float) and math.isnan(value):
+        return struct.pack("!hhHh", 0, 0, 0xC000, 0)
+    d = decimal.Decimal(repr(value) if isinstance(value, float) else value)
+    sign, digits, exp = d.as_tuple()
+    dscale = max(-exp, 0)
+    # padding the decimal digits out to whole groups of 4 on both sides of the point.
+    digits = "".join(map(str, digits)) + "0" * max(exp, 0)
+    point = len(digits) - dscale
+    int_part = digits[:point] if point > 0 else ""
+    frac_part = ("0" * -point if point < 0 else "") + digits[max(point, 0) :]
+    int_part = int_part.zfill((len(int_part) + 3) // 4 * 4)
+    frac_part = frac_part.ljust((len(frac_part) + 3) // 4 * 4, "0")
+    groups = [int(int_part[i : i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(groups) - 1
+    groups += [int(frac_part[i : i + 4]) for i in range(0, len(frac_part), 4)]
+    # stripping leading/trailing zero groups (leading ones shift the weight).
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    header = (len(groups), weight, 0x4000 if sign else 0, dscale)
+    return struct.pack(f"!hhHh{len(groups)}H", *header, *groups)
+
+
+def _encode_value(typ: str, value) -> bytes:
+    """Encodes a single (non-null) value in the binary format of `typ`."""
+    if typ in _FIXED:
+        return np.asarray(value).astype(_FIXED[typ]).tobytes()
+    if typ in _TEXT:
+        return str(value).encode("utf-8")
+    if typ == "date":
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        return struct.pack("!i", (value - _EPOCH).days)
+    if typ == "numeric":
+        return _numeric(value)
+    raise TypeError(f"can't binary-encode postgres type {typ!r}")
+
+
+def _is_null(value) -> bool:
+    return value is None or value is pd.NA or value is pd.NaT
+
+
+class _Field:
+    """One column, ready to be encoded. Fixed-width columns keep their `values`,
+    already in the big-endian binary format; everything else has the encoded bytes
+    of each distinct value as the (zero-padded) rows of `table`, and each row's
+    `codes` into it. `lengths` is each row's encoded length, or -1 for NULL.
+    """
+
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        values: np.ndarray = None,
+        table: np.ndarray = None,
+        codes: np.ndarray = None,
+    ):
+        self.lengths = lengths
+        self.values = values
+        self.table = table
+        self.codes = codes
+        # whether every row is the same length (and none are NULL).
+        self.constant = len(lengths) == 0 or (
+            lengths[0] >= 0 and (lengths == lengths[0]).all()
+        )
+
+    def data(self, rows: np.ndarray, length: int) -> np.ndarray:
+        """The encoded values of some rows that are all `length` bytes long."""
+        if self.values is not None:
+            return self.values[rows]
+        return self.table[self.codes[rows], :length]
+
+
+def _field(typ: str, packed: Tuple) -> _Field:
+    # packed columns come from `utils.table.to_columns`.
+    kind = packed[0]
+    numeric = packed[1].dtype.kind in "biuf"
+    if kind in ("array", "masked") and typ in _FIXED and numeric:
+        values = packed[1]
+        nulls = packed[2] if kind == "masked" else None
+        if values.dtype.kind == "f" and _FIXED[typ].kind != "f":
+            # a float column is how a missing int comes out of pandas; its NaNs
+            # are NULLs (cast as they are, they'd turn into INT_MIN).
+            nans = np.isnan(values)
+            if nans.any():
+                nulls = nans if nulls is None else nulls | nans
+                values = np.where(nans, 0, values)
+        values = values.astype(_FIXED[typ])
+        lengths = np.full(len(values), values.dtype.itemsize, dtype=np.int64)
+        if nulls is not None:
+            lengths[nulls] = -1
+        return _Field(lengths, values=values)
+    if kind == "codes":
+        codes, uniques = packed[1], packed[2]
+    else:
+        values = packed[1]
+        if kind == "masked":
+            values = values.astype(object)
+            values[packed[2]] = None
+        codes, uniques = _factorize(values)
+    # encoding each distinct value once, then gathering them by code.
+    encoded = [b"" if _is_null(u) else _encode_value(typ, u) for u in uniques]
+    width = max(map(len, encoded), default=0)
+    table = np.zeros((len(encoded) + 1, width), dtype=np.uint8)
+    ulens = np.full(len(encoded) + 1, -1, dtype=np.int64)
+    for i, (u, e) in enumerate(zip(uniques, encoded)):
+        table[i, : len(e)] = np.frombuffer(e, dtype=np.uint8)
+        if not _is_null(u):
+            ulens[i] = len(e)
+    # code -1 (a missing value) lands on the extra NULL row at the end.
+    codes = np.where(codes < 0, len(encoded), codes)
+    return _Field(ulens[codes], table=table, codes=codes)
+
+
+def _factorize(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # NaN is a value like any other here (numeric has a NaN); only None is NULL.
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return codes, np.asarray(uniques, dtype=object)
+
+
+def encode(
+    fields: List[_Field], begin: int, end: int, header: bool, trailer: bool
+) -> bytes:
+    """Encodes rows `begin:end` of some fields as (part of) a binary COPY stream.
+
+    Rows whose fields all have the same lengths have the same layout, so each such
+    group is built as one numpy structured array and dumped with `tobytes`. That
+    means rows come out grouped rather than in their original order, which COPY
+    doesn't care about.
+    """
+    n = end - begin
+    parts = [HEADER] if header else []
+    lengths = np.stack([f.lengths[begin:end] for f in fields], axis=1)
+    varying = [i for i, f in enumerate(fields) if not f.constant]
+    if n == 0:
+        groups = []
+    elif len(varying) == 0:
+        groups = [np.arange(begin, end)]
+    else:
+        # numbering each distinct combination of lengths, then sorting rows by it
+        # (a stable sort of small ints is a radix sort, so this is linear).
+        sizes = lengths[:, varying] + 1
+        dims = sizes.max(axis=0) + 1
+        if np.prod(dims.astype(float)) < 2**62:
+            key = np.ravel_multi_index(tuple(sizes.T), tuple(dims))
+            _, inverse = np.unique(key, return_inverse=True)
+        else:
+            _, inverse = np.unique(sizes, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        if inverse.max() < 2**15:
+            inverse = inverse.astype(np.int16)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse))[:-1]
+        groups = np.split(order + begin, bounds)
+    for rows in groups:
+        lens = lengths[rows[0] - begin]
+        dtype = [("count", ">i2")]
+        for i, (f, length) in enumerate(zip(fields, lens)):
+            dtype.append((f"len{i}", ">i4"))
+            if length > 0:
+                sub = f.values.dtype if f.values is not None else ("u1", (length,))
+                dtype.append((f"val{i}", sub))
+        out = np.empty(len(rows), dtype=dtype)
+        out["count"] = len(fields)
+        for i, (f, length) in enumerate(zip(fields, lens)):
+            out[f"len{i}"] = length
+            if length > 0:
+                out[f"val{i}"] = f.data(rows, length)
+        parts.append(out.tobytes())
+    if trailer:
+        parts.append(TRAILER)
+    return b"".join(parts)
+
+
+async def column_types(conn: Connection, table: str) -> Dict[str, str]:
+    """Gets the type of every column of a table from `pg_attribute` (cached, since
+    the schema doesn't change mid-import).
+    """
+    schema = await conn.fetchval("SELECT current_schema()")
+    key = (schema, table)
+    if key not in _types:
+        records = await conn.fetch(
+            """SELECT a.attname, t.typname
+               FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+               WHERE a.attrelid = $1::regclass
+                 AND a.attnum > 0 AND NOT a.attisdropped;""",
+            table,
+        )
+        _types[key] = {r["attname"]: r["typname"] for r in records}
+    return _types[key]
+
+
+def supported(typ: str) -> bool:
+    return typ in _FIXED or typ in _TEXT or typ in ("date", "numeric")
+
+
+async def copy_columns(
+    conn: Connection,
+    table: str,
+    cols: Dict[str, Tuple],
+    types: Dict[str, str],
+    chunk_rows: int = CHUNK_ROWS,
+    timeout: float = None,
+):
+    """COPYs packed columns (see `utils.table.to_columns`) into a table in binary.
+
+    Args:
+        conn (Connection): The connection to COPY on.
+        table (str): The table being appended to.
+        cols (Dict[str, Tuple]): The packed columns, named like the table's columns.
+        types (Dict[str, str]): The table's column types (see `column_types`).
+        chunk_rows (int, optional): Rows encoded at a time. Defaults to CHUNK_ROWS.
+        timeout (float, optional): Passed on to asyncpg. Defaults to None.
+    """
+    names = list(cols)
+    fields = [_field(types[name], cols[name]) for name in names]
+    n = len(fields[0].lengths)
+
+    async def chunks() -> AsyncIterator[bytes]:
+        for begin in range(0, max(n, 1), chunk_rows):
+            end = min(begin + chunk_rows, n)
+            yield encode(fields, begin, end, begin == 0, end == n)
+
+    await conn.copy_to_table(
+        table, source=chunks(), columns=names, format="binary", timeout=timeout
+    )
+
+
+async def copy_frame(
+    conn: Connection, table: str, df: DataFrame, timeout: float = None
+):
+    """COPYs a DataFrame into a table through the binary encoder. The names of the
+    columns in the dataframe must match the names of the columns in the table. If
+    one of the table's columns has a type the encoder doesn't know, it falls back
+    to asyncpg's own (row at a time) `copy_records_to_table`.
+    """
+    types = await column_types(conn, table)
+    if not all(supported(types.get(c)) for c in df.columns):
+        await conn.copy_records_to_table(
+            table,
+            records=df.itertuples(index=False, name=None),
+            columns=list(df),
+            timeout=timeout,
+        )
+        return
+    cols = to_columns(df, downcast=False)
+    await copy_columns(conn, table, cols, types, timeout=timeout)
+
+
+async def copy_packed(
+    conn: Connection, table: str, cols: Dict[str, Tuple], timeout: float = None
+):
+    """`copy_frame` for columns that are already packed (see `utils.table.to_columns`),
+    e.g. the tables the import's parse workers hand back, so they go straight to the
+    encoder without being unpacked into a DataFrame and packed again.
+    """
+    types = await column_types(conn, table)
+    if not all(supported(types.get(c)) for c in cols):
+        await copy_frame(conn, table, from_columns(cols), timeout=timeout)
+        return
+    await copy_columns(conn, table, cols, types, timeout=timeout)
+
+
+async def update_frame(
+    conn: Connection,
+    table: str,
+    df: DataFrame,
+    key: str,
+    keep_existing: bool = False,
+    timeout: float = None,
+) -> int:
+    """Updates many rows of a table at once: the DataFrame is COPYed into a temp
+    staging table, and then a single `UPDATE ... FROM` joins it onto the table by
+    `key`. That's two round trips, no matter how many rows change.
+
+    Args:
+        conn (Connection): The connection to update on.
+        table (str): The table being updated.
+        df (DataFrame): The new values, with `key` and the columns to set, named
+        like the table's columns. Each key should only appear once.
+        key (str): The column that picks out the row to update.
+        keep_existing (bool, optional): Whether a NULL in the DataFrame leaves the
+        table's value alone, rather than setting it to NULL. Defaults to False.
+        timeout (float, optional): Passed on to asyncpg. Defaults to None.
+
+    Returns:
+        int: How many rows of the table were updated.
+    """
+    types = await column_types(conn, table)
+    names = list(df.columns)
+    stage = f"{table}_staging"
+    sets = [
+        f"{c} = coalesce(s.{c}, t.{c})" if keep_existing else f"{c} = s.{c}"
+        for c in names
+        if c != key
+    ]
+    async with conn.transaction():
+        # shaped like the table's columns, without any of its constraints.
+        await conn.execute(
+            f"""CREATE TEMP TABLE {stage} ON COMMIT DROP AS
+                SELECT {", ".join(names)} FROM {table} WITH NO DATA;"""
+        )
+        if all(supported(types.get(c)) for c in names):
+            cols = to_columns(df, downcast=False)
+            await copy_columns(conn, stage, cols, types, timeout=timeout)
+        else:
+            await conn.copy_records_to_table(
+                stage,
+                records=df.itertuples(index=False, name=None),
+                columns=names,
+                timeout=timeout,
+            )
+        status = await conn.execute(
+            f"""UPDATE {table} t SET {", ".join(sets)}
+                FROM {stage} s WHERE t.{key} = s.{key};""",
+            timeout=timeout,
+        )
+    return int(status.split()[-1])
@@ -0,0 +1,69 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List
+
+"""
+Helpers for wiring an import up as a pipeline of stages connected by bounded
+queues, e.g. fetch -> parse -> load. Every stage runs at once, and a full queue
+makes the stage feeding it wait (backpressure), so memory stays bounded and the
+whole thing runs at the pace of its slowest stage rather than the sum of them.
+
+    files, bodies, tables = asyncio.Queue(), asyncio.Queue(8), asyncio.Queue(8)
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(feed(urls, files))
+        tg.create_task(stage(fetch, files, bodies, workers=16))
+        tg.create_task(stage(parse, bodies, tables, workers=4))
+        tg.create_task(load(tables))
+"""
+
+# Put on a queue after its last item.
+DONE = object()
+
+
+async def feed(items: Iterable, outbox: asyncio.Queue):
+    """Puts every item on a queue, then `DONE`."""
+    for item in items:
+        await outbox.put(item)
+    await outbox.put(DONE)
+
+
+async def stage(
+    fn: Callable[..., Awaitable],
+    inbox: asyncio.Queue,
+    outbox: asyncio.Queue,
+    workers: int = 1,
+):
+    """Runs `workers` tasks that each take items off `inbox` and put `await fn(item)`
+    on `outbox`, until `inbox` is `DONE`. `outbox` gets its own `DONE` once every
+    worker has finished.
+    """
+
+    async def worker():
+        while (item := await inbox.get()) is not DONE:
+            await outbox.put(await fn(item))
+        # putting it back for the other workers to see.
+        await inbox.put(DONE)
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(workers):
+            tg.create_task(worker())
+    await outbox.put(DONE)
+
+
+async def batches(inbox: asyncio.Queue, max_size: int) -> AsyncIterator[List]:
+    """Yields what's on a queue in batches, until it's `DONE`. A batch is whatever
+    has piled up since the last one (at least one item, at most `max_size`), so a
+    slow consumer gets bigger batches instead of falling further behind.
+    """
+    done = False
+    while not done:
+        item = await inbox.get()
+        if item is DONE:
+            return
+        batch = [item]
+        while len(batch) < max_size and not inbox.empty():
+            item = inbox.get_nowait()
+            if item is DONE:
+                done = True
+                break
+            batch.append(item)
+        yield batch
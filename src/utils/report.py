@@ -0,0 +1,176 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+from typing import Callable, Dict, List, NamedTuple, Tuple
+import matplotlib
+import matplotlib.pyplot as plt
+import pandas as pd
+from pandas import DataFrame
+import utils.alias as alias
+import utils.cursor as cursor
+import utils.db_connect as db
+
+"""
+A runner for the EDA report. Every query runs at once, each on its own pooled
+connection. Results are cached as Parquet files, keyed by a hash of the query and
+the version of the data (see `data_version`), so the database is only asked again
+after an import. The figures are drawn in a process pool. A figure is only redrawn when
+the results it's drawn from have actually changed (or its files are missing), so
+an import that touches some of the data only redoes the figures that use it.
+"""
+
+# Where query results (and what each figure was last drawn from) are kept.
+CACHE_DIR = "./.report_cache"
+# The tables written by import-pokeapi, fix-imports and ability-import, which
+# `data_version` looks at directly.
+POKEAPI_TABLES = [
+    "pokemon_info",
+    "move_info",
+    "move_pool",
+    "ability_info",
+    "egg_group",
+    "pokemoninfo_egggroup",
+    *alias.TABLES,
+]
+
+
+class Figure(NamedTuple):
+    name: str
+    # the queries whose results are passed to `render`, in order.
+    queries: List[str]
+    # draws the figure and saves it; it runs in another process, so it has to be
+    # a module-level function.
+    render: Callable[..., None]
+    # the files `render` saves.
+    outputs: List[str]
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def _frame_digest(df: DataFrame) -> str:
+    # a hash of the contents, so refetched-but-identical results count as unchanged.
+    h = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+async def data_version() -> str:
+    """The version of the imported data: when `import_manifest` last changed, plus
+    the row count and newest row version (`xmin`) of every table the pokeapi-side
+    scripts write, since those don't go through the manifest.
+    """
+    parts = []
+    async with db.acquire() as conn:
+        updated = None
+        if await conn.fetchval("SELECT to_regclass('import_manifest') IS NOT NULL;"):
+            updated = await conn.fetchval("SELECT max(updated_at) FROM import_manifest;")
+        parts.append("0" if updated is None else str(int(updated.timestamp() * 1_000_000)))
+        for table in POKEAPI_TABLES:
+            if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL;", table):
+                parts.append(f"{table}:-")
+                continue
+            # a rewritten row gets a new xmin; a deleted one changes the count.
+            count, xmin = await conn.fetchrow(
+                f"SELECT count(*), max(xmin::text::bigint) FROM {table};"
+            )
+            parts.append(f"{table}:{count}:{xmin}")
+    return _digest(*parts)
+
+
+async def fetch_cached(query: str, version: str, cache_dir: str = CACHE_DIR) -> DataFrame:
+    """Runs a query, or reads its result from the cache if it was already run
+    against this version of the data.
+
+    Args:
+        query (str): The query.
+        version (str): The version of the data (see `data_version`).
+        cache_dir (str, optional): Where the results are cached. Defaults to CACHE_DIR.
+
+    Returns:
+        DataFrame: The result, with the query's column names.
+    """
+    key = _digest(query)
+    path = os.path.join(cache_dir, f"{key}-{version}.parquet")
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    # streamed through a cursor into typed columns, rather than a Record per row.
+    async with db.acquire() as conn:
+        df = await cursor.fetch_frame(conn, query)
+    # results from older versions of the data won't be asked for again.
+    for name in os.listdir(cache_dir):
+        if name.startswith(f"{key}-"):
+            os.remove(os.path.join(cache_dir, name))
+    df.to_parquet(path, index=False)
+    return df
+
+
+def _render(render: Callable[..., None], frames: List[DataFrame]):
+    # each figure starts from the default style and a blank figure, whatever the
+    # worker drew before it.
+    with matplotlib.rc_context():
+        plt.close("all")
+        render(*frames)
+        plt.close("all")
+
+
+async def run(
+    figures: List[Figure],
+    cache_dir: str = CACHE_DIR,
+    workers: int = None,
+    force: bool = False,
+) -> List[str]:
+    """Draws the figures of a report, redrawing only the ones whose data changed.
+
+    Args:
+        figures (List[Figure]): The figures.
+        cache_dir (str, optional): Where the results are cached. Defaults to CACHE_DIR.
+        workers (int, optional): How many processes draw figures. Defaults to one per core.
+        force (bool, optional): Whether to redraw every figure. Defaults to False.
+
+    Returns:
+        List[str]: The names of the figures that were drawn.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    version = await data_version()
+    queries = list(dict.fromkeys(q for f in figures for q in f.queries))
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(fetch_cached(q, version, cache_dir)) for q in queries]
+    results: Dict[str, Tuple[DataFrame, str]] = {
+        q: (t.result(), _frame_digest(t.result())) for q, t in zip(queries, tasks)
+    }
+    # what each figure was last drawn from.
+    state_path = os.path.join(cache_dir, "figures.json")
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    stale = []
+    for fig in figures:
+        key = _digest(fig.render.__qualname__, *(results[q][1] for q in fig.queries))
+        if force or state.get(fig.name) != key or not all(map(os.path.exists, fig.outputs)):
+            stale.append((fig, key))
+    if len(stale) != 0:
+        loop = asyncio.get_running_loop()
+        # spawning, since the db pool's ssh tunnel runs in threads.
+        with concurrent.futures.ProcessPoolExecutor(
+            workers or min(len(stale), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        pool, _render, fig.render, [results[q][0] for q in fig.queries]
+                    )
+                    for fig, _ in stale
+                )
+            )
+        for fig, key in stale:
+            state[fig.name] = key
+        with open(state_path, "w") as f:
+            json.dump(state, f, indent=2)
+    return [fig.name for fig, _ in stale]
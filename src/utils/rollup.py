@@ -0,0 +1,120 @@
+import datetime
+from typing import Iterable
+from asyncpg.connection import Connection
+
+"""
+Summary tables for the EDA, so plots read a few thousand pre-aggregated rows
+instead of joining all of `pokemon_stats` every time. The usage tables are refreshed
+after every smogon import, one month at a time, so only the months that import
+touched are recomputed; fix-imports redoes them whole, since it can change a
+pokemon's types. `move_pool_size` is refreshed on its own, by import-pokeapi.
+
+- `usage_monthly`: each pokemon's usage in each month (cutoff 0). `share` is its raw
+  count over every battle that month; `battles` is the total battles of just the
+  metagames it showed up in (what `raw_count / battles` usage is measured against).
+- `type_usage_monthly`: the same, summed per type. A pokemon with two types counts
+  towards both.
+- `move_pool_size`: how many distinct moves each pokemon can learn.
+"""
+
+
+async def ensure_rollups(conn: Connection):
+    """Creates the summary tables and their indexes if they don't exist yet, and
+    fills them from everything already imported if they were just created.
+    """
+    async with conn.transaction():
+        # only one importer at a time gets to create them.
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('rollup'))")
+        exists = await conn.fetchval("SELECT to_regclass('usage_monthly') IS NOT NULL;")
+        if exists:
+            return
+        await conn.execute(
+            """CREATE TABLE usage_monthly (
+                   month date NOT NULL,
+                   pokemon_info_id integer NOT NULL,
+                   raw_count bigint NOT NULL,
+                   battles bigint NOT NULL,
+                   share float8 NOT NULL,
+                   PRIMARY KEY (month, pokemon_info_id)
+               );
+               CREATE INDEX usage_monthly_pokemon ON usage_monthly (pokemon_info_id);
+               CREATE TABLE type_usage_monthly (
+                   month date NOT NULL,
+                   type text NOT NULL,
+                   raw_count bigint NOT NULL,
+                   battles bigint NOT NULL,
+                   share float8 NOT NULL,
+                   PRIMARY KEY (month, type)
+               );
+               CREATE INDEX type_usage_monthly_type ON type_usage_monthly (type);
+               CREATE TABLE move_pool_size (
+                   pokemon_info_id integer PRIMARY KEY,
+                   moves_available integer NOT NULL
+               );"""
+        )
+        await refresh(conn)
+        await refresh_move_pools(conn)
+
+
+async def refresh(conn: Connection, months: Iterable[datetime.date] = None):
+    """Recomputes the usage summary tables for some months, in one transaction.
+
+    Args:
+        conn (Connection): The connection to refresh on.
+        months (Iterable[datetime.date], optional): The months to recompute, e.g.
+        the ones an import just loaded. Defaults to every month.
+    """
+    # a NULL array means every month.
+    months = None if months is None else sorted(set(months))
+    if months is not None and len(months) == 0:
+        return
+    async with conn.transaction():
+        await conn.execute(
+            """DELETE FROM usage_monthly WHERE $1::date[] IS NULL OR month = ANY($1);""",
+            months,
+        )
+        await conn.execute(
+            """INSERT INTO usage_monthly (month, pokemon_info_id, raw_count, battles, share)
+               SELECT m.month, ps.pokemon_info_id, sum(ps.raw_count)::bigint,
+                      sum(m.total_battles)::bigint, sum(ps.raw_count) / t.total
+               FROM pokemon_stats ps
+                    JOIN metagame_info m ON m.metagame_id = ps.metagame_id
+                    JOIN (SELECT month, sum(total_battles)::float8 total
+                          FROM metagame_info
+                          WHERE cutoff = 0 AND ($1::date[] IS NULL OR month = ANY($1))
+                          GROUP BY month) t ON t.month = m.month
+               WHERE m.cutoff = 0 AND ($1::date[] IS NULL OR m.month = ANY($1))
+               GROUP BY m.month, ps.pokemon_info_id, t.total;""",
+            months,
+        )
+        await conn.execute(
+            """DELETE FROM type_usage_monthly WHERE $1::date[] IS NULL OR month = ANY($1);""",
+            months,
+        )
+        await conn.execute(
+            """INSERT INTO type_usage_monthly (month, type, raw_count, battles, share)
+               SELECT u.month, t.type, sum(u.raw_count), sum(u.battles), sum(u.share)
+               FROM usage_monthly u
+                    JOIN pokemon_info p ON p.pokemon_info_id = u.pokemon_info_id
+                    CROSS JOIN LATERAL (VALUES (p.primary_type), (p.secondary_type)) t(type)
+               WHERE t.type IS NOT NULL AND ($1::date[] IS NULL OR u.month = ANY($1))
+               GROUP BY u.month, t.type;""",
+            months,
+        )
+
+
+async def refresh_move_pools(conn: Connection):
+    """Recomputes `move_pool_size` from `move_pool`, e.g. after a pokeapi import
+    rewrote the move pools. It's cheap enough to always redo whole.
+
+    Args:
+        conn (Connection): The connection to refresh on.
+    """
+    async with conn.transaction():
+        await conn.execute(
+            """TRUNCATE move_pool_size;
+               INSERT INTO move_pool_size (pokemon_info_id, moves_available)
+               SELECT pokemon_info_id, count(DISTINCT move_id)
+               FROM move_pool
+               GROUP BY pokemon_info_id;"""
+        )
@@ -0,0 +1,275 @@
+import datetime
+from typing import BinaryIO, Dict, List, Set, Tuple, Union
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import utils.alias as alias
+from utils.chaos import parse_chaos
+from utils.lookup import Lookup
+from utils.table import NestedBuilder, flatten, to_columns
+
+"""
+The CPU-bound half of the smogon import: turning the raw bytes of a chaos file into
+rows for every smogon table. It lives here rather than in `import-smogon.py` so it
+can be pickled over to a process pool, where each worker is handed the lookups
+once (with `init_worker`) and then just the paths of the files (or raw bodies).
+"""
+
+# The nested usage dicts of each pokemon that become tables of their own.
+USAGE_KEYS = ["Moves", "Abilities", "Items", "Spreads", "Teammates"]
+# Every table we fill, in the order they have to be appended in.
+TABLE_NAMES = [
+    "metagame_info",
+    "pokemon_stats",
+    "move_stats",
+    "nature_stats",
+    "ability_stats",
+    "teammate_stats",
+    "item_stats",
+]
+
+# the lookups of the worker process (see `init_worker`).
+_pokemon: Lookup = None
+_moves: Lookup = None
+_abilities: Lookup = None
+
+
+def strip_dashes(name: str) -> str:
+    """Smogon's move/ability names have no `-` in them, so pokeapi's can't either."""
+    return name.replace("-", "")
+
+
+def normalize_names(names) -> pd.Index:
+    """Turns smogon's pokemon and move names ("Great Tusk", "Mr. Mime", "uturn")
+    into the slugs the alias tables are keyed by (see `utils.alias`).
+    """
+    return alias.slugs(names)
+
+
+def by_stats_id(
+    usage: NestedBuilder,
+    found: np.ndarray,
+    stats_ids: np.ndarray,
+    key_col: str,
+    value_col: str,
+) -> DataFrame:
+    """Turns one of the nested usage columns of a chaos file into long rows keyed
+    by `stats_id`, dropping the rows of pokemon that didn't make it into `pokemon_stats`.
+
+    Args:
+        usage (NestedBuilder): The usage dicts, keyed by each pokemon's position in the file.
+        found (np.ndarray): Which positions in the file made it into `pokemon_stats`.
+        stats_ids (np.ndarray): The stats id of each position in the file.
+        key_col (str): What to name the key column.
+        value_col (str): What to name the usage column.
+    """
+    df = usage.to_frame("stats_id", key_col, value_col)
+    pos = df["stats_id"].to_numpy()
+    df = df[found[pos]]
+    df["stats_id"] = stats_ids[pos[found[pos]]]
+    return df.reset_index(drop=True)
+
+
+def resolve(
+    df: DataFrame, key_col: str, lookup: Lookup, id_col: str, outliers: set, names=None
+) -> DataFrame:
+    """Swaps a column of names for a column of ids, recording the names that
+    aren't in the lookup as outliers (and dropping their rows).
+    """
+    names = df[key_col] if names is None else names
+    ids, found = lookup.map(names)
+    outliers.update(df.loc[~found, key_col].to_list())
+    df = df[found].drop(columns=[key_col])
+    df[id_col] = ids[found]
+    return df.reset_index(drop=True)
+
+
+def split_spreads(df: DataFrame, outliers: set) -> DataFrame:
+    """Splits smogon's "Nature:hp/atk/def/spa/spd/spe" spread keys into columns,
+    recording the spreads that aren't in that shape (like "Other") as outliers
+    (and dropping their rows).
+    """
+    parts = df["spread"].str.extract(
+        r"^(\w+):(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)$"
+    )
+    parsed = parts[0].notna().to_numpy()
+    outliers.update(df.loc[~parsed, "spread"].to_list())
+    df, parts = df[parsed], parts[parsed]
+    parts.columns = [
+        "nature",
+        "hp_ev",
+        "atk_ev",
+        "def_ev",
+        "spa_ev",
+        "spd_ev",
+        "spe_ev",
+    ]
+    parts["nature"] = parts["nature"].str.lower()
+    for col in parts.columns[1:]:
+        parts[col] = parts[col].astype("Int64")
+    df = pd.concat([df[["stats_id"]], parts, df[["spread_usage"]]], axis=1)
+    return df.reset_index(drop=True)
+
+
+def transform(
+    body: Union[bytes, BinaryIO],
+    month: datetime.date,
+    pokemon: Lookup,
+    moves: Lookup,
+    abilities: Lookup,
+) -> Tuple[Dict[str, DataFrame], Dict[str, Set[str]]]:
+    """Turns the body of a chaos file into rows for every smogon table
+    (`metagame_info`, `pokemon_stats`, `move_stats`, `nature_stats`, `ability_stats`,
+    `teammate_stats` and `item_stats`) in a single pass.
+
+    Nothing here touches shared state, so any number of files can be processed at
+    once. The ids are file-local: `pokemon_stats.stats_id` (and the `stats_id` of
+    every child table) is the pokemon's position among this file's stats rows, and
+    the loader swaps them for ids reserved from the database.
+
+    Args:
+        body (Union[bytes, BinaryIO]): The chaos json file, in memory or open.
+        month (datetime.date): The month that this json file is associated with.
+        pokemon (Lookup): The slug -> id lookup of the `pokemon_alias` table
+        in the database.
+        moves (Lookup): The slug -> id lookup of the `move_alias` table
+        in the database.
+        abilities (Lookup): The name -> id lookup of the `ability_info` table
+        in the database (with the `-` removed from the names).
+
+    Returns:
+        Tuple[Dict[str, DataFrame], Dict[str, Set[str]]]: The rows for each table (None
+        if the file was empty), and the pokemon, move and ability names that weren't
+        in their lookups (and the spreads that couldn't be split).
+    """
+    outliers = {"pokemon": set(), "moves": set(), "abilities": set(), "spreads": set()}
+    # the nested usage dicts are flattened to (position in file, key, usage) rows
+    # as the file is parsed; only one pokemon's entry is ever parsed at a time.
+    meta_inf, names, raw_counts = None, [], []
+    usage = {k: NestedBuilder() for k in USAGE_KEYS}
+    for event in parse_chaos(body):
+        if event[0] == "info":
+            meta_inf = event[1]
+        else:
+            _, name, record = event
+            for k, builder in usage.items():
+                builder.append(len(names), record.get(k, {}))
+            names.append(name)
+            raw_counts.append(record.get("Raw count"))
+    # skipping empty data
+    if len(names) == 0:
+        return None, outliers
+    # generating a single dataframe of metagame info. this is basically just a single row of the table.
+    meta_df = DataFrame(
+        [[meta_inf["metagame"], meta_inf["cutoff"], month, meta_inf["number of battles"]]],
+        columns=["metagame_name", "cutoff", "month", "total_battles"],
+    )
+    # This here is how i figure out which pokemon arent in pokeapi, but are in smogon
+    # (every form and gender variant pokeapi has is in the alias table).
+    names = normalize_names(names)
+    ids, found = pokemon.map(names)
+    outliers["pokemon"].update(names[~found].to_list())
+    # each found pokemon's (file-local) stats id is its position among the found pokemon.
+    stats_ids = np.cumsum(found) - 1
+    # This adds to `pokemon_stats`
+    stats_df = DataFrame(
+        {
+            "stats_id": np.arange(found.sum()),
+            "pokemon_info_id": ids[found],
+            "raw_count": np.asarray(raw_counts)[found],
+        }
+    )
+    # adding to `move_stats` (there are some outliers).
+    moves_df = by_stats_id(usage["Moves"], found, stats_ids, "name", "move_usage")
+    moves_df = resolve(
+        moves_df,
+        "name",
+        moves,
+        "move_id",
+        outliers["moves"],
+        names=normalize_names(moves_df["name"]),
+    )
+    # adding to `ability_stats`
+    ability_df = by_stats_id(
+        usage["Abilities"], found, stats_ids, "name", "ability_usage"
+    )
+    ability_df = resolve(
+        ability_df, "name", abilities, "ability_info_id", outliers["abilities"]
+    )
+    # adding to `teammate_stats`; teammates use the same names as the pokemon themselves.
+    mate_df = by_stats_id(
+        usage["Teammates"], found, stats_ids, "name", "teammate_usage"
+    )
+    mate_df = resolve(
+        mate_df,
+        "name",
+        pokemon,
+        "teammate_id",
+        outliers["pokemon"],
+        names=normalize_names(mate_df["name"]),
+    )
+    # adding to `item_stats`; there's no item table, so items keep smogon's names.
+    item_df = by_stats_id(usage["Items"], found, stats_ids, "item_name", "item_usage")
+    # adding to `nature_stats`
+    spread_df = by_stats_id(
+        usage["Spreads"], found, stats_ids, "spread", "spread_usage"
+    )
+    spread_df = split_spreads(spread_df, outliers["spreads"])
+    tables = {
+        "metagame_info": meta_df,
+        "pokemon_stats": stats_df,
+        "move_stats": moves_df,
+        "nature_stats": spread_df,
+        "ability_stats": ability_df,
+        "teammate_stats": mate_df,
+        "item_stats": item_df,
+    }
+    return tables, outliers
+
+
+def init_worker(pokemon: Lookup, moves: Lookup, abilities: Lookup):
+    """Process pool initializer; hands a worker the lookups once, so they aren't
+    pickled over again with every file.
+    """
+    global _pokemon, _moves, _abilities
+    _pokemon, _moves, _abilities = pokemon, moves, abilities
+
+
+def transform_file(body: Union[bytes, str], month: datetime.date):
+    """`transform`, with the lookups `init_worker` gave this process, packed with
+    `to_columns` so the tables come back to the loader as a handful of numpy buffers.
+    `body` is the file's raw bytes or its path, which is read a chunk at a time.
+    """
+    if isinstance(body, str):
+        with open(body, "rb") as f:
+            tables, outliers = transform(f, month, _pokemon, _moves, _abilities)
+    else:
+        tables, outliers = transform(body, month, _pokemon, _moves, _abilities)
+    if tables is not None:
+        tables = {t: to_columns(df) for t, df in tables.items()}
+    return tables, outliers
+
+
+def ability_usage(body: Union[bytes, str]) -> Dict[str, Tuple]:
+    """Pulls just the `(pokemon, ability, usage)` rows out of a chaos file, packed
+    with `to_columns`. Pokemon names are normalized like `transform` does. `body` is
+    the file's raw bytes or its path, which is read a chunk at a time.
+    """
+    if isinstance(body, str):
+        with open(body, "rb") as f:
+            names, abilities = _ability_rows(f)
+    else:
+        names, abilities = _ability_rows(body)
+    df = flatten(range(len(names)), abilities, "pokemon", "ability", "usage")
+    df["pokemon"] = normalize_names(names)[df["pokemon"].to_numpy()]
+    return to_columns(df)
+
+
+def _ability_rows(body: Union[bytes, BinaryIO]) -> Tuple[List[str], List[Dict]]:
+    # each pokemon's name and its "Abilities" block, in file order.
+    names, abilities = [], []
+    for event in parse_chaos(body, keys=["Abilities"]):
+        if event[0] == "pokemon":
+            names.append(event[1])
+            abilities.append(event[2].get("Abilities", {}))
+    return names, abilities
@@ -0,0 +1,395 @@
+import abc
+import argparse
+import html
+import json
+import mmap
+import os
+import posixpath
+import tarfile
+import tempfile
+import zipfile
+from typing import AsyncIterator, Dict, List, Tuple
+from urllib.parse import urlsplit
+import utils.http as http
+
+"""
+Where the importers read pokeapi and smogon from. By default that's the live sites
+(through `utils.http`), but a local mirror can be swapped in with `use()` to re-run
+the whole pipeline at disk speed without touching the network. A mirror is laid out
+by host and path, the way `wget --mirror` saves a site:
+
+    mirror/
+        pokeapi.co/api/v2/pokemon/1/index.json
+        www.smogon.com/stats/2023-01/chaos/gen9ou-0.json
+
+and can be a directory, a .tar or a .zip. A mirror of a single site can leave the
+host out (pokeapi's api-data repo, whose json links to `/api/v2/...` paths, works
+as-is). Urls ending in `/` resolve to their `index.json` (or `index.html`), or to
+an autoindex page listing the directory. A query string stays part of the file
+name, the way wget saves it (`api/v2/pokemon?offset=20&limit=20`), so every page
+of a list is its own file. Only a mirror without any such pages for a url (like
+api-data, whose list pages hold every result at once) falls back to the page
+without the query.
+"""
+
+CHUNK_SIZE = http.CHUNK_SIZE
+
+
+class Source(abc.ABC):
+    """The interface every source implements."""
+
+    @abc.abstractmethod
+    async def get_bytes(self, url: str) -> bytes:
+        raise NotImplementedError
+
+    async def stream(self, url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        yield await self.get_bytes(url)
+
+    def stat(self, url: str) -> Tuple[str, int]:
+        """Returns the `(etag, size)` of a url we've read, either of which may be None."""
+        return None, None
+
+    def local_path(self, url: str) -> str:
+        """Returns the path of a url's file on disk, if it has one that can be read
+        as-is, or None.
+        """
+        return None
+
+    async def get_json(self, url: str):
+        return json.loads(await self.get_bytes(url))
+
+    async def get_text(self, url: str) -> str:
+        return (await self.get_bytes(url)).decode("utf-8")
+
+    async def get_listing(self, url: str) -> str:
+        """Gets a directory listing page, which (unlike the files in it) can change
+        at any time.
+        """
+        return await self.get_text(url)
+
+
+class HttpSource(Source):
+    """The live sites, through the shared session and cache in `utils.http`."""
+
+    async def get_bytes(self, url: str) -> bytes:
+        return await http.get_bytes(url)
+
+    async def get_listing(self, url: str) -> str:
+        # always revalidated, or a newly published month wouldn't show up until
+        # the cached listing expired.
+        return await http.get_text(url, revalidate=True)
+
+    async def stream(self, url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async for chunk in http.stream(url, chunk_size):
+            yield chunk
+
+    def stat(self, url: str) -> Tuple[str, int]:
+        entry = http.cached(url)
+        return (entry.etag, entry.size) if entry is not None else (None, None)
+
+
+def _mirror_paths(url: str) -> List[str]:
+    # https://pokeapi.co/api/v2/pokemon/1/?x=y -> pokeapi.co/api/v2/pokemon/1, then
+    # api/v2/pokemon/1 for mirrors of a single site (like pokeapi's api-data repo).
+    # the query is left for `_resolve` to add back on.
+    parts = urlsplit(url)
+    path = posixpath.normpath(parts.path.lstrip("/") or ".").strip("/")
+    path = "" if path == "." else path
+    if not parts.netloc:
+        return [path]
+    return [f"{parts.netloc}/{path}".rstrip("/"), path]
+
+
+def _autoindex(names: List[str]) -> bytes:
+    # a listing in the same shape as smogon's stats pages, so `get_links` works on it.
+    links = ['<a href="../">../</a>']
+    for name in sorted(names):
+        links.append(f'<a href="{html.escape(name)}">{html.escape(name)}</a>')
+    return f"<html><body><pre>{chr(10).join(links)}</pre></body></html>".encode()
+
+
+class MirrorSource(Source):
+    """Shared url -> member resolution for the directory and archive mirrors."""
+
+    @abc.abstractmethod
+    def _is_file(self, path: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _list(self, path: str) -> List[str]:
+        """The names in a directory (sub-directories end in `/`), or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _read(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _size(self, path: str) -> int:
+        raise NotImplementedError
+
+    def _has_pages(self, path: str) -> bool:
+        # whether the mirror has any `path?...` files, i.e. pages of it by query.
+        folder, name = posixpath.split(path)
+        return any(n.startswith(f"{name}?") for n in self._list(folder) or [])
+
+    def _resolve(self, url: str) -> str:
+        query = urlsplit(url).query
+        for path in _mirror_paths(url):
+            candidates = [
+                path,
+                *(f"{path}/{index}".lstrip("/") for index in ("index.json", "index.html")),
+            ]
+            if query:
+                for candidate in candidates:
+                    if self._is_file(f"{candidate}?{query}"):
+                        return f"{candidate}?{query}"
+                # the page without the query would be some other page of the list
+                # (and lead back to this one, forever).
+                if any(self._has_pages(c) for c in candidates):
+                    continue
+            for candidate in candidates:
+                if self._is_file(candidate):
+                    return candidate
+        return None
+
+    async def get_bytes(self, url: str) -> bytes:
+        path = self._resolve(url)
+        if path is not None:
+            return self._read(path)
+        # (a page of a list that isn't in the mirror isn't a listing of its folder.)
+        for path in _mirror_paths(url) if not urlsplit(url).query else []:
+            names = self._list(path)
+            if names is not None:
+                return _autoindex(names)
+        raise FileNotFoundError(f"{url} isn't in the mirror")
+
+    async def get_json(self, url: str):
+        # json is never an autoindex; a url that would only get one isn't mirrored.
+        path = self._resolve(url)
+        if path is None:
+            raise FileNotFoundError(f"{url} isn't in the mirror as a file")
+        return json.loads(self._read(path))
+
+    def stat(self, url: str) -> Tuple[str, int]:
+        path = self._resolve(url)
+        return None, (self._size(path) if path is not None else None)
+
+
+class DirSource(MirrorSource):
+    """A mirror in a directory on disk."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _full(self, path: str) -> str:
+        return os.path.join(self.root, *path.split("/"))
+
+    def _is_file(self, path: str) -> bool:
+        return os.path.isfile(self._full(path))
+
+    def _list(self, path: str) -> List[str]:
+        full = self._full(path)
+        if not os.path.isdir(full):
+            return None
+        return [
+            f"{n}/" if os.path.isdir(os.path.join(full, n)) else n
+            for n in os.listdir(full)
+        ]
+
+    def _read(self, path: str) -> bytes:
+        with open(self._full(path), "rb") as f:
+            return f.read()
+
+    def _size(self, path: str) -> int:
+        return os.path.getsize(self._full(path))
+
+    def local_path(self, url: str) -> str:
+        path = self._resolve(url)
+        return self._full(path) if path is not None else None
+
+    async def stream(self, url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        path = self._resolve(url)
+        if path is None:
+            yield await self.get_bytes(url)
+            return
+        with open(self._full(path), "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+
+class ArchiveSource(MirrorSource):
+    """A mirror in a .tar or .zip. The archive is memory-mapped and its member
+    table read once; members that are stored uncompressed (everything in a plain
+    .tar, and ZIP_STORED members of a .zip) are read as slices of the map, with no
+    extraction step. Compressed members are decompressed as they're read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        # path -> (offset of its data in the archive, size, name in the archive),
+        # with a None offset if it has to be decompressed.
+        self._members: Dict[str, Tuple[int, int, str]] = {}
+        self._dirs: Dict[str, set] = {}
+        self._tar: tarfile.TarFile = None
+        self._zip: zipfile.ZipFile = None
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(self._file)
+            for info in self._zip.infolist():
+                if info.is_dir():
+                    continue
+                offset = None
+                if info.compress_type == zipfile.ZIP_STORED:
+                    # the data starts after the local header, whose name/extra
+                    # lengths can differ from the central directory's.
+                    h = info.header_offset
+                    name_len = int.from_bytes(self._map[h + 26 : h + 28], "little")
+                    extra_len = int.from_bytes(self._map[h + 28 : h + 30], "little")
+                    offset = h + 30 + name_len + extra_len
+                self._add(info.filename, offset, info.file_size)
+        else:
+            self._tar = tarfile.open(fileobj=self._file)
+            # a compressed tar gets wrapped in a decompressing file object.
+            plain = self._tar.fileobj is self._file
+            for info in self._tar.getmembers():
+                if info.isfile():
+                    self._add(info.name, info.offset_data if plain else None, info.size)
+
+    def _add(self, name: str, offset: int, size: int):
+        path = posixpath.normpath(name).strip("/")
+        self._members[path] = (offset, size, name)
+        # registering every parent directory so they can be listed.
+        parts = path.split("/")
+        for i in range(len(parts)):
+            parent = "/".join(parts[:i])
+            child = parts[i] + ("/" if i < len(parts) - 1 else "")
+            self._dirs.setdefault(parent, set()).add(child)
+
+    def _is_file(self, path: str) -> bool:
+        return path in self._members
+
+    def _list(self, path: str) -> List[str]:
+        names = self._dirs.get(path)
+        return None if names is None else list(names)
+
+    def _size(self, path: str) -> int:
+        return self._members[path][1]
+
+    def _open_member(self, path: str):
+        name = self._members[path][2]
+        if self._zip is not None:
+            return self._zip.open(name)
+        return self._tar.extractfile(name)
+
+    def _read(self, path: str) -> bytes:
+        offset, size, _ = self._members[path]
+        if offset is not None:
+            return self._map[offset : offset + size]
+        with self._open_member(path) as f:
+            return f.read()
+
+    async def stream(self, url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        path = self._resolve(url)
+        if path is None:
+            yield await self.get_bytes(url)
+            return
+        offset, size, _ = self._members[path]
+        if offset is not None:
+            view = memoryview(self._map)[offset : offset + size]
+            try:
+                for i in range(0, size, chunk_size):
+                    yield view[i : i + chunk_size]
+            finally:
+                view.release()
+            return
+        with self._open_member(path) as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+
+def open_source(location: str = None) -> Source:
+    """Opens the source at a location: None for the live sites, or the path to a
+    mirror directory, .tar or .zip.
+    """
+    if location is None:
+        return HttpSource()
+    if os.path.isdir(location):
+        return DirSource(location)
+    return ArchiveSource(location)
+
+
+_source: Source = HttpSource()
+
+
+def use(source: Source):
+    """Makes every importer read from `source`."""
+    global _source
+    _source = source
+
+
+def current() -> Source:
+    return _source
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Adds the `--mirror` option to a script's argument parser."""
+    parser.add_argument(
+        "--mirror",
+        help="read pokeapi/smogon from a local mirror (a directory, .tar or .zip) "
+        "instead of the live sites",
+    )
+
+
+def configure_from_args(args: argparse.Namespace):
+    """Switches to the mirror given with `--mirror`, if there was one."""
+    if getattr(args, "mirror", None) is not None:
+        use(open_source(args.mirror))
+
+
+async def get_bytes(url: str) -> bytes:
+    return await _source.get_bytes(url)
+
+
+async def get_json(url: str):
+    return await _source.get_json(url)
+
+
+async def get_text(url: str) -> str:
+    return await _source.get_text(url)
+
+
+async def get_listing(url: str) -> str:
+    return await _source.get_listing(url)
+
+
+async def stream(url: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    async for chunk in _source.stream(url, chunk_size):
+        yield chunk
+
+
+def stat(url: str) -> Tuple[str, int]:
+    return _source.stat(url)
+
+
+def local_path(url: str) -> str:
+    return _source.local_path(url)
+
+
+async def spool(url: str, dir: str = None) -> str:
+    """Streams a url into a temp file, a chunk at a time, so a big body never has
+    to be held in memory. The caller removes the file when it's done with it.
+
+    Returns:
+        str: The path of the temp file.
+    """
+    fd, path = tempfile.mkstemp(suffix=posixpath.splitext(urlsplit(url).path)[1], dir=dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in stream(url):
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
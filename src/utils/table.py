@@ -0,0 +1,217 @@
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+class TableBuilder:
+    """Collects rows for a table into one python list per column and only builds
+    a DataFrame once, when `to_frame` is called. Appending a row is O(1), unlike
+    `df.loc[len(df.index)] = row`, which copies the frame every time.
+
+    Tasks on the event loop can share a builder safely, since an append never
+    awaits in the middle of a row.
+    """
+
+    def __init__(self, columns: List[str], dtypes: Dict[str, str] = None):
+        """
+        Args:
+            columns (List[str]): The names of the columns, in row order.
+            dtypes (Dict[str, str], optional): Pandas dtypes for some or all of
+            the columns, applied when the frame is built. Defaults to None.
+        """
+        self.columns = list(columns)
+        self.dtypes = dtypes or {}
+        self._data = [[] for _ in self.columns]
+
+    def __len__(self) -> int:
+        return len(self._data[0])
+
+    def append(self, row: List):
+        """Appends a single row (in the same order as `columns`)."""
+        for col, val in zip(self._data, row):
+            col.append(val)
+
+    def extend(self, rows: List[List]):
+        """Appends many rows at once."""
+        for row in rows:
+            self.append(row)
+
+    def to_frame(self) -> DataFrame:
+        """Builds the DataFrame from everything appended so far."""
+        data = {}
+        for name, col in zip(self.columns, self._data):
+            dtype = self.dtypes.get(name)
+            data[name] = pd.Series(col, dtype=dtype)
+        return DataFrame(data, columns=self.columns)
+
+    def clear(self):
+        """Empties the builder so it can be reused for the next batch."""
+        self._data = [[] for _ in self.columns]
+
+
+class NestedBuilder:
+    """Flattens a column of nested `{key: value}` dicts (like the Moves, Abilities,
+    Items, Spreads and Teammates of a chaos file) into long `(parent, key, value)`
+    rows. Keys and values are appended to flat lists as each dict comes in, along
+    with how many came from each parent, so there's never a wide parent x key
+    matrix to build and stack back down.
+    """
+
+    def __init__(self):
+        self._parents = []
+        self._lengths = []
+        self._keys = []
+        self._values = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def append(self, parent: int, nested: Dict):
+        """Appends every `key: value` of one parent's dict."""
+        self._parents.append(parent)
+        self._lengths.append(len(nested))
+        self._keys.extend(nested.keys())
+        self._values.extend(nested.values())
+
+    def arrays(self):
+        """Returns the flat `(parents, keys, values)` arrays, one entry per pair."""
+        parents = np.repeat(
+            np.asarray(self._parents, dtype=np.int64),
+            np.asarray(self._lengths, dtype=np.int64),
+        )
+        keys = np.asarray(self._keys, dtype=object)
+        values = np.asarray(self._values, dtype=np.float64)
+        return parents, keys, values
+
+    def to_frame(self, parent_col: str, key_col: str, value_col: str) -> DataFrame:
+        """Builds the long DataFrame, with the given column names."""
+        parents, keys, values = self.arrays()
+        return DataFrame({parent_col: parents, key_col: keys, value_col: values})
+
+
+def flatten(
+    parents: Iterable[int],
+    nested: Iterable[Dict],
+    parent_col: str,
+    key_col: str,
+    value_col: str,
+) -> DataFrame:
+    """Flattens a column of dicts into a long `(parent, key, value)` DataFrame.
+
+    Args:
+        parents (Iterable[int]): The id of the row each dict belongs to.
+        nested (Iterable[Dict]): The dicts.
+        parent_col (str): The name of the parent id column.
+        key_col (str): The name of the key column.
+        value_col (str): The name of the value column.
+    """
+    builder = NestedBuilder()
+    for parent, d in zip(parents, nested):
+        builder.append(parent, d)
+    return builder.to_frame(parent_col, key_col, value_col)
+
+
+def _downcast(values: np.ndarray) -> np.ndarray:
+    # ids and counts are sent in the smallest int type that holds them.
+    if values.dtype.kind not in "iu" or len(values) == 0:
+        return values
+    return pd.to_numeric(values, downcast="integer")
+
+
+def to_columns(df: DataFrame, downcast: bool = True) -> Dict[str, Tuple]:
+    """Packs a DataFrame into plain numpy buffers, for handing it from a worker
+    process to the loader. Pickling a column of python objects pickles every
+    object; a packed frame is just a few arrays, which pickle as raw memory.
+
+    - numeric columns become `("array", values, dtype)`, with integers downcast to
+      the smallest type that fits (and cast back to `dtype` when unpacked).
+    - nullable numeric columns (like "Int64") become `("masked", values, mask, dtype)`.
+    - everything else (names, dates...) is factorized into `("codes", codes, uniques)`,
+      so each distinct value is only sent once. Missing values get a code of -1.
+
+    Pass `downcast=False` to skip shrinking the integers when the columns aren't
+    going to be pickled anyway.
+    """
+    shrink = _downcast if downcast else lambda values: values
+    cols = {}
+    for name in df.columns:
+        col = df[name]
+        masked = isinstance(col.dtype, pd.api.extensions.ExtensionDtype)
+        if masked and col.dtype.kind in "iuf":
+            values = col.to_numpy(dtype=col.dtype.numpy_dtype, na_value=0)
+            small = shrink(values)
+            cols[name] = ("masked", small, col.isna().to_numpy(), values.dtype)
+        elif col.dtype.kind in "iu":
+            values = col.to_numpy()
+            cols[name] = ("array", shrink(values), values.dtype)
+        elif col.dtype.kind in "bf":
+            cols[name] = ("array", col.to_numpy(), col.dtype)
+        else:
+            codes, uniques = pd.factorize(col)
+            uniques = np.asarray(uniques, dtype=object)
+            cols[name] = ("codes", codes.astype(np.int32), uniques)
+    return cols
+
+
+def unpack_column(packed: Tuple):
+    """Unpacks a single column packed by `to_columns`, as a numpy or pandas array."""
+    if packed[0] == "array":
+        return packed[1].astype(packed[2], copy=False)
+    if packed[0] == "masked":
+        values, mask = packed[1].astype(packed[3], copy=False), packed[2]
+        if values.dtype.kind == "f":
+            return pd.arrays.FloatingArray(values, mask)
+        return pd.arrays.IntegerArray(values, mask)
+    codes, uniques = packed[1], packed[2]
+    return np.append(uniques, None)[codes]
+
+
+def from_columns(cols: Dict[str, Tuple]) -> DataFrame:
+    """Unpacks a frame packed by `to_columns`."""
+    data = {}
+    for name, packed in cols.items():
+        values = unpack_column(packed)
+        data[name] = pd.Series(values, dtype=object) if packed[0] == "codes" else values
+    return DataFrame(data, columns=list(cols))
+
+
+def concat_columns(frames: List[Dict[str, Tuple]]) -> Dict[str, Tuple]:
+    """Concatenates frames packed by `to_columns` (with the same columns) without
+    unpacking them: numbers are joined as they are, and codes are offset onto the
+    joined uniques. Integers come out at their full size again.
+    """
+    frames = [f for f in frames if columns_len(f) != 0]
+    if len(frames) == 0:
+        return {}
+    cols = {}
+    for name in frames[0]:
+        packs = [f[name] for f in frames]
+        kinds = {p[0] for p in packs}
+        if kinds == {"codes"}:
+            offsets = np.cumsum([0] + [len(p[2]) for p in packs[:-1]])
+            codes = [np.where(p[1] < 0, -1, p[1] + o) for p, o in zip(packs, offsets)]
+            uniques = np.concatenate([p[2] for p in packs])
+            cols[name] = ("codes", np.concatenate(codes).astype(np.int32), uniques)
+        elif "codes" not in kinds:
+            # the dtype to unpack to is always the last thing in the tuple.
+            values = np.concatenate([p[1].astype(p[-1], copy=False) for p in packs])
+            if kinds == {"array"}:
+                cols[name] = ("array", values, values.dtype)
+            else:
+                mask = np.concatenate(
+                    [p[2] if p[0] == "masked" else np.zeros(len(p[1]), bool) for p in packs]
+                )
+                cols[name] = ("masked", values, mask, values.dtype)
+        else:
+            # numbers in some frames and objects in others; packed again as a whole.
+            col = pd.concat([pd.Series(unpack_column(p)) for p in packs], ignore_index=True)
+            cols[name] = to_columns(DataFrame({name: col}), downcast=False)[name]
+    return cols
+
+
+def columns_len(cols: Dict[str, Tuple]) -> int:
+    """The number of rows in a frame packed by `to_columns`."""
+    if len(cols) == 0:
+        return 0
+    return len(next(iter(cols.values()))[1])